@@ -0,0 +1,316 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: benchmarks/mock_tator.py
+# Description: in-memory mock of the Tator REST endpoints used by fastapi-tator, with injected latency and errors
+
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+PROJECT_ID = 1
+PROJECT_NAME = "benchmark"
+BOX_TYPE = 10
+IMAGE_TYPE = 20
+VIDEO_TYPE = 21
+VERSIONS = {"Baseline": 1, "V2": 2}
+
+# Query parameters sent as comma separated lists and those that are integers
+LIST_PARAMS = {"media_id", "version", "attribute", "attribute_lt", "attribute_contains",
+               "related_attribute", "related_attribute_lt", "related_attribute_contains"}
+INT_PARAMS = {"type", "after", "start", "stop"}
+
+
+@dataclass
+class Dataset:
+    """
+    Size and make up of the generated project
+    """
+    media: int = 1000
+    localizations_per_media: int = 20
+    clusters: int = 50
+    labels: int = 10
+    verified_fraction: float = 0.2
+    delete_fraction: float = 0.05
+    seed: int = 0
+
+
+def _match(value: Any, expected: str) -> bool:
+    return str(value).lower() == expected.lower()
+
+
+def _lt(value: Any, limit: str) -> bool:
+    try:
+        return float(value) < float(limit)
+    except (TypeError, ValueError):
+        return False
+
+
+class MockTator:
+    """
+    A Tator project held in memory. Each call sleeps latency_s plus up to jitter_s seconds, and fails with a 503
+    with probability error_rate. Calls are counted by endpoint, and localizations updated and deleted are counted.
+    """
+
+    def __init__(self, dataset: Dataset, latency_s: float = 0., jitter_s: float = 0., error_rate: float = 0.):
+        self.dataset = dataset
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self.errors = 0
+        self.updated = 0
+        self.deleted = 0
+        self._random = random.Random(dataset.seed)
+        self.reset()
+
+    def reset(self):
+        """
+        Regenerate the project and clear the counters
+        """
+        d = self.dataset
+        rng = random.Random(d.seed)
+        self.media: Dict[int, dict] = {}
+        self.localizations: Dict[int, dict] = {}
+        self.by_media: Dict[int, List[int]] = {}
+        loc_id = 1
+        for media_id in range(1, d.media + 1):
+            image = media_id % 2 == 1
+            self.media[media_id] = {"id": media_id, "type": IMAGE_TYPE if image else VIDEO_TYPE,
+                                    "name": f"dive{media_id % 7}_{media_id:06d}.{'jpg' if image else 'mp4'}",
+                                    "attributes": {}}
+            ids = []
+            for _ in range(d.localizations_per_media):
+                self.localizations[loc_id] = {
+                    "id": loc_id, "media": media_id, "type": BOX_TYPE,
+                    "version": VERSIONS["Baseline"] if rng.random() < 0.9 else VERSIONS["V2"],
+                    "attributes": {
+                        "Label": f"label{rng.randrange(d.labels)}",
+                        "cluster": f"C{rng.randrange(d.clusters)}",
+                        "verified": rng.random() < d.verified_fraction,
+                        "saliency": rng.randrange(1000),
+                        "score": round(rng.random(), 3),
+                        "delete": rng.random() < d.delete_fraction,
+                    },
+                }
+                ids.append(loc_id)
+                loc_id += 1
+            self.by_media[media_id] = ids
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.errors = 0
+        self.updated = 0
+        self.deleted = 0
+
+    # Filters, with the semantics of the Tator query parameters used by the service
+
+    @staticmethod
+    def _match_attributes(attributes: dict, params: dict, prefix: str = "") -> bool:
+        for f in params.get(f"{prefix}attribute", []):
+            name, value = f.split("::", 1)
+            if not name.startswith("$") and not _match(attributes.get(name), value):
+                return False
+        for f in params.get(f"{prefix}attribute_lt", []):
+            name, value = f.split("::", 1)
+            if not _lt(attributes.get(name), value):
+                return False
+        return True
+
+    @staticmethod
+    def _match_name(media: dict, params: dict, prefix: str = "") -> bool:
+        for f in params.get(f"{prefix}attribute", []):
+            name, value = f.split("::", 1)
+            if name == "$name" and media["name"] != value:
+                return False
+        for f in params.get(f"{prefix}attribute_contains", []):
+            name, value = f.split("::", 1)
+            if name == "$name" and value not in media["name"]:
+                return False
+        return True
+
+    def find_media(self, params: dict) -> List[dict]:
+        related = any(k.startswith("related_") for k in params)
+        media_ids = set(params.get("media_id", []))
+        out = []
+        for media in self.media.values():
+            if "type" in params and media["type"] != params["type"]:
+                continue
+            if media_ids and media["id"] not in media_ids:
+                continue
+            if "after" in params and media["id"] <= params["after"]:
+                continue
+            if not self._match_name(media, params):
+                continue
+            if related and not any(self._match_attributes(self.localizations[i]["attributes"], params, "related_")
+                                   for i in self.by_media[media["id"]] if i in self.localizations):
+                continue
+            out.append(media)
+        return out
+
+    def find_localizations(self, params: dict) -> List[dict]:
+        if "media_id" in params:
+            candidates = (self.localizations[i] for m in params["media_id"] for i in self.by_media.get(m, ())
+                          if i in self.localizations)
+        else:
+            candidates = self.localizations.values()
+        versions = set(params.get("version", []))
+        related = any(k.startswith("related_") for k in params)
+        out = []
+        for loc in candidates:
+            if versions and loc["version"] not in versions:
+                continue
+            if "after" in params and loc["id"] <= params["after"]:
+                continue
+            if not self._match_attributes(loc["attributes"], params):
+                continue
+            if related and not self._match_name(self.media[loc["media"]], params, "related_"):
+                continue
+            out.append(loc)
+        return out
+
+    @staticmethod
+    def _page(items: List[dict], params: dict) -> List[dict]:
+        items = sorted(items, key=lambda i: i["id"])
+        return items[params.get("start", 0):params.get("stop")]
+
+    async def call(self, endpoint: str) -> JSONResponse | None:
+        """
+        Count a call, wait the injected latency and maybe fail it
+        :return: an error response, or None to go on with the call
+        """
+        self.calls[endpoint] += 1
+        delay = self.latency_s + (self._random.random() * self.jitter_s if self.jitter_s else 0.)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return JSONResponse(status_code=503, content={"message": "injected error"})
+        return None
+
+
+def _parse(request: Request) -> dict:
+    params = {}
+    for name, value in request.query_params.multi_items():
+        if name in LIST_PARAMS:
+            values = [v for v in value.split(",") if v]
+            params[name] = [int(v) for v in values] if name in ("media_id", "version") else values
+        elif name in INT_PARAMS:
+            params[name] = int(value)
+        else:
+            params[name] = value
+    return params
+
+
+def create_app(mock: MockTator) -> FastAPI:
+    """
+    ASGI app serving the mock under the Tator REST paths
+    """
+    app = FastAPI()
+
+    @app.get("/rest/User/GetCurrent")
+    async def whoami():
+        return await mock.call("whoami") or {"id": 1, "username": "benchmark"}
+
+    @app.get("/rest/Projects")
+    async def get_project_list():
+        return await mock.call("get_project_list") or [{"id": PROJECT_ID, "name": PROJECT_NAME}]
+
+    @app.get("/rest/LocalizationTypes/{project}")
+    async def get_localization_type_list(project: int):
+        return await mock.call("get_localization_type_list") or [{"id": BOX_TYPE, "name": "Boxes", "dtype": "box"}]
+
+    @app.get("/rest/MediaTypes/{project}")
+    async def get_media_type_list(project: int):
+        return await mock.call("get_media_type_list") or [{"id": IMAGE_TYPE, "name": "Images", "dtype": "image"},
+                                                          {"id": VIDEO_TYPE, "name": "Videos", "dtype": "video"}]
+
+    @app.get("/rest/Versions/{project}")
+    async def get_version_list(project: int):
+        return await mock.call("get_version_list") or [{"id": i, "name": n} for n, i in VERSIONS.items()]
+
+    @app.get("/rest/MediaCount/{project}")
+    async def get_media_count(project: int, request: Request):
+        return await mock.call("get_media_count") or len(mock.find_media(_parse(request)))
+
+    @app.get("/rest/Medias/{project}")
+    async def get_media_list(project: int, request: Request):
+        params = _parse(request)
+        return await mock.call("get_media_list") or mock._page(mock.find_media(params), params)
+
+    @app.get("/rest/LocalizationCount/{project}")
+    async def get_localization_count(project: int, request: Request):
+        return await mock.call("get_localization_count") or len(mock.find_localizations(_parse(request)))
+
+    @app.get("/rest/Localizations/{project}")
+    async def get_localization_list(project: int, request: Request):
+        params = _parse(request)
+        return await mock.call("get_localization_list") or mock._page(mock.find_localizations(params), params)
+
+    @app.get("/rest/Localization/{id}")
+    async def get_localization(id: int):
+        error = await mock.call("get_localization")
+        if error:
+            return error
+        if id not in mock.localizations:
+            return JSONResponse(status_code=404, content={"message": f"Localization {id} not found"})
+        return mock.localizations[id]
+
+    @app.patch("/rest/Localizations/{project}")
+    async def update_localization_list(project: int, request: Request):
+        error = await mock.call("update_localization_list")
+        if error:
+            return error
+        body = await request.json()
+        ids = [i for i in body.get("ids", []) if i in mock.localizations]
+        for i in ids:
+            mock.localizations[i]["attributes"].update(body.get("attributes", {}))
+        mock.updated += len(ids)
+        return {"message": f"Successfully updated {len(ids)} localizations!"}
+
+    @app.delete("/rest/Localizations/{project}")
+    async def delete_localization_list(project: int, request: Request):
+        error = await mock.call("delete_localization_list")
+        if error:
+            return error
+        found = mock.find_localizations(_parse(request))
+        for loc in found:
+            del mock.localizations[loc["id"]]
+        mock.deleted += len(found)
+        return {"message": f"Successfully deleted {len(found)} localizations!"}
+
+    return app
+
+
+class MockServer:
+    """
+    Serves the mock on a local port from a background thread, so both the SDK and the async client reach it over HTTP
+    """
+
+    def __init__(self, mock: MockTator, port: int = 0):
+        self.mock = mock
+        self.server = uvicorn.Server(uvicorn.Config(create_app(mock), host="127.0.0.1", port=port, log_level="warning",
+                                                    access_log=False))
+        self._thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        socket = self.server.servers[0].sockets[0]
+        return f"http://127.0.0.1:{socket.getsockname()[1]}"
+
+    def __enter__(self) -> "MockServer":
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self._thread.join()
@@ -0,0 +1,171 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: benchmarks/run.py
+# Description: end-to-end benchmarks of the bulk operations against a local mock Tator server.
+#   Run from the repository root with
+#   PYTHONPATH=src python benchmarks/run.py [--media 1000] [--latency-ms 20] [--client async] [--update-baseline]
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from mock_tator import Dataset, MockServer, MockTator, PROJECT_NAME
+
+BASELINES = Path(__file__).parent / "baselines.json"
+
+# Bulk operations by name: HTTP method, path and request body. Each one runs as a queued job on a fresh dataset.
+OPERATIONS = {
+    "cluster_relabel": ("POST", "/label/cluster/relabeled", {"cluster_name": "C1", "version_name": "Baseline"}),
+    "filename_delete": ("DELETE", "/localizations/filename", {"media_name": "dive3", "filter_media": "Includes"}),
+    "filename_label_delete": ("DELETE", "/localizations/filename_label",
+                              {"media_name": "dive3", "filter_media": "Includes", "label_name": "label1", "version_name": "Baseline"}),
+    "saliency_delete": ("DELETE", "/localizations/filename_saliency",
+                        {"media_name": "dive3", "filter_media": "Includes", "saliency_value": 100, "version_name": "Baseline"}),
+    "delete_flag_purge": ("DELETE", "/localizations/delete_flag", {}),
+}
+
+
+def configure_environment(url: str, client: str):
+    """
+    Point the service at the mock before it is imported. There is no database, so the bulk operations take their
+    REST paths, and no Redis server, so jobs run in the web process.
+    """
+    os.environ.update({
+        "TATOR_API_HOST": url,
+        "TATOR_API_TOKEN": "benchmark",
+        "TATOR_DEFAULT_PROJECT": PROJECT_NAME,
+        "FASTAPI_TATOR_SQL_RESOLVE": "false",
+        "TATOR_DB_HOST": "127.0.0.1",
+        "TATOR_DB_PORT": "1",
+        "TATOR_DB_POOL_TIMEOUT": "0.1",
+        "FASTAPI_TATOR_ASYNC_CLIENT": "true" if client == "async" else "false",
+        "FASTAPI_TATOR_JOB_DEDUP_WINDOW": "0",
+        "FASTAPI_TATOR_HEALTH_INTERVAL": "3600",
+        "FASTAPI_TATOR_LOG_LEVEL": "WARNING",
+        "FASTAPI_TATOR_CHECKPOINT_DB": str(Path(tempfile.mkdtemp(prefix="fastapi-tator-bench")) / "checkpoints.db"),
+    })
+    for name in ("TATOR_DB_PASSWORD", "FASTAPI_TATOR_REDIS_URL"):
+        os.environ.pop(name, None)
+
+
+def wait_for_job(client, job_id: str, timeout_s: float) -> Dict[str, Any]:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        status = client.get(f"/jobs/{job_id}").json()
+        if status.get("status") in ("finished", "failed", "stopped", "canceled"):
+            return status
+        time.sleep(0.01)
+    raise TimeoutError(f"Job {job_id} did not finish in {timeout_s} s")
+
+
+def run_operation(client, mock: MockTator, name: str, timeout_s: float) -> Dict[str, Any]:
+    """
+    Run one bulk operation as a job on a fresh dataset
+    :return: the measurements of the run
+    """
+    method, path, body = OPERATIONS[name]
+    mock.reset()
+    start = time.perf_counter()
+    response = client.request(method, path, json={**body, "project_name": PROJECT_NAME, "dry_run": False})
+    response.raise_for_status()
+    job_id = response.json().get("job_id")
+    if job_id is None:
+        raise RuntimeError(f"{name} did not queue a job: {response.text}")
+    job = wait_for_job(client, job_id, timeout_s)
+    elapsed_s = time.perf_counter() - start
+    localizations = mock.updated + mock.deleted
+    return {
+        "status": job["status"],
+        "elapsed_s": round(elapsed_s, 3),
+        "localizations": localizations,
+        "throughput": round(localizations / elapsed_s, 1) if elapsed_s > 0 else 0.,
+        "upstream_calls": sum(mock.calls.values()),
+        "calls": dict(sorted(mock.calls.items())),
+        "upstream_errors": mock.errors,
+        "job_errors": len(job.get("errors") or []),
+    }
+
+
+def scenario_name(args: argparse.Namespace) -> str:
+    return (f"{args.client}-{args.media}x{args.locs_per_media}-latency{args.latency_ms:g}ms"
+            f"-errors{args.error_rate:g}")
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], tolerance: float) -> list:
+    """
+    Regressions of the results against a baseline: more upstream calls, which is deterministic without injected
+    errors, or lower throughput beyond the tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["localizations"] != base["localizations"]:
+            regressions.append(f"{name}: {result['localizations']} localizations changed, baseline {base['localizations']}")
+        if result["upstream_calls"] > base["upstream_calls"] * (1 + tolerance):
+            regressions.append(f"{name}: {result['upstream_calls']} upstream calls, baseline {base['upstream_calls']}")
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['throughput']} localizations/s, baseline {base['throughput']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bulk operations against a local mock Tator server")
+    parser.add_argument("--media", type=int, default=1000, help="number of media in the dataset")
+    parser.add_argument("--locs-per-media", type=int, default=20, help="localizations per media")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency added to each upstream call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random latency added on top of --latency-ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of upstream calls that fail with a 503")
+    parser.add_argument("--client", choices=("sdk", "async"), default="sdk", help="tator SDK threads or the async client")
+    parser.add_argument("--ops", nargs="+", choices=sorted(OPERATIONS), default=list(OPERATIONS), help="operations to run")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each operation, the fastest is kept")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each job")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression as a fraction of the baseline")
+    parser.add_argument("--baselines", type=Path, default=BASELINES, help="baselines file")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the baseline of the scenario")
+    args = parser.parse_args()
+
+    mock = MockTator(Dataset(media=args.media, localizations_per_media=args.locs_per_media),
+                     latency_s=args.latency_ms / 1000, jitter_s=args.jitter_ms / 1000, error_rate=args.error_rate)
+    with MockServer(mock) as server:
+        configure_environment(server.url, args.client)
+        from fastapi.testclient import TestClient
+        from app.main import app
+
+        results = {}
+        with TestClient(app) as client:
+            for name in args.ops:
+                runs = [run_operation(client, mock, name, args.timeout) for _ in range(args.repeat)]
+                results[name] = max(runs, key=lambda r: r["throughput"])
+                r = results[name]
+                print(f"{name:24} {r['status']:9} {r['localizations']:8} locs {r['elapsed_s']:8.3f} s "
+                      f"{r['throughput']:10.1f} locs/s {r['upstream_calls']:6} calls {r['upstream_errors']:4} errors")
+
+    scenario = scenario_name(args)
+    baselines = json.loads(args.baselines.read_text()) if args.baselines.exists() else {}
+    if args.update_baseline:
+        baselines[scenario] = results
+        args.baselines.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Stored the baseline of {scenario} in {args.baselines}")
+        return
+
+    if scenario not in baselines:
+        print(f"No baseline for {scenario}, store one with --update-baseline")
+        return
+    regressions = compare(results, baselines[scenario], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions against the baseline of {scenario}")
+
+
+if __name__ == "__main__":
+    main()
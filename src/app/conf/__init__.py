@@ -1 +1,16 @@
-from .init import temp_path, default_project
+from .init import temp_path, default_project, db_name, db_user, db_password, db_host, db_port, \
+    db_pool_min_size, db_pool_max_size, db_pool_timeout_s, db_statement_timeout_ms, \
+    project_spec_ttl_s, project_refresh_interval_s, version_ttl_s, \
+    sdk_threads, sdk_max_concurrency, sdk_project_concurrency, sdk_interactive_reserved, \
+    tator_async_client, tator_pool_size, tator_http2, tator_timeout_s, tator_project_concurrency, \
+    batch_concurrency, batch_prefetch, \
+    media_page_size, \
+    sql_resolve, loc_chunk_size, \
+    redis_url, job_queue_name, job_timeout_s, job_result_ttl_s, \
+    health_interval_s, health_timeout_s, health_stale_s, \
+    profile_token, profile_interval_s, profile_top_n, server_timing, \
+    worker_metrics_port, checkpoint_db, job_drain_timeout_s, job_dedup_window_s, \
+    label_cache_size, label_cache_ttl_s, \
+    log_level, log_json, log_rate_limit, log_max_items, log_max_length, \
+    export_fetch_size, export_statement_timeout_ms, export_concurrency, \
+    batch_target_localizations, batch_target_latency_s, batch_min_media, batch_max_media, batch_project_limits
@@ -5,6 +5,7 @@
 
 from pathlib import Path
 import tempfile
+import json
 import os
 
 temp_path = Path(tempfile.gettempdir()) / "fastapi-tator"
@@ -15,3 +16,96 @@ if "TATOR_DEFAULT_PROJECT" not in os.environ:
     default_project = "901902-uavs"
 else:
     default_project = os.environ["TATOR_DEFAULT_PROJECT"]
+
+# Direct (read-only) access to the tator Postgres database, used for the label count queries
+db_name = os.environ.get("TATOR_DB_NAME", "tator_online")
+db_user = os.environ.get("TATOR_DB_USER", "django")
+db_password = os.environ.get("TATOR_DB_PASSWORD")
+db_host = os.environ.get("TATOR_DB_HOST", "mantis.shore.mbari.org")
+db_port = int(os.environ.get("TATOR_DB_PORT", "5432"))
+# Size of the shared async connection pool, how long to wait for a free connection in seconds,
+# and the default per-query statement timeout in milliseconds
+db_pool_min_size = int(os.environ.get("TATOR_DB_POOL_MIN", "1"))
+db_pool_max_size = int(os.environ.get("TATOR_DB_POOL_MAX", "10"))
+db_pool_timeout_s = float(os.environ.get("TATOR_DB_POOL_TIMEOUT", "30"))
+db_statement_timeout_ms = int(os.environ.get("TATOR_DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+# How long a resolved project specification is cached in seconds, and how often the project list is refreshed
+project_spec_ttl_s = float(os.environ.get("FASTAPI_TATOR_PROJECT_SPEC_TTL", "600"))
+project_refresh_interval_s = float(os.environ.get("FASTAPI_TATOR_PROJECT_REFRESH_INTERVAL", "300"))
+# How long the version name to id map of a project is cached in seconds
+version_ttl_s = float(os.environ.get("FASTAPI_TATOR_VERSION_TTL", "300"))
+# Number of threads for blocking tator SDK calls and the maximum number of SDK calls in flight at once
+sdk_threads = int(os.environ.get("FASTAPI_TATOR_SDK_THREADS", "16"))
+sdk_max_concurrency = int(os.environ.get("FASTAPI_TATOR_SDK_MAX_CONCURRENCY", "16"))
+# SDK calls in flight at once for one project, and the slots bulk operations leave free for interactive requests
+sdk_project_concurrency = int(os.environ.get("FASTAPI_TATOR_SDK_PROJECT_CONCURRENCY", "8"))
+sdk_interactive_reserved = int(os.environ.get("FASTAPI_TATOR_SDK_INTERACTIVE_RESERVED", "2"))
+# Call Tator with a native async HTTP client instead of the SDK thread pool, the size of its connection pool, which is
+# also the number of calls in flight at once, whether to use HTTP/2 when the server supports it, and the call timeout
+tator_async_client = os.environ.get("FASTAPI_TATOR_ASYNC_CLIENT", "false").lower() in ("1", "true", "yes")
+tator_pool_size = int(os.environ.get("FASTAPI_TATOR_HTTP_POOL_SIZE", "100"))
+tator_http2 = os.environ.get("FASTAPI_TATOR_HTTP2", "true").lower() in ("1", "true", "yes")
+tator_timeout_s = float(os.environ.get("FASTAPI_TATOR_HTTP_TIMEOUT", "60"))
+# Calls in flight at once for one project with the async client, by default three quarters of its connection pool
+tator_project_concurrency = int(os.environ.get("FASTAPI_TATOR_HTTP_PROJECT_CONCURRENCY", str(max(1, tator_pool_size * 3 // 4))))
+# Number of batches updated at once and number of batches fetched ahead in the bulk operations
+batch_concurrency = int(os.environ.get("FASTAPI_TATOR_BATCH_CONCURRENCY", "4"))
+batch_prefetch = int(os.environ.get("FASTAPI_TATOR_BATCH_PREFETCH", "2"))
+# Number of media fetched per request when scanning media ids
+media_page_size = int(os.environ.get("FASTAPI_TATOR_MEDIA_PAGE_SIZE", "1000"))
+# Media batches of the bulk operations are sized to hold about batch_target_localizations localizations and to
+# take about batch_target_latency_s seconds upstream, between batch_min_media and batch_max_media media.
+# Overrides per project as JSON, e.g. {"901103-biodiversity": {"max_media": 20, "target_localizations": 2000}}
+batch_target_localizations = int(os.environ.get("FASTAPI_TATOR_BATCH_TARGET_LOCALIZATIONS", "5000"))
+batch_target_latency_s = float(os.environ.get("FASTAPI_TATOR_BATCH_TARGET_LATENCY", "10"))
+batch_min_media = int(os.environ.get("FASTAPI_TATOR_BATCH_MIN_MEDIA", "1"))
+batch_max_media = int(os.environ.get("FASTAPI_TATOR_BATCH_MAX_MEDIA", "500"))
+batch_project_limits = json.loads(os.environ.get("FASTAPI_TATOR_BATCH_PROJECT_LIMITS", "{}"))
+# Resolve the localizations to modify with direct database queries when database credentials are configured,
+# and the number of localization ids in each bulk update
+sql_resolve = os.environ.get("FASTAPI_TATOR_SQL_RESOLVE", "true").lower() in ("1", "true", "yes")
+loc_chunk_size = int(os.environ.get("FASTAPI_TATOR_LOC_CHUNK_SIZE", "500"))
+# Redis server for the durable job queue, e.g. redis://redis:6379/0. Jobs run inside the web process if not set
+redis_url = os.environ.get("FASTAPI_TATOR_REDIS_URL")
+job_queue_name = os.environ.get("FASTAPI_TATOR_JOB_QUEUE", "fastapi-tator")
+# Maximum run time of a job and how long job results are kept, in seconds
+job_timeout_s = int(os.environ.get("FASTAPI_TATOR_JOB_TIMEOUT", str(24 * 3600)))
+job_result_ttl_s = int(os.environ.get("FASTAPI_TATOR_JOB_RESULT_TTL", str(7 * 24 * 3600)))
+# How long a finished job still absorbs identical requests, in seconds. Identical requests always attach to a queued
+# or running job. 0 disables deduplication
+job_dedup_window_s = int(os.environ.get("FASTAPI_TATOR_JOB_DEDUP_WINDOW", "300"))
+# sqlite database with the progress cursors of bulk jobs so jobs interrupted by a restart resume where they stopped,
+# and how long a shutdown waits for running jobs to checkpoint, in seconds
+checkpoint_db = os.environ.get("FASTAPI_TATOR_CHECKPOINT_DB",
+                               "/sqlite_data/checkpoints.db" if Path("/sqlite_data").is_dir() else str(temp_path / "checkpoints.db"))
+job_drain_timeout_s = float(os.environ.get("FASTAPI_TATOR_JOB_DRAIN_TIMEOUT", "60"))
+# Logging: level of the console, one JSON object per line instead of plain text, messages per second allowed from one
+# log call before the rest are dropped (0 for no limit), and how many items of a long list or mapping are logged
+log_level = os.environ.get("FASTAPI_TATOR_LOG_LEVEL", "DEBUG").upper()
+log_json = os.environ.get("FASTAPI_TATOR_LOG_JSON", "false").lower() in ("1", "true", "yes")
+log_rate_limit = float(os.environ.get("FASTAPI_TATOR_LOG_RATE_LIMIT", "20"))
+log_max_items = int(os.environ.get("FASTAPI_TATOR_LOG_MAX_ITEMS", "10"))
+log_max_length = int(os.environ.get("FASTAPI_TATOR_LOG_MAX_LENGTH", "2000"))
+# How often the health snapshot behind /health/ready is refreshed, how long each check may take, and the age
+# after which a snapshot no longer counts as ready, in seconds
+health_interval_s = float(os.environ.get("FASTAPI_TATOR_HEALTH_INTERVAL", "10"))
+health_timeout_s = float(os.environ.get("FASTAPI_TATOR_HEALTH_TIMEOUT", "5"))
+health_stale_s = float(os.environ.get("FASTAPI_TATOR_HEALTH_STALE", "60"))
+# Profiling of single requests and their jobs, off unless a token is set. A request is profiled when it sends the token
+# in the X-Profile header. Sampling interval of the profiler in seconds and number of allocation sites reported
+profile_token = os.environ.get("FASTAPI_TATOR_PROFILE_TOKEN")
+profile_interval_s = float(os.environ.get("FASTAPI_TATOR_PROFILE_INTERVAL", "0.001"))
+profile_top_n = int(os.environ.get("FASTAPI_TATOR_PROFILE_TOP_N", "25"))
+# Add a Server-Timing header with the time spent in tator SDK calls and SQL queries to each response
+server_timing = os.environ.get("FASTAPI_TATOR_SERVER_TIMING", "true").lower() in ("1", "true", "yes")
+# Port of the prometheus metrics of a queue worker, 0 to disable
+worker_metrics_port = int(os.environ.get("FASTAPI_TATOR_WORKER_METRICS_PORT", "9100"))
+# Maximum number of cached label count results and how long they are kept, in seconds
+label_cache_size = int(os.environ.get("FASTAPI_TATOR_LABEL_CACHE_SIZE", "256"))
+label_cache_ttl_s = float(os.environ.get("FASTAPI_TATOR_LABEL_CACHE_TTL", "300"))
+# Number of rows fetched at a time by exports and the statement timeout of their queries, in milliseconds
+export_fetch_size = int(os.environ.get("FASTAPI_TATOR_EXPORT_FETCH_SIZE", "5000"))
+export_statement_timeout_ms = int(os.environ.get("FASTAPI_TATOR_EXPORT_STATEMENT_TIMEOUT_MS", str(60 * 60 * 1000)))
+# Exports streamed at a time, each holds a pooled database connection while the client reads
+export_concurrency = int(os.environ.get("FASTAPI_TATOR_EXPORT_CONCURRENCY", str(max(1, db_pool_max_size // 4))))
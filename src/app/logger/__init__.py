@@ -1,14 +1,27 @@
 # fastapi-tator, Apache-2.0 license
 # Filename: app/conf/init_config.py
-# Description:  Logger for fastapi-tator. Logs to both a file and the console
+# Description:  Logger for fastapi-tator. Logs to both a file and the console from a background thread
 
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from datetime import datetime as dt
+from datetime import datetime as dt, timezone
+from typing import Any, Dict, List, Tuple
+
+from app.conf import log_level, log_json, log_rate_limit, log_max_items, log_max_length
 
 LOGGER_NAME = "MANTIS"
 DEBUG = True
 
+# Records waiting for the logging thread. While it is full records below ERROR are dropped rather than blocking the caller,
+# errors are written by the caller
+QUEUE_SIZE = 10000
+
 
 class _Singleton(type):
     """A metaclass that creates a Singleton base class when called."""
@@ -25,19 +38,176 @@ class Singleton(_Singleton("SingletonMeta", (object,), {})):
     pass
 
 
+class _Summary:
+    """Stands in for a long list or mapping in a log message"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+    __str__ = __repr__
+
+
+def summarize(value: Any, max_items: int = log_max_items) -> Any:
+    """
+    Shorten the lists, tuples, sets and mappings in a value to their first max_items items and a count of the rest,
+    e.g. the ids of a bulk update
+    """
+    if isinstance(value, dict):
+        items = [(k, summarize(v, max_items)) for k, v in list(value.items())[:max_items]]
+        if len(value) > max_items:
+            text = ", ".join(f"{k!r}: {v!r}" for k, v in items)
+            return _Summary(f"{{{text}, ... {len(value) - max_items} more}}")
+        return dict(items)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [summarize(v, max_items) for v in list(value)[:max_items]]
+        if len(value) > max_items:
+            return _Summary(f"[{', '.join(map(repr, items))}, ... {len(value) - max_items} more]")
+        return items if isinstance(value, list) else tuple(items)
+    return value
+
+
+def _summarized(record: logging.LogRecord) -> logging.LogRecord:
+    """
+    Copy of a record with its message formatted from the summarized arguments, cut to log_max_length characters
+    """
+    record = logging.makeLogRecord(record.__dict__)
+    if not isinstance(record.msg, str):
+        record.msg = str(summarize(record.msg))
+    if record.args:
+        args = record.args
+        if isinstance(args, dict):
+            # logging passes a single mapping argument as args, used by %(key)s messages or as a whole by %s
+            record.args = {k: summarize(v) for k, v in args.items()} if "%(" in record.msg else (summarize(args),)
+        else:
+            record.args = tuple(summarize(a) for a in args)
+    message = record.getMessage()
+    if len(message) > log_max_length:
+        message = f"{message[:log_max_length]}... ({len(message)} characters)"
+    dropped = getattr(record, "dropped", 0)
+    if dropped:
+        message = f"{message} [{dropped} similar messages dropped]"
+    record.msg, record.args = message, None
+    return record
+
+
+class SummarizingFormatter(logging.Formatter):
+    """Plain text formatter that keeps long messages short, see summarize"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return super().format(_summarized(record))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the message kept short, see summarize"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        record = _summarized(record)
+        entry = {
+            "time": dt.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "line": record.lineno,
+            "message": record.msg,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops the records of a log call beyond rate per second. Errors are never dropped. The next record of the call let
+    through says how many were dropped.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        # (start of the current second, records let through, records dropped) by log call
+        self._windows: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= 1:
+                if window is not None and window[2]:
+                    record.dropped = window[2]
+                self._windows[key] = [record.created, 1, 0]
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Queues records without formatting them so messages are built by the logging thread, not the caller.
+    Arguments are formatted when the record is written, so do not change them after logging.
+    When the queue is full, errors are written directly to the handlers and other records are dropped and counted.
+    The count is logged as a warning once the queue has room again.
+    """
+
+    def __init__(self, records: queue.Queue, handlers: List[logging.Handler]):
+        super().__init__(records)
+        self.handlers = handlers
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def _write(self, record: logging.LogRecord):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self._unreported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "%d log records dropped while the log queue was full", "args": (self._unreported,)}))
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.ERROR:
+                self._write(record)
+            else:
+                self.dropped += 1
+                self._unreported += 1
+
+
 class CustomLogger(Singleton):
     _logger = None
     _output_path = Path.cwd()
+    _listener = None
 
     def __init__(self, output_path: Path = Path.cwd(), output_prefix: str = "tator"):
         """
         Initialize the logger
         """
+        console_level = logging.getLevelName(log_level)
+        if not isinstance(console_level, int):
+            console_level = logging.DEBUG
         self._logger = logging.getLogger(LOGGER_NAME)
-        self._logger.setLevel(logging.DEBUG)
+        # Disabled levels return before their arguments are formatted
+        self._logger.setLevel(min(console_level, logging.INFO))
         self._output_path = output_path
         output_path.mkdir(parents=True, exist_ok=True)
-        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(name)s]: %(message)s")
+        if log_json:
+            formatter = JsonFormatter()
+        else:
+            formatter = SummarizingFormatter("[%(asctime)s] [%(levelname)s] [%(name)s]: %(message)s")
 
         # default log file date to today
         now = dt.utcnow()
@@ -47,15 +217,38 @@ class CustomLogger(Singleton):
         handler = logging.FileHandler(log_filename, mode="w")
         handler.setFormatter(formatter)
         handler.setLevel(logging.INFO)
-        self._logger.addHandler(handler)
 
         # also log to console
         console = logging.StreamHandler()
-        console.setLevel(logging.DEBUG)
+        console.setLevel(console_level)
         console.setFormatter(formatter)
-        self._logger.addHandler(console)
 
-        self._logger.info(f"Logging to {log_filename}")
+        # the handlers write from a background thread so logging does not block the event loop
+        self._handlers = [handler, console]
+        self._queue_handler = _DeferredQueueHandler(queue.Queue(QUEUE_SIZE), self._handlers)
+        self._queue_handler.addFilter(RateLimitFilter(log_rate_limit))
+        self._logger.addHandler(self._queue_handler)
+        self._start_listener()
+        atexit.register(lambda: self._listener.stop())
+        # A forked process, e.g. the work horse of a queue worker, has no logging thread, so it starts its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+        self._logger.info("Logging to %s", log_filename)
+
+    def _start_listener(self):
+        self._listener = QueueListener(self._queue_handler.queue, *self._handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def _after_fork(self):
+        self._queue_handler.queue = queue.Queue(QUEUE_SIZE)
+        self._start_listener()
+
+    def flush(self):
+        """
+        Write the queued records, waiting for the logging thread to catch up
+        """
+        self._listener.stop()
+        self._listener.start()
 
     def loggers(self) -> logging.Logger:
         return self._logger
@@ -71,6 +264,15 @@ def create_logger_file(log_path: Path, prefix: str = "tator"):
     return CustomLogger(log_path, prefix)
 
 
+def flush_logs():
+    """
+    Write the queued log records, e.g. before a process exits without running atexit handlers
+    """
+    logger = _Singleton.instances.get(CustomLogger)
+    if logger is not None:
+        logger.flush()
+
+
 def custom_logger() -> logging.Logger:
     """
     Get the logger
@@ -78,25 +280,28 @@ def custom_logger() -> logging.Logger:
     return logging.getLogger(LOGGER_NAME)
 
 
-def err(s: str):
-    custom_logger().error(s)
+# The functions take printf-style arguments, formatted only if the level is enabled, e.g. debug("Found %d ids", len(ids)).
+# Long lists and mappings in the arguments are shortened, see summarize. stacklevel=2 records the caller's line.
+
+def err(s: Any, *args):
+    custom_logger().error(s, *args, stacklevel=2)
 
 
-def info(s: str):
-    custom_logger().info(s)
+def info(s: Any, *args):
+    custom_logger().info(s, *args, stacklevel=2)
 
 
-def debug(s: str):
-    custom_logger().debug(s)
+def debug(s: Any, *args):
+    custom_logger().debug(s, *args, stacklevel=2)
 
 
-def warn(s: str):
-    custom_logger().warning(s)
+def warn(s: Any, *args):
+    custom_logger().warning(s, *args, stacklevel=2)
 
 
-def exception(s: str):
-    custom_logger().exception(s)
+def exception(s: Any, *args):
+    custom_logger().exception(s, *args, stacklevel=2)
 
 
-def critical(s: str):
-    custom_logger().critical(s)
+def critical(s: Any, *args):
+    custom_logger().critical(s, *args, stacklevel=2)
@@ -2,19 +2,22 @@
 # Filename: app/main.py
 # Description: Runs a FastAPI server for common bulk operations on tator
 
+import asyncio
 import os
-from contextlib import asynccontextmanager
+from collections import Counter
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 from typing import List
 
-from fastapi import FastAPI, status, Request, BackgroundTasks
+from fastapi import FastAPI, status, Request, Response, UploadFile, Form
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.openapi.utils import get_openapi
 
 from app import __version__
-from app.logger import info, debug, create_logger_file
+from app.conf import db_password, default_project, server_timing
+from app.logger import info, debug, err, create_logger_file
 from app import logger
 
 from app.ops.models import (
@@ -26,14 +29,26 @@ from app.ops.models import (
     LocClusterFilterModel,
     MediaIdFilterModel,
     DeleteFlagFilterModel,
-    LocIdFilterModel, MediaNameFilterModelBase, LabelFilterModel, LabelScoreFilterModel,
+    LocIdFilterModel, MediaNameFilterModelBase, LabelFilterModel, LabelScoreFilterModel, ExportFilterModel, ExportFormat,
+    LocLabelBulkModel, ClusterLabelPlanModel,
 )
-from app.ops.modifications import assign_cluster_media_label, assign_cluster_label, change_label_id
 from app.ops.utils import NotFoundException, init_api, get_projects, get_image_spec_version, \
     get_project_spec, get_version_id, get_media_count, get_localization_count, prepare_media_kwargs, get_media_list, \
     get_localization, get_label_counts_json, check_media_args, get_tator_projects, get_label_counts_cluster, \
     get_label_counts_score
-from app.ops.deletions import del_media_id, del_locs_by_filter, del_locs_filename
+from app.ops.db import open_db_pool, close_db_pool
+from app.ops.projects import registry
+from app.ops.cache import CachedValue, etag_matches, listen_for_writes
+from app.ops.executor import shutdown_executor
+from app.ops.health import monitor
+from app.ops.tator_client import AsyncTatorClient
+from app.ops.tracing import TracingMiddleware
+from app.ops.profiling import ProfilingMiddleware, PROFILE_HEADER, profiling_enabled, profile_allowed, profile_path
+from app.ops.redis_process import submit_job, get_job_status, local_mode, resume_jobs, drain_local_jobs
+from app.ops.queries import sql_resolve_enabled, estimate_localizations, count_cluster_localizations
+from app.ops.modifications import change_label_ids
+from app.ops.uploads import InvalidUploadException, is_parquet, parse_cluster_file, MAX_ERRORS
+from app.ops.export import EXPORTERS, EXTENSIONS, MEDIA_TYPES, export_slot_available, stream_export
 from prometheus_fastapi_instrumentator import Instrumentator
 
 global projects
@@ -42,12 +57,13 @@ init_flag = False
 api = None
 create_logger_file(Path.home() / "tator_api" / "logs", "TATOR_API")
 
-# Define a function to handle the SIGINT signal (Ctrl+C)
-def handle_sigint(signum, frame):
+# Called on shutdown, after uvicorn has handled SIGINT (Ctrl+C) or SIGTERM
+async def handle_shutdown():
     global shutdown_flag
-    info("Received Ctrl+C signal. Stopping the application...")
-    print("Received Ctrl+C signal. Stopping the application...")
-    shutdown_flag = False
+    info("Stopping the application...")
+    shutdown_flag = True
+    # Jobs running in this process checkpoint and resume on the next start
+    await drain_local_jobs()
 
 
 async def handle_init():
@@ -63,7 +79,22 @@ async def handle_init():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await handle_init()
+    await open_db_pool()
+    refresh_task = asyncio.create_task(registry.refresh_loop(api))
+    writes_task = asyncio.create_task(listen_for_writes())
+    health_task = asyncio.create_task(monitor.refresh_loop(api))
+    if local_mode():
+        await resume_jobs(api)
     yield
+    await handle_shutdown()
+    for task in (refresh_task, writes_task, health_task):
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await close_db_pool()
+    if isinstance(api, AsyncTatorClient):
+        await api.aclose()
+    shutdown_executor()
 
 app = FastAPI(
     title="Bulk Tator API",
@@ -91,6 +122,14 @@ if CORS_ORIGINS:
         expose_headers=["*"],
     )
 
+# Upstream call times of each request in a Server-Timing header, see app/ops/tracing.py
+if server_timing:
+    app.add_middleware(TracingMiddleware)
+
+# Opt-in profiling of single requests, installed only when FASTAPI_TATOR_PROFILE_TOKEN is set
+if profiling_enabled():
+    app.add_middleware(ProfilingMiddleware)
+
 # Exception handler for 404 errors
 @app.exception_handler(NotFoundException)
 async def nof_found_exception(request: Request, exc: NotFoundException):
@@ -107,18 +146,51 @@ async def root():
 
 @app.get("/health", status_code=status.HTTP_200_OK)
 async def health():
-    try:
-        global projects
+    # Answers while the server is up, with the error of the last background Tator check if it failed.
+    # The database and job queue are only part of /health/ready
+    error = monitor.tator_error()
+    if error is not None:
+        return {"message": f"Error: {error}"}
+    return {"message": "OK"}
 
-        # Check if project are available and return a 503 error if not
-        projects = await get_projects(api)
 
-        if len(projects) == 0:
-            return {"message": "no projects available"}, 503
+@app.get("/health/live",
+         summary="Liveness probe, OK while the server answers requests",
+         status_code=status.HTTP_200_OK)
+async def health_live():
+    return {"message": "OK"}
 
-        return {"message": "OK"}
-    except Exception as ex:
-        return {"message": f"Error: {ex}"}, 503
+
+@app.get("/health/ready",
+         summary="Readiness probe from a snapshot of Tator, database and job queue checks refreshed in the background",
+         status_code=status.HTTP_200_OK)
+async def health_ready():
+    snapshot = monitor.snapshot()
+    if not snapshot["ready"]:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=snapshot)
+    return snapshot
+
+
+@app.get("/profiles/{name}",
+         summary="Download a stored profile, e.g. <X-Profile-Id>.speedscope.json, sending the profiling token in X-Profile",
+         status_code=status.HTTP_200_OK)
+async def get_profile(name: str, request: Request):
+    if not profile_allowed(request.headers.get(PROFILE_HEADER)):
+        return JSONResponse(status_code=status.HTTP_403_FORBIDDEN, content={"message": "Profiling not allowed"})
+    path = profile_path(name)
+    if path is None or not path.exists():
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": f"Profile {name} not found"})
+    return FileResponse(path, filename=name)
+
+
+@app.get("/jobs/{job_id}",
+         summary="Get the status, progress and errors of a queued operation",
+         status_code=status.HTTP_200_OK)
+async def get_job(job_id: str):
+    job_status = await asyncio.to_thread(get_job_status, job_id)
+    if job_status is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": f"Job {job_id} not found"})
+    return job_status
 
 
 @app.get("/projects",
@@ -138,10 +210,24 @@ async def get_all_projects():
         return {"message": f"Error: {ex}"}
 
 
+def label_count_response(counts: CachedValue, request: Request, response: Response):
+    """
+    Label counts with their Age and ETag headers, or 304 Not Modified if a GET client already has them.
+    If-None-Match is ignored on the POST routes, as 304 only answers GET and HEAD requests
+    """
+    headers = {"Age": str(int(counts.age_s))}
+    if counts.etag:
+        headers["ETag"] = counts.etag
+        if request.method in ("GET", "HEAD") and etag_matches(request.headers.get("if-none-match"), counts.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return {"labels": counts.value}
+
+
 @app.get("/labels/{project_name}",
          summary="Get the list of unique labels associated with a Tator project and the count of each label.",
          status_code=status.HTTP_200_OK)
-async def get_label_list(project_name: str):
+async def get_label_list(project_name: str, request: Request, response: Response):
     """
     Get the list of unique labels associated with a Tator project and the count of each label.
     - **project_name**** the name of the project, e.g. 901902-uavs
@@ -154,7 +240,7 @@ async def get_label_list(project_name: str):
     try:
         # Return a dictionary of labels/counts pairs
         label_count = await get_label_counts_json(spec.project_id)
-        return {"labels": label_count}
+        return label_count_response(label_count, request, response)
     except Exception as ex:
         return {"message": f"Error: {ex}"}, 404
 
@@ -162,7 +248,8 @@ async def get_label_list(project_name: str):
 @app.post("/labels/score/{project_name}",
           summary="Get labels with score greater than a threshold",
           status_code=status.HTTP_200_OK)
-async def get_label_list_greater_than_score(project_name: str, item: LabelScoreFilterModel):
+async def get_label_list_greater_than_score(project_name: str, item: LabelScoreFilterModel, request: Request,
+                                            response: Response):
     """
     Get the list of unique labels associated with a Tator project and the count of each label.
     - **project_name** the name of the project
@@ -180,15 +267,26 @@ async def get_label_list_greater_than_score(project_name: str, item: LabelScoreF
 
         # Return a dictionary of labels/counts pairs grouped by label that are greater than the score
         label_count = await get_label_counts_score(spec.project_id, version_id, model.score)
-        return {"labels": label_count}
+        return label_count_response(label_count, request, response)
 
     except Exception as ex:
         return {"message": f"Error: {ex}"}, 404
 
+
+@app.get("/labels/score/{project_name}",
+         summary="Get labels with score greater than a threshold, cacheable with If-None-Match",
+         status_code=status.HTTP_200_OK)
+async def get_label_list_greater_than_score_query(project_name: str, request: Request, response: Response,
+                                                  version_name: str = "Baseline", score: str = "0.5"):
+    return await get_label_list_greater_than_score(
+        project_name, LabelScoreFilterModel(version_name=version_name, score=score), request, response)
+
+
 @app.post("/labels/cluster/{project_name}",
           summary="Get the list of unique labels associated with a Tator project and the count of each label.",
           status_code=status.HTTP_200_OK)
-async def get_label_list_cluster_and_version(project_name: str, item: LabelFilterModel):
+async def get_label_list_cluster_and_version(project_name: str, item: LabelFilterModel, request: Request,
+                                             response: Response):
     """
     Get the list of unique labels associated with a Tator project and the count of each label.
 
@@ -207,17 +305,76 @@ async def get_label_list_cluster_and_version(project_name: str, item: LabelFilte
 
         # Return a dictionary of labels/counts pairs grouped by optional attribute (e.g. depth, altitude)
         label_count = await get_label_counts_cluster(spec.project_id, version_id, model.attribute)
-        return {"labels": label_count}
+        return label_count_response(label_count, request, response)
 
     except Exception as ex:
         return {"message": f"Error: {ex}"}, 404
 
 
+@app.get("/labels/cluster/{project_name}",
+         summary="Get the label counts of a Tator project grouped by an attribute, cacheable with If-None-Match",
+         status_code=status.HTTP_200_OK)
+async def get_label_list_cluster_and_version_query(project_name: str, request: Request, response: Response,
+                                                   version_name: str = "Baseline", attribute: str = "depth"):
+    return await get_label_list_cluster_and_version(
+        project_name, LabelFilterModel(version_name=version_name, attribute=attribute), request, response)
+
+
+@app.post("/export",
+          summary="Stream labeled localizations for training as NDJSON, COCO JSON or a YOLO zip",
+          status_code=status.HTTP_200_OK)
+async def export_localizations(item: ExportFilterModel):
+    """
+    Stream the localizations with a label, optionally filtered by label, cluster and verified state.
+    Defaults to verified localizations. Requires database credentials.
+
+    - **export_format** ndjson, coco or yolo
+    """
+    model = ExportFilterModel(**jsonable_encoder(item))
+    try:
+        export_format = ExportFormat(model.export_format)
+    except ValueError:
+        return {"message": f"Invalid export format {model.export_format}. Must be 'ndjson', 'coco' or 'yolo'"}
+
+    if db_password is None:
+        return {"message": "Exports require the database credentials in TATOR_DB_PASSWORD"}
+
+    try:
+        spec = await get_project_spec(api, model.project_name)
+    except NotFoundException as ex:
+        return {"message": f"{ex._name} project not found. Is {ex._name} the correct project?"}, 404
+
+    if spec.box_type is None:
+        return {"message": f"No box type found for project {model.project_name}"}
+
+    version_id = await get_version_id(api, spec.project_id, model.version_name)
+    if version_id is None and len(model.version_name) > 0:
+        return {"message": f"No version found for project {model.project_name} with version {model.version_name}"}
+
+    filters = {
+        "version_id": version_id,
+        "label_name": model.label_name,
+        "cluster_name": model.cluster_name,
+        "verified": model.verified,
+    }
+    if not export_slot_available():
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "60"},
+                            content={"message": "Too many exports running, try again later"})
+
+    info(f"Exporting {export_format.value} from project {spec.project_name} with {filters}")
+    filename = f"{spec.project_name}_{model.version_name or 'all'}.{EXTENSIONS[export_format]}"
+    return StreamingResponse(
+        stream_export(EXPORTERS[export_format], spec, **filters),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.post("/label/id/{label}",
           summary="Assign a label to a localization by id",
           status_code=status.HTTP_200_OK)
 async def assign_label_by_id(
-        label: str, item: LocIdFilterModel, background_tasks: BackgroundTasks
+        label: str, item: LocIdFilterModel
 ):
     try:
         model = LocIdFilterModel(**jsonable_encoder(item))  # Convert to a model
@@ -245,8 +402,91 @@ async def assign_label_by_id(
             info(f"Found localization")
             return {"message": f"Found localization for id {model.loc_id} with label {found.attributes['Label']}"}
         else:
-            background_tasks.add_task(change_label_id, model=model, api=api, label=label, spec=spec)
-            return {"message": f"Queued localization change for id {model.loc_id}"}
+            job_id = await submit_job(api, "change_label_id", model, label=label)
+            return {"message": f"Queued localization change for id {model.loc_id}", "job_id": job_id}
+    except Exception as ex:
+        return {"message": f"Error: {ex}"}
+
+@app.post("/label/ids",
+          summary="Assign labels to many localizations by id, with an optional score and verified state for each",
+          status_code=status.HTTP_200_OK)
+async def assign_labels_by_ids(
+        model: LocLabelBulkModel
+):
+    try:
+        try:
+            spec = await get_project_spec(api, model.project_name)
+        except NotFoundException as ex:
+            return {"message": f"{ex._name} project not found. Is {ex._name} the correct project?"}, 404
+
+        if spec.box_type is None:
+            return {"message": f"No box type found for project {model.project_name}"}
+
+        if spec.project_id is None:
+            return {"message": f"No project id found for project {model.project_name}"}
+
+        if model.dry_run:
+            calls, results = await change_label_ids(model, api, spec)
+            planned = sum(1 for r in results if r.status == "planned")
+            return {"message": f"Found {planned} of {len(results)} localizations to update in {calls} calls",
+                    "results": results}
+        # The result of each item is in the summary of the job
+        job_id = await submit_job(api, "assign_label_ids", model)
+        return {"message": f"Queued label changes for {len(model.items)} localizations", "job_id": job_id}
+    except Exception as ex:
+        return {"message": f"Error: {ex}"}
+
+@app.post("/label/clusters",
+          summary="Assign labels to many clusters from an uploaded sdcat CSV or Parquet file with cluster, label and optional verify columns",
+          status_code=status.HTTP_200_OK)
+async def assign_labels_by_clusters(
+        file: UploadFile,
+        project_name: str = Form(default_project),
+        version_name: str = Form("Baseline"),
+        dry_run: bool = Form(True),
+):
+    try:
+        try:
+            spec = await get_project_spec(api, project_name)
+        except NotFoundException as ex:
+            return {"message": f"{ex._name} project not found. Is {ex._name} the correct project?"}, 404
+
+        if spec.box_type is None:
+            return {"message": f"No box type found for project {project_name}"}
+
+        version_id = await get_version_id(api, spec.project_id, version_name)
+        if version_id is None and len(version_name) > 0:
+            return {"message": f"Version {version_name} not found in project {project_name}"}
+
+        try:
+            assignments = await asyncio.to_thread(parse_cluster_file, file.file, is_parquet(file.filename, file.content_type))
+        except InvalidUploadException as ex:
+            return {"message": f"Invalid file {file.filename}. {ex.message}"}
+
+        response = {"rows": assignments.rows, "clusters": len(assignments.items), "num_errors": assignments.num_errors,
+                    "errors": assignments.errors}
+        if len(assignments.items) == 0:
+            return {"message": f"No cluster assignments found in {assignments.rows} rows of {file.filename}", **response}
+
+        clusters = [item.cluster_name for item in assignments.items]
+        if sql_resolve_enabled():
+            try:
+                counts = await count_cluster_localizations(spec, clusters, version_id)
+                response["localizations"] = sum(counts.values())
+                response["not_found"] = [c for c in clusters if c not in counts][:MAX_ERRORS]
+            except Exception as ex:
+                err(f"Failed to count the localizations in {len(clusters)} clusters. Error: {ex}")
+
+        labels = Counter(item.label for item in assignments.items)
+        model = ClusterLabelPlanModel(items=assignments.items, version_name=version_name, project_name=project_name,
+                                      dry_run=dry_run)
+        if dry_run:
+            return {"message": f"Found {len(clusters)} clusters to relabel to {len(labels)} labels in version {version_name}",
+                    "labels": dict(labels), **response}
+
+        job_id = await submit_job(api, "assign_cluster_labels", model)
+        return {"message": f"Queued relabeling of {len(clusters)} clusters to {len(labels)} labels in version {version_name}",
+                "job_id": job_id, **response}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
@@ -254,7 +494,7 @@ async def assign_label_by_id(
           summary="Assign a label to a localization by cluster name. Set the verified attribute to true (default), false, or leave off verified=true|false leave verified attribute as-is",
           status_code=status.HTTP_200_OK)
 async def assign_label_by_cluster(
-        label: str, model: LocClusterFilterModel, background_tasks: BackgroundTasks
+        label: str, model: LocClusterFilterModel
 ):
     try:
         model = LocClusterFilterModel(**jsonable_encoder(model))
@@ -276,19 +516,24 @@ async def assign_label_by_cluster(
             return {"message": f"No version found for project {model.project_name} with version {model.version_name}"}
 
         attribute_cluster = [f"cluster::{model.cluster_name}"]
-        kwargs = {"related_attribute": attribute_cluster}
-
-        debug(f"kwargs {kwargs}")
-        num_media = await get_media_count(api, spec, **kwargs)
+        media_kwargs = {"related_attribute": attribute_cluster}
+        debug("kwargs %s", media_kwargs)
 
-        # Clear the kwargs and add the media name filter
-        kwargs.clear()
+        kwargs = {}
         if version_id:
             kwargs["version"] = [version_id]
-        counts = {}
-        for verified in ("True", "False"):
-            kwargs["attribute"] = [f"cluster::{model.cluster_name}", f"verified::{verified}"]
-            counts[verified] = await get_localization_count(api, spec, **kwargs)
+        estimate = await estimate_localizations(spec, version_id, {"cluster": model.cluster_name}) \
+            if sql_resolve_enabled() else None
+        if estimate is not None:
+            num_media = estimate.total.media
+            counts = {"True": estimate.verified.localizations, "False": estimate.unverified.localizations}
+        else:
+            num_media, *verified_counts = await asyncio.gather(
+                get_media_count(api, spec, **media_kwargs),
+                *(get_localization_count(api, spec, attribute=[f"cluster::{model.cluster_name}", f"verified::{verified}"], **kwargs)
+                  for verified in ("True", "False"))
+            )
+            counts = dict(zip(("True", "False"), verified_counts))
         if model.verify is not None:
             kwargs["attribute"] = [f"cluster::{model.cluster_name}", f"verified::{str(bool(model.verify))}"]
         else:
@@ -297,19 +542,23 @@ async def assign_label_by_cluster(
         if model.dry_run:
             num_verified = counts["True"]
             num_unverified = counts["False"]
-            return {
+            response = {
             "message": f'{num_unverified} unverified {num_verified} verified localizations in '
                        f'cluster {model.cluster_name} and '
                        f'{model.version_name if version_id else "all versions"} in {num_media} medias'
-        }
+            }
+            if estimate is not None:
+                response["estimate"] = estimate.model_dump()
+            return response
         else:
             if num_media == 0:
                 return {"message": f"No media found with {kwargs}"}
-            background_tasks.add_task(assign_cluster_label, label=label, model=model, api=api, spec=spec)
+            job_id = await submit_job(api, "assign_cluster_label", model, label=label)
             return {
                 "message": f"Queued modification of localizations in cluster {model.cluster_name} and "
                            f'{model.version_name if version_id else "all versions"} to label {label}'
-                           f' and verify {model.verify if model.verify is not None else "unchanged"}'
+                           f' and verify {model.verify if model.verify is not None else "unchanged"}',
+                "job_id": job_id
             }
     except Exception as ex:
         return {"message": f"Error: {ex}"}
@@ -320,7 +569,7 @@ async def assign_label_by_cluster(
           summary="Assign a label to a localization by media filename and cluster name",
           status_code=status.HTTP_200_OK)
 async def assign_label_by_media_filename_and_cluster(
-        label: str, model: LocMediaClusterFilterModel, background_tasks: BackgroundTasks
+        label: str, model: LocMediaClusterFilterModel
 ):
     try:
         model = LocMediaClusterFilterModel(**jsonable_encoder(model))
@@ -361,12 +610,11 @@ async def assign_label_by_media_filename_and_cluster(
             else:
                 return {"message": f"Invalid filter type {model.filter_media}"}
 
-        debug(f"kwargs {kwargs}")
-        num_media = await get_media_count(api, spec, **kwargs)
+        debug("kwargs %s", kwargs)
+        media_kwargs = kwargs
 
-        # Clear the kwargs and add the media name filter
-        kwargs.clear()
-        kwargs["attribute"] = [f"cluster::{model.cluster_name}"]
+        # Add the media name filter to the localization query
+        kwargs = {"attribute": [f"cluster::{model.cluster_name}"]}
         if media_filter_type == FilterType.Includes:
             kwargs["related_attribute_contains"] = [f"$name::{model.media_name}"]
         elif media_filter_type == FilterType.Equals:
@@ -375,22 +623,35 @@ async def assign_label_by_media_filename_and_cluster(
             return {"message": f"Invalid filter type {model.filter_media}"}
         if version_id:
             kwargs["version"] = [version_id]
-        num_boxes = await get_localization_count(api, spec, **kwargs)
+        estimate = await estimate_localizations(spec, version_id, {"cluster": model.cluster_name},
+                                                media_name=model.media_name, filter_media=media_filter_type) \
+            if sql_resolve_enabled() else None
+        if estimate is not None:
+            num_media, num_boxes = estimate.unverified.media, estimate.total.localizations
+        else:
+            num_media, num_boxes = await asyncio.gather(
+                get_media_count(api, spec, **media_kwargs),
+                get_localization_count(api, spec, **kwargs)
+            )
 
         if model.dry_run:
-            return {
+            response = {
             "message": f'{num_boxes} unverified localizations that '
                        f'{"include" if media_filter_type == FilterType.Includes else "equals"} '
                        f'{model.media_name} and '
                        f'{model.cluster_name} and '
                        f'{model.version_name if version_id else "all versions"} in {num_media} medias'
-        }
+            }
+            if estimate is not None:
+                response["estimate"] = estimate.model_dump()
+            return response
         else:
             if num_media == 0:
                 return {"message": f"No media found with {kwargs}"}
-            background_tasks.add_task(assign_cluster_media_label, label=label, model=model, api=api, spec=spec)
+            job_id = await submit_job(api, "assign_cluster_media_label", model, label=label)
             return {
-                "message": f"Queued modification of localizations by filename {model.media_name} and cluster {model.cluster_name} to label {label}"
+                "message": f"Queued modification of localizations by filename {model.media_name} and cluster {model.cluster_name} to label {label}",
+                "job_id": job_id
             }
     except Exception as ex:
         return {"message": f"Error: {ex}"}
@@ -434,7 +695,7 @@ async def media_count_by_media_filename(item: MediaNameFilterModelBase):
 @app.delete("/localizations/filename",
             summary="Delete localizations by media filename and filter type Includes/Equals. ONLY deletes unverified localizations",
             status_code=status.HTTP_200_OK)
-async def localizations_by_media_filename(item: MediaNameFilterModel, background_tasks: BackgroundTasks):
+async def localizations_by_media_filename(item: MediaNameFilterModel):
     model = MediaNameFilterModel(**jsonable_encoder(item))  # Convert to a model
 
     try:
@@ -459,39 +720,46 @@ async def localizations_by_media_filename(item: MediaNameFilterModel, background
     else:
         return {"message": f"Invalid filter type {model.filter_media}"}
 
-    num_media = await get_media_count(api, spec, **kwargs)
-
-    if num_media == 0:
-        return {"message": f"No media found with {kwargs}"}
-
     loc_kwargs = {}
     if media_filter_type == FilterType.Includes:
         loc_kwargs["related_attribute_contains"] = [f"$name::{model.media_name}"]
     elif media_filter_type == FilterType.Equals:
         loc_kwargs["related_attribute"] = [f"$name::{model.media_name}"]
+
+    estimate = await estimate_localizations(spec, media_name=model.media_name, filter_media=media_filter_type) \
+        if sql_resolve_enabled() else None
+    if estimate is not None:
+        num_media, num_boxes = estimate.total.media, estimate.total.localizations
     else:
-        return {"message": f"Invalid filter type {model.filter_media}"}
+        num_media, num_boxes = await asyncio.gather(
+            get_media_count(api, spec, **kwargs),
+            get_localization_count(api, spec, **loc_kwargs)
+        )
 
-    num_boxes = await get_localization_count(api, spec, **loc_kwargs)
+    if num_media == 0:
+        return {"message": f"No media found with {kwargs}"}
 
     if num_boxes == 0:
         return {"message": f"No unverified localizations found for {model.media_name}"}
 
     if model.dry_run:
-        return {
+        response = {
         "message": f"Found {num_media} medias that "
                    f"{'include' if media_filter_type == FilterType.Includes else 'equals'} "
                    f"{model.media_name} with {num_boxes} unverified localizations"
-    }
+        }
+        if estimate is not None:
+            response["estimate"] = estimate.model_dump()
+        return response
     else:
-        background_tasks.add_task(del_locs_filename, model=model, api=api, spec=spec, **loc_kwargs)
-        return {"message": f"Queued deletion of localizations in medias by filename {model.media_name}"}
+        job_id = await submit_job(api, "del_locs_filename", model, **loc_kwargs)
+        return {"message": f"Queued deletion of localizations in medias by filename {model.media_name}", "job_id": job_id}
 
 @app.delete("/localizations/filename_label",
             summary="Delete localizations by media filename Includes/Equals and label. ONLY deletes unverified localizations",
             status_code=status.HTTP_200_OK)
 async def delete_localizations_by_media_filename_and_label(
-        model: LocLabelFilterModel, background_tasks: BackgroundTasks
+        model: LocLabelFilterModel
 ):
     try:
         model = LocLabelFilterModel(**jsonable_encoder(model))
@@ -509,16 +777,24 @@ async def delete_localizations_by_media_filename_and_label(
 
         media_kwargs = prepare_media_kwargs(model, allow_empty_media=True)
         media_kwargs["related_attribute"] = [f"Label::{model.label_name}", "verified::False"]
-        num_media = await get_media_count(api, spec, **media_kwargs)
-        debug(f"Found {num_media} media with {media_kwargs}")
 
         loc_kwargs = prepare_media_kwargs(model, attribute_prefix="related")
         loc_kwargs["attribute"] = [f"Label::{model.label_name}", "verified::False"]
         if version_id:
             loc_kwargs["version"] = [version_id]
-        num_boxes = await get_localization_count(api, spec, **loc_kwargs)
+        estimate = await estimate_localizations(spec, version_id, {"Label": model.label_name},
+                                                media_name=model.media_name, filter_media=media_filter_type) \
+            if sql_resolve_enabled() else None
+        if estimate is not None:
+            num_media, num_boxes = estimate.unverified.media, estimate.unverified.localizations
+        else:
+            num_media, num_boxes = await asyncio.gather(
+                get_media_count(api, spec, **media_kwargs),
+                get_localization_count(api, spec, **loc_kwargs)
+            )
+        debug("Found %s media with %s", num_media, media_kwargs)
 
-        debug(f"Found {num_boxes} boxes in {num_media} medias")
+        debug("Found %s boxes in %s medias", num_boxes, num_media)
         if num_boxes == 0:
             return {
                 "message": f'no unverified localizations in {num_media} media that '
@@ -528,16 +804,19 @@ async def delete_localizations_by_media_filename_and_label(
             }
 
         if model.dry_run:
-            return {
+            response = {
                 "message": f'{num_boxes} unverified localizations in {num_media} media that '
                            f'{"include" if media_filter_type == FilterType.Includes else "equals"} '
                            f'{model.media_name} with label {model.label_name} in version '
                            f'{model.version_name if version_id else "all versions"}'
             }
+            if estimate is not None:
+                response["estimate"] = estimate.model_dump()
+            return response
         else:
             kwargs = {"attribute": [f"Label::{model.label_name}", "verified::False"]}
-            background_tasks.add_task(del_locs_by_filter, allow_empty_media=True, model=model, api=api, spec=spec, **kwargs)
-            return {"message": f"Queued deletion by name {model.media_name} and label {model.label_name}"}
+            job_id = await submit_job(api, "del_locs_by_filter", model, allow_empty_media=True, **kwargs)
+            return {"message": f"Queued deletion by name {model.media_name} and label {model.label_name}", "job_id": job_id}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
@@ -545,7 +824,7 @@ async def delete_localizations_by_media_filename_and_label(
             summary="Delete localizations by media filename Includes/Equals and cluster name. ONLY deletes unverified localizations",
             status_code=status.HTTP_200_OK)
 async def delete_localizations_by_media_filename_and_cluster(
-        model: LocMediaClusterFilterModel, background_tasks: BackgroundTasks
+        model: LocMediaClusterFilterModel
 ):
     try:
         model = LocMediaClusterFilterModel(**jsonable_encoder(model))
@@ -560,15 +839,23 @@ async def delete_localizations_by_media_filename_and_cluster(
 
         media_kwargs = prepare_media_kwargs(model, allow_empty_media=True)
         media_kwargs["related_attribute"] = [f"cluster::{model.cluster_name}", "verified::False"]
-        num_media = await get_media_count(api, spec, **media_kwargs)
-        debug(f"Found {num_media} media with {media_kwargs}")
 
         loc_kwargs = prepare_media_kwargs(model, attribute_prefix="related")
         loc_kwargs["attribute"] = [f"cluster::{model.cluster_name}", "verified::False"]
         if version_id:
             loc_kwargs["version"] = [version_id]
-        num_boxes = await get_localization_count(api, spec, **loc_kwargs)
-        debug(f"Found {num_boxes} boxes in {num_media} medias")
+        estimate = await estimate_localizations(spec, version_id, {"cluster": model.cluster_name},
+                                                media_name=model.media_name, filter_media=media_filter_type) \
+            if sql_resolve_enabled() else None
+        if estimate is not None:
+            num_media, num_boxes = estimate.unverified.media, estimate.unverified.localizations
+        else:
+            num_media, num_boxes = await asyncio.gather(
+                get_media_count(api, spec, **media_kwargs),
+                get_localization_count(api, spec, **loc_kwargs)
+            )
+        debug("Found %s media with %s", num_media, media_kwargs)
+        debug("Found %s boxes in %s medias", num_boxes, num_media)
         if num_boxes == 0:
             return {
                 "message": f'no unverified localizations in {num_media} media that '
@@ -578,16 +865,19 @@ async def delete_localizations_by_media_filename_and_cluster(
             }
 
         if model.dry_run:
-            return {
+            response = {
                 "message": f'{num_boxes} unverified localizations in {num_media} media that '
                            f'{"include" if media_filter_type == FilterType.Includes else "equals"} '
                            f'{loc_kwargs} in version '
                            f'{model.version_name if version_id else "all versions"}'
             }
+            if estimate is not None:
+                response["estimate"] = estimate.model_dump()
+            return response
         else:
             kwargs = {"attribute": [f"cluster::{model.cluster_name}", "verified::False"]}
-            background_tasks.add_task(del_locs_by_filter, allow_empty_media=True, model=model, api=api, spec=spec, **kwargs)
-            return {"message": f"Queued deletion by name {model.media_name} and cluster {model.cluster_name}"}
+            job_id = await submit_job(api, "del_locs_by_filter", model, allow_empty_media=True, **kwargs)
+            return {"message": f"Queued deletion by name {model.media_name} and cluster {model.cluster_name}", "job_id": job_id}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
@@ -596,7 +886,7 @@ async def delete_localizations_by_media_filename_and_cluster(
             summary="Delete localizations by media filename Includes/Equals less than a saliency value",
             status_code=status.HTTP_200_OK)
 async def delete_localizations_by_media_filename_and_low_saliency(
-        model: LocSaliencyLabelFilterModel, background_tasks: BackgroundTasks
+        model: LocSaliencyLabelFilterModel
 ):
     try:
         model = LocSaliencyLabelFilterModel(**jsonable_encoder(model))
@@ -614,16 +904,23 @@ async def delete_localizations_by_media_filename_and_low_saliency(
         media_kwargs["related_attribute_lt"] = [f"saliency::{model.saliency_value}"]
         media_kwargs["related_attribute"] = [f"verified::False"]
 
-        num_media = await get_media_count(api, spec, **media_kwargs)
-        debug(f"Found {num_media} media with {media_kwargs}")
-
         loc_kwargs = prepare_media_kwargs(model, attribute_prefix="related")
         loc_kwargs["attribute"] = [f"verified::False"]
         loc_kwargs["attribute_lt"] = [f"saliency::{model.saliency_value}"]
         if version_id:
             loc_kwargs["version"] = [version_id]
-        num_boxes = await get_localization_count(api, spec, **loc_kwargs)
-        debug(f"Found {num_boxes} boxes in {num_media} medias")
+        estimate = await estimate_localizations(spec, version_id, attributes_lt={"saliency": model.saliency_value},
+                                                media_name=model.media_name, filter_media=media_filter_type) \
+            if sql_resolve_enabled() and model.saliency_value is not None else None
+        if estimate is not None:
+            num_media, num_boxes = estimate.unverified.media, estimate.unverified.localizations
+        else:
+            num_media, num_boxes = await asyncio.gather(
+                get_media_count(api, spec, **media_kwargs),
+                get_localization_count(api, spec, **loc_kwargs)
+            )
+        debug("Found %s media with %s", num_media, media_kwargs)
+        debug("Found %s boxes in %s medias", num_boxes, num_media)
 
         if num_boxes == 0:
             return { "message": f'no unverified localizations in {num_media} media that '
@@ -633,23 +930,26 @@ async def delete_localizations_by_media_filename_and_low_saliency(
                      }
 
         if model.dry_run:
-            return {
+            response = {
                 "message": f'{num_boxes} unverified localizations in {num_media} media that '
                            f'{"include" if media_filter_type == FilterType.Includes else "equals"} '
                            f'{model.media_name} with saliency less than {model.saliency_value} in version '
                            f'{model.version_name if version_id else "all versions"}'
             }
+            if estimate is not None:
+                response["estimate"] = estimate.model_dump()
+            return response
         else:
             kwargs = {"attribute_lt": [f"saliency::{model.saliency_value}"], "attribute": [f"verified::False"]}
-            background_tasks.add_task(del_locs_by_filter, allow_empty_media=True, model=model, api=api, spec=spec, **kwargs)
-            return {"message": f"Queued deletion by name {model.media_name} and {loc_kwargs}"}
+            job_id = await submit_job(api, "del_locs_by_filter", model, allow_empty_media=True, **kwargs)
+            return {"message": f"Queued deletion by name {model.media_name} and {loc_kwargs}", "job_id": job_id}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
 @app.delete("/localizations/id",
             summary="Delete localization by id",
             status_code=status.HTTP_200_OK)
-async def delete_localizations_by_media_id(item: MediaIdFilterModel, background_tasks: BackgroundTasks):
+async def delete_localizations_by_media_id(item: MediaIdFilterModel):
 
     try:
         model = MediaIdFilterModel(**jsonable_encoder(item))  # Convert to a model
@@ -672,8 +972,8 @@ async def delete_localizations_by_media_id(item: MediaIdFilterModel, background_
             return {"message": f"Found {num_boxes} unverified localizations for media id {model.media_id}"}
         else:
             kwargs = {"attribute": ["verified::false"]}
-            background_tasks.add_task(del_media_id, model=model, api=api, spec=spec, **kwargs)
-            return {"message": f"Queued deletion of localizations for media id {model.media_id}"}
+            job_id = await submit_job(api, "del_media_id", model, **kwargs)
+            return {"message": f"Queued deletion of localizations for media id {model.media_id}", "job_id": job_id}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
@@ -681,7 +981,7 @@ async def delete_localizations_by_media_id(item: MediaIdFilterModel, background_
 @app.delete("/localizations/delete_flag",
             summary="Delete all localizations flagged for deletion",
             status_code=status.HTTP_200_OK)
-async def delete_localizations_flagged_for_deletion(item: DeleteFlagFilterModel, background_tasks: BackgroundTasks):
+async def delete_localizations_flagged_for_deletion(item: DeleteFlagFilterModel):
     try:
         model = DeleteFlagFilterModel(**jsonable_encoder(item))
 
@@ -694,15 +994,17 @@ async def delete_localizations_flagged_for_deletion(item: DeleteFlagFilterModel,
             return {"message": f"No project id found for project {model.project_name}"}
 
         media_kwargs = {"related_attribute": ["delete::True"]}
-        num_media = await get_media_count(api, spec, **media_kwargs)
-        debug(f"Found {num_media} medias  with boxes flagged for deletion")
+        loc_kwargs = {"attribute": ["delete::True"]}
+        num_media, num_boxes = await asyncio.gather(
+            get_media_count(api, spec, **media_kwargs),
+            get_localization_count(api, spec, **loc_kwargs)
+        )
+        debug("Found %s medias  with boxes flagged for deletion", num_media)
 
         if num_media == 0:
             return {"message": f"No medias found with boxes flagged for deletion"}
 
-        loc_kwargs = {"attribute": ["delete::True"]}
-        num_boxes = await get_localization_count(api, spec, **loc_kwargs)
-        debug(f"Found {num_boxes} localizations in {num_media} medias flagged for deletion in {num_media} medias")
+        debug("Found %s localizations in %s medias flagged for deletion in %s medias", num_boxes, num_media, num_media)
 
         if num_boxes == 0:
             return {"message": "No localizations found for medias flagged for deletion"}
@@ -710,8 +1012,8 @@ async def delete_localizations_flagged_for_deletion(item: DeleteFlagFilterModel,
         if model.dry_run:
             return {"message": f"Found {num_boxes} unverified localizations in {num_media} medias flagged for deletion"}
         else:
-            background_tasks.add_task(del_locs_by_filter, model=model, api=api, spec=spec, **loc_kwargs)
-            return {"message": f"Queued deletion of localizations in medias flagged for deletion"}
+            job_id = await submit_job(api, "del_locs_by_filter", model, **loc_kwargs)
+            return {"message": f"Queued deletion of localizations in medias flagged for deletion", "job_id": job_id}
     except Exception as ex:
         return {"message": f"Error: {ex}"}
 
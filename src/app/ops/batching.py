@@ -0,0 +1,229 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/batching.py
+# Description: adaptive media batches for the bulk operations, sized by localization count and upstream latency
+
+import math
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List
+
+import tator
+from app.conf import batch_target_localizations, batch_target_latency_s, batch_min_media, batch_max_media, \
+    batch_project_limits, media_page_size
+from app.logger import debug, info, err
+from app.ops.checkpoints import current_checkpoint, checkpointed
+from app.ops.metrics import BATCH_MEDIA
+from app.ops.models import ProjectSpec
+from app.ops.queries import sql_resolve_enabled, get_media_localization_counts
+from app.ops.utils import iter_media_ids
+
+# Starting number of media per batch, the fixed size used before batches were adaptive
+INITIAL_MEDIA = 100
+
+
+def is_overload(e: Exception) -> bool:
+    """
+    True if an upstream call failed with a 5xx, 429 or a timeout, i.e. a smaller batch may succeed
+    """
+    status = getattr(e, "status", None)
+    if isinstance(status, int) and (status >= 500 or status == 429):
+        return True
+    return isinstance(e, TimeoutError) or "timeout" in type(e).__name__.lower()
+
+
+class AdaptiveBatcher:
+    """
+    Chooses the number of media in each batch of a project. Batches are cut so they hold about target_localizations
+    localizations, using exact counts when known and otherwise the observed localizations per media. The media
+    limit grows while batches finish under target_latency_s, shrinks in proportion when they are slower and
+    is halved when a call fails with a 5xx or a timeout.
+    """
+
+    def __init__(self, project_name: str | None = None,
+                 target_localizations: int = batch_target_localizations,
+                 target_latency_s: float = batch_target_latency_s,
+                 min_media: int = batch_min_media,
+                 max_media: int = batch_max_media):
+        self.project_name = project_name
+        self.target_localizations = max(1, target_localizations)
+        self.target_latency_s = target_latency_s
+        self.min_media = max(1, min_media)
+        self.max_media = max(self.min_media, max_media)
+        self.size = min(max(INITIAL_MEDIA, self.min_media), self.max_media)
+        # Average localizations per media, None until the first batch is recorded
+        self.density: float | None = None
+        self._update_metric()
+
+    def _update_metric(self):
+        BATCH_MEDIA.labels(self.project_name or "").set(self.size)
+
+    def _set_size(self, size: float):
+        size = min(max(int(size), self.min_media), self.max_media)
+        if size != self.size:
+            debug("Batch size of %s changed from %d to %d media", self.project_name, self.size, size)
+            self.size = size
+            self._update_metric()
+
+    def cut(self, media_ids: List[int], counts: Dict[int, int] | None = None, final: bool = True) -> int:
+        """
+        Number of media from the start of media_ids to put in the next batch
+        :param media_ids: media ids waiting to be batched
+        :param counts: localizations by media id, if known. Media not in counts have none
+        :param final: True if no more media ids follow, otherwise 0 is returned if the batch is not yet full
+        :return: number of media in the next batch
+        """
+        per_media = self.density if self.density is not None else 0.
+        num_locs = 0.
+        for i, media_id in enumerate(media_ids):
+            n = counts.get(media_id, 0) if counts is not None else per_media
+            if i > 0 and (i >= self.size or num_locs + n > self.target_localizations):
+                return i
+            num_locs += n
+        return len(media_ids) if final else 0
+
+    def record(self, num_media: int, num_localizations: int, elapsed_s: float):
+        """
+        Record a successful upstream call for a batch
+        :param num_media: number of media in the batch
+        :param num_localizations: number of localizations fetched, modified or deleted
+        :param elapsed_s: duration of the call
+        """
+        if num_media > 0:
+            density = num_localizations / num_media
+            self.density = density if self.density is None else 0.7 * self.density + 0.3 * density
+        if elapsed_s > self.target_latency_s:
+            self._set_size(min(num_media, self.size) * self.target_latency_s / elapsed_s)
+        elif num_media >= self.size:
+            # Only grow when the batch was full, small batches say little about larger ones
+            self._set_size(math.ceil(self.size * 1.25))
+
+    def record_failure(self, e: Exception) -> bool:
+        """
+        Record a failed upstream call, halving the batch size if the failure suggests the batch was too large
+        :return: True if a smaller batch may succeed
+        """
+        if not is_overload(e):
+            return False
+        self._set_size(self.size // 2)
+        return True
+
+
+_batchers: Dict[str | None, AdaptiveBatcher] = {}
+
+
+def get_batcher(project_name: str | None) -> AdaptiveBatcher:
+    """
+    Adaptive batcher of a project, shared by the operations in this process so the learned size carries over.
+    Limits are read from batch_project_limits with the global settings as defaults.
+    """
+    batcher = _batchers.get(project_name)
+    if batcher is None:
+        limits = batch_project_limits.get(project_name, {}) if project_name else {}
+        batcher = AdaptiveBatcher(
+            project_name,
+            target_localizations=int(limits.get("target_localizations", batch_target_localizations)),
+            target_latency_s=float(limits.get("target_latency_s", batch_target_latency_s)),
+            min_media=int(limits.get("min_media", batch_min_media)),
+            max_media=int(limits.get("max_media", batch_max_media)),
+        )
+        _batchers[project_name] = batcher
+    return batcher
+
+
+async def iter_adaptive_media_batches(
+        api: tator.api,
+        spec: ProjectSpec,
+        batcher: AdaptiveBatcher,
+        count_localizations: bool = True,
+        position: Dict[str, Any] | None = None,
+        **kwargs
+) -> AsyncIterator[List[int]]:
+    """
+    Stream the media ids that match the filter in batches sized by the batcher at the time each batch is cut.
+    With count_localizations and direct database queries enabled, the localizations in each page of media are
+    counted first so batches are cut on exact counts. The counts include localizations the operation may filter out,
+    so leave it off when only a few localizations of each media are used, e.g. those of a cluster.
+    :param api: tator api
+    :param spec: project specifications
+    :param batcher: batcher that chooses the size of each batch
+    :param count_localizations: count the localizations of each media before cutting the batches
+    :param position: optional position to resume after, updated to the last media of each batch before it is yielded,
+    see iter_media_ids
+    :param kwargs: filter arguments to pass to iter_media_ids
+    :return: async iterator of lists of media ids
+    """
+    pending: List[int] = []
+    # Media type of each pending media id, to record the position of a batch
+    pending_types: List[int] = []
+    page_position = dict(position) if position is not None else None
+    counts: Dict[int, int] | None = {} if count_localizations and sql_resolve_enabled() else None
+
+    def take(n: int) -> List[int]:
+        nonlocal pending, pending_types
+        batch, pending = pending[:n], pending[n:]
+        if position is not None:
+            position.update(media_type=pending_types[n - 1], after=batch[-1])
+            pending_types = pending_types[n:]
+        if counts is not None:
+            for media_id in batch:
+                counts.pop(media_id, None)
+        return batch
+
+    async for page in iter_media_ids(api, spec, chunk_size=media_page_size, position=page_position, **kwargs):
+        if counts is not None:
+            try:
+                counts.update(await get_media_localization_counts(spec, page))
+            except Exception as e:
+                err(f"Failed to count localizations per media, batching on observed counts. Error: {e}")
+                counts = None
+        pending.extend(page)
+        if page_position is not None:
+            pending_types.extend([page_position["media_type"]] * len(page))
+        while n := batcher.cut(pending, counts, final=False):
+            yield take(n)
+
+    while pending:
+        yield take(batcher.cut(pending, counts))
+
+
+def resumable_media_batches(api: tator.api, spec: ProjectSpec, count_localizations: bool = True, **kwargs) -> AsyncIterator[List[int]]:
+    """
+    Adaptive media batches of the project that resume from and are recorded in the checkpoint of the current job, if any
+    :param api: tator api
+    :param spec: project specifications
+    :param count_localizations: count the localizations of each media before cutting the batches
+    :param kwargs: filter arguments to pass to iter_media_ids
+    :return: async iterator of lists of media ids
+    """
+    checkpoint = current_checkpoint.get()
+    position = checkpoint.begin("media") if checkpoint is not None else None
+    batches = iter_adaptive_media_batches(api, spec, get_batcher(spec.project_name), count_localizations, position, **kwargs)
+    return checkpointed(batches, "media", position, checkpoint) if checkpoint is not None else batches
+
+
+async def call_adaptive(
+        batcher: AdaptiveBatcher,
+        media_ids: List[int],
+        call: Callable[[List[int]], Awaitable[Any]],
+        count: Callable[[Any], int],
+) -> List[Any]:
+    """
+    Make an upstream call for a batch of media, recording its latency. If the call fails with a 5xx or a timeout
+    the batch is split in two and each half is retried, down to a single media.
+    :param batcher: batcher to record the calls in
+    :param media_ids: the batch of media ids
+    :param call: coroutine taking media ids that makes the upstream call
+    :param count: number of localizations in a result of the call
+    :return: the result of each call made, in media order
+    """
+    start = time.perf_counter()
+    try:
+        result = await call(media_ids)
+    except Exception as e:
+        if not batcher.record_failure(e) or len(media_ids) == 1:
+            raise
+        half = len(media_ids) // 2
+        info(f"Upstream call for {len(media_ids)} media failed, retrying as two batches. Error: {e}")
+        return [*await call_adaptive(batcher, media_ids[:half], call, count),
+                *await call_adaptive(batcher, media_ids[half:], call, count)]
+    batcher.record(len(media_ids), count(result), time.perf_counter() - start)
+    return [result]
@@ -0,0 +1,179 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/cache.py
+# Description: bounded LRU cache of label counts with a TTL, invalidated by the relabels and deletes of this service
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Tuple
+
+import redis
+import redis.asyncio as aioredis
+
+from app.conf import label_cache_size, label_cache_ttl_s, redis_url, job_queue_name
+from app.logger import debug, info, err
+
+# Channel that carries the ids of projects written to by queue workers
+WRITES_CHANNEL = f"{job_queue_name}:writes"
+
+
+class CachedValue(NamedTuple):
+    value: Any
+    age_s: float
+    etag: str | None
+
+
+def make_etag(value: Any) -> str:
+    """
+    Strong ETag of a JSON serializable value, derived from its content
+    """
+    digest = hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    True if an If-None-Match header matches an ETag, using the weak comparison of RFC 9110
+    """
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+
+class LabelCountCache:
+    """
+    Least recently used cache of label counts keyed by tuples that start with the project id, e.g.
+    (project_id, "cluster", version_id, attribute). Entries expire after ttl_s to pick up changes made
+    outside this service. Each project has a write generation that is bumped on invalidation so a load that
+    raced a write is not cached. Concurrent loads of the same key share one query. The ETag of each value is
+    computed once when it is loaded.
+    """
+
+    def __init__(self, max_entries: int = label_cache_size, ttl_s: float = label_cache_ttl_s):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict[tuple, Tuple[float, CachedValue]] = OrderedDict()
+        self._generations: Dict[int, int] = {}
+        self._loading: Dict[tuple, asyncio.Task] = {}
+
+    def generation(self, project_id: int) -> int:
+        return self._generations.get(project_id, 0)
+
+    def get(self, key: tuple) -> CachedValue | None:
+        """
+        Get a cached value
+        :param key: cache key, starting with the project id
+        :return: the value with its age in seconds and ETag, or None if not cached or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, cached = entry
+        age = time.monotonic() - created
+        if age > self.ttl_s:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return cached._replace(age_s=age)
+
+    def put(self, key: tuple, value: Any) -> CachedValue:
+        cached = CachedValue(value, 0., make_etag(value))
+        self._entries[key] = (time.monotonic(), cached)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return cached
+
+    def invalidate(self, project_id: int | None = None):
+        """
+        Drop the entries of a project, or all entries if no project is given
+        """
+        if project_id is None:
+            self._entries.clear()
+            for p in self._generations:
+                self._generations[p] += 1
+            return
+        for key in [k for k in self._entries if k[0] == project_id]:
+            del self._entries[key]
+        self._generations[project_id] = self.generation(project_id) + 1
+
+    async def _load(self, key: tuple, load: Callable[[], Awaitable[Any]]) -> CachedValue:
+        generation = self.generation(key[0])
+        value = await load()
+        if generation == self.generation(key[0]):
+            return self.put(key, value)
+        return CachedValue(value, 0., make_etag(value))
+
+    async def get_or_load(self, key: tuple, load: Callable[[], Awaitable[Any]]) -> CachedValue:
+        """
+        Get a cached value, loading it if it is not cached. Errors from load are raised and not cached.
+        :param key: cache key, starting with the project id
+        :param load: coroutine function that returns the value
+        :return: the value with its age in seconds and ETag
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, load))
+            self._loading[key] = task
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(task)
+
+
+label_cache = LabelCountCache()
+
+_publisher: redis.Redis | None = None
+
+
+def _shared_redis() -> bool:
+    return bool(redis_url) and not redis_url.startswith("fakeredis://")
+
+
+async def notify_write(project_id: int):
+    """
+    Invalidate the cached label counts of a project after modifying or deleting its localizations.
+    Queue workers also publish the project id so the web process drops its entries, see listen_for_writes.
+    :param project_id: the project id
+    """
+    global _publisher
+    label_cache.invalidate(project_id)
+    if not _shared_redis():
+        return
+    try:
+        if _publisher is None:
+            _publisher = redis.Redis.from_url(redis_url)
+        await asyncio.to_thread(_publisher.publish, WRITES_CHANNEL, project_id)
+    except redis.RedisError as e:
+        err(f"Failed to publish a write to project {project_id}. Error: {e}")
+
+
+async def listen_for_writes(retry_s: float = 5.):
+    """
+    Invalidate the cached label counts of the projects written to by queue workers.
+    Runs until cancelled. All entries are dropped after a lost connection as writes may have been missed.
+    """
+    if not _shared_redis():
+        return
+    while True:
+        try:
+            client = aioredis.Redis.from_url(redis_url)
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(WRITES_CHANNEL)
+                info(f"Listening for writes on {WRITES_CHANNEL}")
+                label_cache.invalidate()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        debug("Write to project %s, invalidating label counts", message['data'])
+                        label_cache.invalidate(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            err(f"Lost the connection to {WRITES_CHANNEL}, retrying in {retry_s} s. Error: {e}")
+            label_cache.invalidate()
+            await asyncio.sleep(retry_s)
@@ -0,0 +1,227 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/checkpoints.py
+# Description: progress cursors of bulk jobs kept in a local sqlite database so interrupted jobs resume where they stopped
+
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterator, List, Tuple
+
+from app.conf import checkpoint_db, job_result_ttl_s
+from app.logger import info, err
+
+# Job states in the store. Jobs left running by a crash or interrupted by a shutdown are resumed on startup
+RUNNING = "running"
+INTERRUPTED = "interrupted"
+DONE = "done"
+FAILED = "failed"
+
+_drain = threading.Event()
+
+
+class JobInterrupted(BaseException):
+    """
+    Raised by a bulk operation that stopped after its in-flight batches because a shutdown was requested.
+    A BaseException so the broad exception handlers of the operations do not swallow it.
+    """
+
+
+def request_drain():
+    """
+    Ask running bulk operations to finish their in-flight batches, checkpoint and stop. Safe to call from a signal handler.
+    """
+    _drain.set()
+
+
+def drain_requested() -> bool:
+    return _drain.is_set()
+
+
+class CheckpointStore:
+    """
+    sqlite table of jobs with their payload, the cursor to resume from and the number of batches done
+    """
+
+    def __init__(self, path: str | Path = checkpoint_db):
+        self.path = Path(path)
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    cursor TEXT,
+                    batch_index INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, query: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute(query, params).fetchall()
+
+    def start(self, job_id: str, payload: Dict[str, Any]) -> Tuple[Dict[str, Any] | None, int]:
+        """
+        Record a job as running, keeping the cursor of an earlier run of the same job
+        :return: the cursor to resume from, or None to start from the beginning, and the number of batches done
+        """
+        self._execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, time.time() - job_result_ttl_s))
+        rows = self._execute("SELECT cursor, batch_index FROM jobs WHERE job_id = ?", (job_id,))
+        if rows:
+            self._execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?", (RUNNING, time.time(), job_id))
+            cursor, batch_index = rows[0]
+            return (json.loads(cursor) if cursor else None), batch_index
+        self._execute("INSERT INTO jobs (job_id, payload, status, updated_at) VALUES (?, ?, ?, ?)",
+                      (job_id, json.dumps(payload), RUNNING, time.time()))
+        return None, 0
+
+    def save(self, job_id: str, cursor: Dict[str, Any] | None, batch_index: int):
+        self._execute("UPDATE jobs SET cursor = ?, batch_index = ?, updated_at = ? WHERE job_id = ?",
+                      (json.dumps(cursor) if cursor else None, batch_index, time.time(), job_id))
+
+    def finish(self, job_id: str, status: str):
+        self._execute("UPDATE jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id))
+
+    def unfinished(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        The jobs that were running or interrupted, oldest first
+        :return: list of (job id, payload)
+        """
+        rows = self._execute("SELECT job_id, payload FROM jobs WHERE status IN (?, ?) ORDER BY updated_at", (RUNNING, INTERRUPTED))
+        return [(job_id, json.loads(payload)) for job_id, payload in rows]
+
+
+store = CheckpointStore()
+
+
+class Checkpoint:
+    """
+    Progress of one job. Each scan of the job issues batches in order with the position to resume after once the
+    batch is done. Batches finish out of order, so the cursor only advances past batches done in an unbroken run.
+    Failed batches are never done, so the cursor stays before them and a resumed job retries them.
+    """
+
+    def __init__(self, job_id: str, cursor: Dict[str, Any] | None = None, batch_index: int = 0, store: CheckpointStore = store):
+        self.job_id = job_id
+        self.cursor = cursor
+        self.batch_index = batch_index
+        self.store = store
+        self._issued: Dict[int, Dict[str, Any] | None] = {}
+        self._done = set()
+        self._next = 0
+        self._num_issued = 0
+
+    def begin(self, scan: str) -> Dict[str, Any]:
+        """
+        Start a scan over media or localizations
+        :param scan: name of the scan, e.g. media or localizations. A cursor saved by a different scan is not used
+        :return: position to resume the scan from, empty to start from the beginning. Updated by the scan as it goes
+        """
+        self._issued.clear()
+        self._done.clear()
+        self._next = 0
+        self._num_issued = 0
+        if self.cursor and self.cursor.get("scan") == scan:
+            info(f"Resuming job {self.job_id} after {self.cursor} with {self.batch_index} batches done")
+            return {k: v for k, v in self.cursor.items() if k != "scan"}
+        self.cursor = None
+        return {}
+
+    def issue(self, scan: str, position: Dict[str, Any] | None):
+        """
+        Record the next batch of a scan
+        :param scan: name of the scan
+        :param position: position to resume after once this and all earlier batches are done, or None if the batch
+        does not end at a position the scan can resume from
+        """
+        self._issued[self._num_issued] = {"scan": scan, **position} if position else None
+        self._num_issued += 1
+
+    def done(self, index: int):
+        """
+        Record a batch as done once it succeeded, saving the cursor if it advanced
+        :param index: index of the batch in the order issued
+        """
+        self._done.add(index)
+        advanced = False
+        while self._next in self._done:
+            self._done.discard(self._next)
+            position = self._issued.pop(self._next)
+            if position is not None:
+                self.cursor = position
+            self._next += 1
+            self.batch_index += 1
+            advanced = True
+        if advanced:
+            try:
+                self.store.save(self.job_id, self.cursor, self.batch_index)
+            except sqlite3.Error as e:
+                err(f"Failed to checkpoint job {self.job_id}. Error: {e}")
+
+
+# Checkpoint of the job running the current bulk operation, or None when an operation is run directly
+current_checkpoint: ContextVar[Checkpoint | None] = ContextVar("current_checkpoint", default=None)
+
+
+async def checkpointed(batches: AsyncIterable[Any], scan: str, position: Dict[str, Any],
+                       checkpoint: Checkpoint | None) -> AsyncIterator[Any]:
+    """
+    Issue each batch of a scan to the checkpoint with the position the scan set before yielding it
+    :param batches: batches of the scan
+    :param scan: name of the scan
+    :param position: position updated by the scan, see Checkpoint.begin
+    :param checkpoint: the checkpoint, or None to pass the batches through
+    """
+    async for batch in batches:
+        if checkpoint is not None:
+            checkpoint.issue(scan, dict(position))
+        yield batch
+
+
+@contextmanager
+def job_checkpoint(job_id: str | None, payload: Dict[str, Any]) -> Iterator[Checkpoint | None]:
+    """
+    Track the progress of a job for the operation run inside the block, see current_checkpoint
+    :param job_id: the job id, or None to run without a checkpoint
+    :param payload: the job payload, kept to resubmit the job if it does not finish
+    """
+    if job_id is None:
+        yield None
+        return
+
+    try:
+        cursor, batch_index = store.start(job_id, payload)
+    except sqlite3.Error as e:
+        err(f"Failed to open the checkpoint of job {job_id}, running it without one. Error: {e}")
+        yield None
+        return
+
+    checkpoint = Checkpoint(job_id, cursor, batch_index)
+    token = current_checkpoint.set(checkpoint)
+    try:
+        yield checkpoint
+        store.finish(job_id, DONE)
+    except JobInterrupted:
+        info(f"Job {job_id} interrupted after {checkpoint.batch_index} batches, it resumes after {checkpoint.cursor} on restart")
+        store.finish(job_id, INTERRUPTED)
+        raise
+    except Exception:
+        store.finish(job_id, FAILED)
+        raise
+    finally:
+        current_checkpoint.reset(token)
@@ -0,0 +1,151 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/db.py
+# Description: shared async connection pool for direct queries against the tator database
+
+import time
+from typing import Any, AsyncIterator, List, Sequence
+
+from psycopg_pool import AsyncConnectionPool
+
+from app.conf import db_name, db_user, db_password, db_host, db_port, db_pool_min_size, db_pool_max_size, \
+    db_pool_timeout_s, db_statement_timeout_ms
+from app.logger import info
+from app.ops.metrics import DB_QUERY_DURATION
+from app.ops.tracing import record_call
+
+_pool: AsyncConnectionPool | None = None
+
+
+async def open_db_pool() -> AsyncConnectionPool:
+    """
+    Open the shared connection pool. Connections are established in the background so a database
+    that is not reachable at startup does not block the application from starting.
+    :return: The connection pool
+    """
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    info(f"Opening database pool to {db_host}:{db_port}/{db_name} "
+         f"min {db_pool_min_size} max {db_pool_max_size} statement timeout {db_statement_timeout_ms} ms")
+    _pool = AsyncConnectionPool(
+        min_size=db_pool_min_size,
+        max_size=db_pool_max_size,
+        kwargs={
+            "dbname": db_name,
+            "user": db_user,
+            "password": db_password,
+            "host": db_host,
+            "port": db_port,
+            "options": f"-c statement_timeout={db_statement_timeout_ms}",
+            "autocommit": True,
+        },
+        timeout=db_pool_timeout_s,
+        name="tator-db",
+        open=False,
+    )
+    await _pool.open(wait=False)
+    return _pool
+
+
+async def close_db_pool():
+    """
+    Close the shared connection pool, waiting for connections in use to be returned
+    """
+    global _pool
+    if _pool is None:
+        return
+    info("Closing database pool")
+    await _pool.close()
+    _pool = None
+
+
+def get_db_pool() -> AsyncConnectionPool:
+    """
+    Get the shared connection pool. Raises a RuntimeError if the pool has not been opened.
+    """
+    if _pool is None:
+        raise RuntimeError("Database pool is not open")
+    return _pool
+
+
+async def fetch_all(query: str, params: Sequence[Any] = (), timeout_ms: int | None = None, name: str = "query",
+                    project: Any = None) -> List[tuple]:
+    """
+    Run a query as a prepared statement on a pooled connection and return all rows
+    :param query: SQL query with %s placeholders
+    :param params: query parameters
+    :param timeout_ms: optional statement timeout in milliseconds overriding the pool default
+    :param name: name of the query for the query duration metrics
+    :param project: optional project id the query is for, for tracing
+    :return: list of rows
+    """
+    pool = get_db_pool()
+    start = time.perf_counter()
+    rows = None
+    try:
+        with DB_QUERY_DURATION.labels(name).time():
+            async with pool.connection() as conn:
+                if timeout_ms is None:
+                    cur = await conn.execute(query, params, prepare=True)
+                    rows = await cur.fetchall()
+                else:
+                    async with conn.transaction():
+                        await conn.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+                        cur = await conn.execute(query, params, prepare=True)
+                        rows = await cur.fetchall()
+        return rows
+    finally:
+        record_call("db", name, start, project, rows, error=rows is None)
+
+
+async def fetch_one(query: str, params: Sequence[Any] = (), timeout_ms: int | None = None, name: str = "query",
+                    project: Any = None) -> tuple | None:
+    """
+    Run a query as a prepared statement on a pooled connection and return the first row
+    :param query: SQL query with %s placeholders
+    :param params: query parameters
+    :param timeout_ms: optional statement timeout in milliseconds overriding the pool default
+    :param name: name of the query for the query duration metrics
+    :param project: optional project id the query is for, for tracing
+    :return: the first row or None if no rows were returned
+    """
+    rows = await fetch_all(query, params, timeout_ms, name, project)
+    return rows[0] if rows else None
+
+
+async def stream_rows(query: str, params: Sequence[Any] = (), fetch_size: int = 1000, timeout_ms: int | None = None,
+                      name: str = "query", project: Any = None) -> AsyncIterator[tuple]:
+    """
+    Stream the rows of a query through a server-side cursor, holding at most fetch_size rows in memory.
+    The pooled connection is returned when the iteration ends or is abandoned.
+    :param query: SQL query with %s placeholders
+    :param params: query parameters
+    :param fetch_size: number of rows fetched from the server at a time
+    :param timeout_ms: optional statement timeout in milliseconds overriding the pool default
+    :param name: name of the query, used for the cursor name
+    :param project: optional project id the query is for, for tracing
+    :return: async iterator of rows
+    """
+    pool = get_db_pool()
+    start = time.perf_counter()
+    count = 0
+    error = False
+    try:
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                if timeout_ms is not None:
+                    await conn.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+                async with conn.cursor(name=f"fastapi_tator_{name}") as cur:
+                    cur.itersize = fetch_size
+                    with DB_QUERY_DURATION.labels(name).time():
+                        await cur.execute(query, params)
+                    async for row in cur:
+                        count += 1
+                        yield row
+    except Exception:
+        error = True
+        raise
+    finally:
+        # The span covers the whole iteration, including the time the consumer spent between rows
+        record_call("db", name, start, project, count, error)
@@ -0,0 +1,111 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/dedup.py
+# Description: idempotency keys that attach repeated bulk requests to the job already running them
+
+import hashlib
+import json
+from typing import Any, Callable
+
+import redis
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+from app.conf import job_queue_name, job_timeout_s, job_dedup_window_s
+from app.logger import info, err
+
+# Jobs a repeated request attaches to. Finished jobs only count until their key expires, see release_job_key
+ATTACHABLE = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED, JobStatus.FINISHED)
+# Statuses of jobs interrupted by a shutdown, which stay attachable until they are resumed, see redis_process.resume_jobs
+INTERRUPTED = (JobStatus.FAILED, JobStatus.STOPPED)
+
+
+def job_key(payload: dict) -> str:
+    """
+    Idempotency key of a job, the same for requests with the same operation, label, filters, project and version
+    :param payload: the job payload with the request model as a dictionary
+    :return: the Redis key
+    """
+    normalized = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return f"{job_queue_name}:dedup:{hashlib.sha256(normalized.encode()).hexdigest()}"
+
+
+def _if_owner(conn: redis.Redis, key: str, job_id: str, action: Callable[[redis.client.Pipeline], None]):
+    """
+    Run action in a transaction if key still holds job_id
+    """
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            value = pipe.get(key)
+            if value is None or value.decode() != job_id:
+                return
+            pipe.multi()
+            action(pipe)
+            pipe.execute()
+        except redis.WatchError:
+            pass
+
+
+def claim_job_key(conn: redis.Redis, key: str, job_id: str) -> str | None:
+    """
+    Claim an idempotency key for a new job. SET NX makes the claim atomic across processes and replicas.
+    A key held by a job that failed, was stopped or expired from Redis is taken over, unless the job was interrupted
+    by a shutdown and waits to be resumed.
+    :param conn: Redis connection of the job queue
+    :param key: the idempotency key
+    :param job_id: id of the new job
+    :return: id of the job to attach to instead, or None if the new job should run
+    """
+    if job_dedup_window_s <= 0:
+        return None
+    try:
+        for _ in range(3):
+            if conn.set(key, job_id, nx=True, ex=job_timeout_s + job_dedup_window_s):
+                return None
+            existing = conn.get(key)
+            if existing is None:
+                continue
+            existing = existing.decode()
+            try:
+                job = Job.fetch(existing, connection=conn)
+                status = job.get_status()
+            except NoSuchJobError:
+                job, status = None, None
+            if status in ATTACHABLE or (status in INTERRUPTED and job.meta.get("interrupted")):
+                info(f"Attaching to job {existing} with the same request, status {status.value}")
+                return existing
+            _if_owner(conn, key, existing, lambda pipe: pipe.delete(key))
+    except redis.RedisError as e:
+        err(f"Failed to check for a duplicate job, starting a new one. Error: {e}")
+    return None
+
+
+def _succeeded(job: Job, summary: Any) -> bool:
+    """
+    True if a finished job recorded no errors and none of its batches failed
+    """
+    if job.meta.get("errors"):
+        return False
+    if isinstance(summary, dict):
+        return not summary.get("failed")
+    return not getattr(summary, "failed", 0)
+
+
+def release_job_key(job: Job, finished: bool, summary: Any = None):
+    """
+    Keep the idempotency key of a job that succeeded for job_dedup_window_s seconds so quick retries attach to it,
+    or drop it right away if the job did not finish, recorded errors or had failed batches so a retry starts over
+    :param job: the job
+    :param finished: True if the job finished without raising
+    :param summary: the summary the job returned, if any
+    """
+    key = job.meta.get("dedup_key")
+    if not key:
+        return
+    try:
+        if finished and _succeeded(job, summary):
+            _if_owner(job.connection, key, job.id, lambda pipe: pipe.expire(key, job_dedup_window_s))
+        else:
+            _if_owner(job.connection, key, job.id, lambda pipe: pipe.delete(key))
+    except redis.RedisError as e:
+        err(f"Failed to release the idempotency key of job {job.id}. Error: {e}")
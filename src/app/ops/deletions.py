@@ -2,16 +2,32 @@
 # Filename: app/ops/deletions.py
 # Description: operations that delete data the database
 
-from typing import Any
+import re
+from typing import Any, List
 
 import tator
 from app.logger import info, debug, exception
-from app.ops.utils import get_media_ids, prepare_media_kwargs
+from app.ops.batching import get_batcher, resumable_media_batches, call_adaptive
+from app.ops.checkpoints import current_checkpoint, drain_requested, JobInterrupted
+from app.ops.cache import notify_write
+from app.ops.executor import run_sdk
+from app.ops.metrics import LOCALIZATIONS
+from app.ops.progress import report_progress
+from app.ops.utils import prepare_media_kwargs
 from app.ops.models import (
     MediaIdFilterModel,
     ProjectSpec,
 )
 
+
+def _deleted_count(response: Any) -> int:
+    """
+    Number of localizations deleted from the message of a bulk delete response, e.g. "Successfully deleted 10 localizations!"
+    """
+    match = re.search(r"(\d+)", getattr(response, "message", None) or "")
+    return int(match.group(1)) if match else 0
+
+
 async def del_media_id(model: MediaIdFilterModel, api: tator.api, spec: ProjectSpec, **kwargs):
     """
     Delete all localizations for a given media id
@@ -21,13 +37,70 @@ async def del_media_id(model: MediaIdFilterModel, api: tator.api, spec: ProjectS
     """
     try:
         info(f"Fetching localizations for media {model.media_id}  ...")
-        localizations = api.get_localization_list(project=spec.project_id, type=spec.box_type, media_id=[model.media_id])
+        localizations = await run_sdk(api.get_localization_list, project=spec.project_id, type=spec.box_type, media_id=[model.media_id])
 
         info(f"Deleting {len(localizations)} localizations for media {model.media_id}")
-        api.delete_localization_list(project=spec.project_id, media_id=[model.media_id], **kwargs)
+        deleted = await run_sdk(api.delete_localization_list, project=spec.project_id, media_id=[model.media_id], **kwargs)
+        await notify_write(spec.project_id)
+        LOCALIZATIONS.labels("del_media_id", spec.project_name, "deleted").inc(_deleted_count(deleted))
         info(f'Done. Deleted localizations for media {model.media_id} in project {spec.project_name}')
+        report_progress(media=1)
     except Exception as e:
         exception(f"Failed to delete localizations for media {model.media_id}. Error: {e}")
+        report_progress(error=f"Failed to delete localizations for media {model.media_id}. Error: {e}")
+        raise
+
+async def _del_locs_in_media(model: Any, spec: ProjectSpec, api: tator.api, media_kwargs: dict, operation: str, **kwargs):
+    """
+    Delete localizations in batches of media sized by the adaptive batcher of the project, starting as soon as the
+    first batch of matching media ids arrives
+    :param model:  data model with media criteria for deletions
+    :param spec:  project specifications
+    :param api: tator api
+    :param media_kwargs: filter arguments to select the media
+    :param operation: name of the operation for the metrics
+    :param kwargs: filter arguments to select the localizations to delete in the media
+    """
+    batcher = get_batcher(spec.project_name)
+
+    async def delete(media_ids: List[int]) -> Any:
+        # https://www.tator.io/docs/references/tator-py/api
+        deleted = await run_sdk(
+            api.delete_localization_list,
+            project=spec.project_id,
+            media_id=media_ids,
+            **kwargs
+        )
+        debug("%s", deleted)
+        await notify_write(spec.project_id)
+        LOCALIZATIONS.labels(operation, spec.project_name, "deleted").inc(_deleted_count(deleted))
+        return deleted
+
+    checkpoint = current_checkpoint.get()
+    num_media = 0
+    index = 0
+    async for media_ids in resumable_media_batches(api, spec, **media_kwargs):
+        if checkpoint is not None and drain_requested():
+            info(f"Stopped deleting localizations after {num_media} media for a shutdown")
+            raise JobInterrupted(operation)
+        if hasattr(model, "media_name"):
+            info("Deleting localizations for media %s %d to %d  ...", model.media_name, num_media, num_media + len(media_ids))
+        else:
+            info("Deleting localizations for media %d to %d  ...", num_media, num_media + len(media_ids))
+        debug("%s", kwargs)
+        await call_adaptive(batcher, media_ids, delete, _deleted_count)
+        num_media += len(media_ids)
+        report_progress(media=len(media_ids), batches=1)
+        if checkpoint is not None:
+            checkpoint.done(index)
+        index += 1
+        info("Done. Deleted localizations for media %s in project %s", media_ids, spec.project_name)
+
+    if num_media == 0:
+        info(f"No media found with {media_kwargs}")
+    else:
+        debug("Deleted localizations in %s medias with %s", num_media, media_kwargs)
+
 
 async def del_locs_filename(model: Any, spec: ProjectSpec, api: tator.api, allow_empty_media: bool=False, **kwargs):
     """
@@ -40,31 +113,11 @@ async def del_locs_filename(model: Any, spec: ProjectSpec, api: tator.api, allow
     """
     try:
         media_kwargs = prepare_media_kwargs(model, allow_empty_media)
-        media_ids = await get_media_ids(api, spec, **media_kwargs)
-        debug(f"Found {len(media_ids)} medias with {media_kwargs}...")
-
-        if len(media_ids) == 0:
-            info(f"No media found with {media_kwargs}")
-            return
-
-        # Fetch localizations for media 100 at a time
-        batch_size = min(100, len(media_ids))
-        for i in range(0, len(media_ids), batch_size):
-            if hasattr(model, "media_name"):
-                info(f"Deleting localizations for media {model.media_name} {i} to {i+batch_size}  ...")
-            else:
-                info(f"Deleting localizations for media {i} to {i+batch_size}  ...")
-            info(kwargs)
-            # https://www.tator.io/docs/references/tator-py/api
-            deleted = api.delete_localization_list(
-                project=spec.project_id,
-                media_id=media_ids[i: i + batch_size],
-                **kwargs
-            )
-            debug(deleted)
-            info(f'Done. Deleted localizations for media {media_ids[i: i + batch_size]} in project {spec.project_name}')
+        await _del_locs_in_media(model, spec, api, media_kwargs, "del_locs_filename", **kwargs)
     except Exception as e:
-        exception(f"Failed to delete localizations for media {model.media_name}. Error: {e}")
+        exception(f"Failed to delete localizations for media {getattr(model, 'media_name', None)}. Error: {e}")
+        report_progress(error=f"Failed to delete localizations for media {getattr(model, 'media_name', None)}. Error: {e}")
+        raise
 
 
 async def del_locs_by_filter(model: Any, spec: ProjectSpec, api: tator.api, allow_empty_media: bool=False, **kwargs):
@@ -81,28 +134,8 @@ async def del_locs_by_filter(model: Any, spec: ProjectSpec, api: tator.api, allo
         for key, value in kwargs.items():
             media_kwargs["related_"+key] = value
         media_kwargs.update(kwargs)
-        media_ids = await get_media_ids(api, spec, **media_kwargs)
-        debug(f"Found {len(media_ids)} medias with {media_kwargs}...")
-
-        if len(media_ids) == 0:
-            info(f"No media found with {media_kwargs}")
-            return
-
-        # Fetch localizations for media 100 at a time
-        batch_size = min(100, len(media_ids))
-        for i in range(0, len(media_ids), batch_size):
-            if hasattr(model, "media_name"):
-                info(f"Deleting localizations for media {model.media_name} {i} to {i+batch_size}  ...")
-            else:
-                info(f"Deleting localizations for media {i} to {i+batch_size}  ...")
-            info(kwargs)
-            # https://www.tator.io/docs/references/tator-py/api
-            deleted = api.delete_localization_list(
-                project=spec.project_id,
-                media_id=media_ids[i: i + batch_size],
-                **kwargs
-            )
-            debug(deleted)
-            info(f'Done. Deleted localizations for media {media_ids[i: i + batch_size]} in project {spec.project_name}')
+        await _del_locs_in_media(model, spec, api, media_kwargs, "del_locs_by_filter", **kwargs)
     except Exception as e:
-        exception(f"Failed to delete localizations for media {model.media_name}. Error: {e}")
\ No newline at end of file
+        exception(f"Failed to delete localizations for media {getattr(model, 'media_name', None)}. Error: {e}")
+        report_progress(error=f"Failed to delete localizations for media {getattr(model, 'media_name', None)}. Error: {e}")
+        raise
@@ -0,0 +1,83 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/executor.py
+# Description: runs blocking tator SDK calls on a dedicated thread pool so they do not stall the event loop
+
+import asyncio
+import functools
+import inspect
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from app.conf import sdk_threads, sdk_max_concurrency, sdk_project_concurrency, sdk_interactive_reserved, \
+    tator_async_client, tator_pool_size, tator_project_concurrency
+from app.logger import info
+from app.ops.metrics import SDK_CALL_DURATION, SDK_CALL_ERRORS
+from app.ops.scheduler import FairScheduler
+from app.ops.tracing import record_call
+
+_executor: ThreadPoolExecutor | None = None
+# One scheduler per event loop, as the queue worker runs each job on a new loop
+_schedulers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        info(f"Starting tator SDK thread pool with {sdk_threads} threads and at most {sdk_max_concurrency} concurrent calls")
+        _executor = ThreadPoolExecutor(max_workers=sdk_threads, thread_name_prefix="tator-sdk")
+    return _executor
+
+
+def get_scheduler() -> FairScheduler:
+    loop = asyncio.get_running_loop()
+    if loop not in _schedulers:
+        # The async client makes calls without threads, so its connection pool bounds the calls in flight
+        if tator_async_client:
+            _schedulers[loop] = FairScheduler(tator_pool_size, tator_project_concurrency, sdk_interactive_reserved)
+        else:
+            _schedulers[loop] = FairScheduler(sdk_max_concurrency, sdk_project_concurrency, sdk_interactive_reserved)
+    return _schedulers[loop]
+
+
+async def run_sdk(fn: Callable, *args, **kwargs) -> Any:
+    """
+    Run a tator SDK call off the event loop, waiting for a free slot if sdk_max_concurrency calls are in flight.
+    Slots are handed out fairly between projects, by the project argument of the call, and to interactive requests
+    before bulk jobs, see app/ops/scheduler.py. Coroutine functions, i.e. the methods of tator_client.AsyncTatorClient,
+    are awaited directly. The call is timed in the trace of the current request or job, see app/ops/tracing.py
+    :param fn: SDK method, e.g. api.get_media_count
+    :param args: positional arguments for the call
+    :param kwargs: keyword arguments for the call
+    :return: the result of the call
+    """
+    method = getattr(fn, "__name__", "unknown")
+    async with get_scheduler().slot(str(kwargs.get("project", ""))):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        result = None
+        error = False
+        try:
+            if inspect.iscoroutinefunction(fn):
+                result = await fn(*args, **kwargs)
+            else:
+                result = await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+            return result
+        except Exception:
+            SDK_CALL_ERRORS.labels(method).inc()
+            error = True
+            raise
+        finally:
+            SDK_CALL_DURATION.labels(method).observe(time.perf_counter() - start)
+            record_call("sdk", method, start, kwargs.get("project"), result, error)
+
+
+def shutdown_executor():
+    """
+    Stop the thread pool, waiting for calls in flight to finish
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,238 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/export.py
+# Description: streaming exports of localizations for training as NDJSON, COCO JSON or a YOLO zip
+
+import asyncio
+import io
+import json
+import os
+import zipfile
+from typing import Any, AsyncIterator, Callable, Dict
+
+from app.conf import export_fetch_size, export_concurrency
+from app.ops.models import ExportFormat, ProjectSpec
+from app.ops.queries import get_export_labels, iter_export_images, iter_export_localizations
+
+# Minimum size of the chunks written to the response by the YOLO export
+ZIP_CHUNK_SIZE = 256 * 1024
+
+MEDIA_TYPES = {
+    ExportFormat.NDJSON: "application/x-ndjson",
+    ExportFormat.COCO: "application/json",
+    ExportFormat.YOLO: "application/zip",
+}
+
+EXTENSIONS = {
+    ExportFormat.NDJSON: "ndjson",
+    ExportFormat.COCO: "json",
+    ExportFormat.YOLO: "zip",
+}
+
+
+# Exports being streamed, so slow downloads do not take all the pooled database connections
+_export_slots = asyncio.Semaphore(export_concurrency)
+
+
+class _ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable file that collects the bytes written by a ZipFile until they are drained
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self.size += len(b)
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def _is_video(spec: ProjectSpec, media_type: int) -> bool:
+    return spec.video_type is not None and media_type == spec.video_type
+
+
+def _image_id(spec: ProjectSpec, media_id: int, frame: int, media_type: int) -> int:
+    """
+    COCO image id, the media id for images and media id * 1000000 + frame for video frames
+    """
+    return media_id * 1000000 + (frame or 0) if _is_video(spec, media_type) else media_id
+
+
+def _frame_name(spec: ProjectSpec, media_id: int, media_name: str, frame: int, media_type: int) -> str:
+    """
+    Name of the image of a media frame without extension, prefixed by the media id so media with the same name
+    in different folders do not collide, e.g. 12_image01 or 34_video01_000100
+    """
+    stem = os.path.splitext(os.path.basename(media_name))[0]
+    return f"{media_id}_{stem}_{frame or 0:06d}" if _is_video(spec, media_type) else f"{media_id}_{stem}"
+
+
+async def _json_lines(records: AsyncIterator[Dict[str, Any]], separator: str) -> AsyncIterator[bytes]:
+    """
+    Serialize records to JSON joined by a separator, export_fetch_size records per chunk
+    """
+    batch = []
+    first = True
+    async for record in records:
+        batch.append(json.dumps(record, default=str))
+        if len(batch) >= export_fetch_size:
+            yield (("" if first else separator) + separator.join(batch)).encode()
+            batch.clear()
+            first = False
+    if batch:
+        yield (("" if first else separator) + separator.join(batch)).encode()
+
+
+async def export_ndjson(spec: ProjectSpec, **filters) -> AsyncIterator[bytes]:
+    """
+    Stream one JSON object per localization, with the box in coordinates normalized to the media size
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters
+    :return: async iterator of NDJSON chunks
+    """
+    async def records():
+        async for loc_id, media_id, frame, media_name, _, media_width, media_height, x, y, w, h, attributes \
+                in iter_export_localizations(spec, **filters):
+            yield {
+                "id": loc_id,
+                "media_id": media_id,
+                "media_name": media_name,
+                "frame": frame,
+                "media_width": media_width,
+                "media_height": media_height,
+                "label": attributes.get("Label"),
+                "x": x,
+                "y": y,
+                "width": w,
+                "height": h,
+                "attributes": attributes,
+            }
+
+    empty = True
+    async for chunk in _json_lines(records(), "\n"):
+        empty = False
+        yield chunk
+    if not empty:
+        yield b"\n"
+
+
+async def export_coco(spec: ProjectSpec, **filters) -> AsyncIterator[bytes]:
+    """
+    Stream a COCO JSON document with the boxes in pixels. The images and the annotations are read in
+    separate passes so neither is held in memory.
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters
+    :return: async iterator of JSON chunks
+    """
+    labels = await get_export_labels(spec, **filters)
+    categories = {label: i + 1 for i, label in enumerate(labels)}
+
+    async def images():
+        async for media_id, frame, media_name, media_type, width, height in iter_export_images(spec, **filters):
+            yield {
+                "id": _image_id(spec, media_id, frame, media_type),
+                "file_name": media_name if not _is_video(spec, media_type) else _frame_name(spec, media_id, media_name, frame, media_type),
+                "width": width,
+                "height": height,
+                "media_id": media_id,
+                "frame": frame,
+            }
+
+    async def annotations():
+        async for loc_id, media_id, frame, _, media_type, media_width, media_height, x, y, w, h, attributes \
+                in iter_export_localizations(spec, **filters):
+            # Boxes stay normalized if the media size is unknown
+            sx, sy = media_width or 1, media_height or 1
+            yield {
+                "id": loc_id,
+                "image_id": _image_id(spec, media_id, frame, media_type),
+                "category_id": categories.get(attributes.get("Label")),
+                "bbox": [x * sx, y * sy, w * sx, h * sy],
+                "area": w * sx * h * sy,
+                "iscrowd": 0,
+                "score": attributes.get("score"),
+            }
+
+    yield b'{"images": ['
+    async for chunk in _json_lines(images(), ", "):
+        yield chunk
+    yield b'], "categories": '
+    yield json.dumps([{"id": i, "name": label} for label, i in categories.items()]).encode()
+    yield b', "annotations": ['
+    async for chunk in _json_lines(annotations(), ", "):
+        yield chunk
+    yield b']}'
+
+
+async def export_yolo(spec: ProjectSpec, **filters) -> AsyncIterator[bytes]:
+    """
+    Stream a zip of YOLO label files, one per image or video frame under labels/, and classes.txt with the
+    class names in class id order. Label files are named after the media id and name, see _frame_name, as are
+    video frames in the COCO export. Localizations are read ordered by media so each file is written once.
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters
+    :return: async iterator of zip chunks
+    """
+    labels = await get_export_labels(spec, **filters)
+    classes = {label: i for i, label in enumerate(labels)}
+    stream = _ZipStream()
+
+    with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("classes.txt", "".join(f"{label}\n" for label in labels))
+        current, name, lines = None, None, []
+        async for _, media_id, frame, media_name, media_type, _, _, x, y, w, h, attributes \
+                in iter_export_localizations(spec, by_media=True, **filters):
+            if (media_id, frame) != current:
+                if lines:
+                    zf.writestr(f"labels/{name}.txt", "".join(lines))
+                    lines.clear()
+                    if stream.size >= ZIP_CHUNK_SIZE:
+                        yield stream.drain()
+                current = (media_id, frame)
+                name = _frame_name(spec, media_id, media_name, frame, media_type)
+            class_id = classes.get(attributes.get("Label"))
+            if class_id is None:
+                # Labeled after the classes were read
+                continue
+            lines.append(f"{class_id} {x + w / 2:.6f} {y + h / 2:.6f} {w:.6f} {h:.6f}\n")
+        if lines:
+            zf.writestr(f"labels/{name}.txt", "".join(lines))
+
+    yield stream.drain()
+
+
+def export_slot_available() -> bool:
+    """
+    True if another export can start streaming right away, see export_concurrency
+    """
+    return not _export_slots.locked()
+
+
+async def stream_export(exporter: Callable[..., AsyncIterator[bytes]], spec: ProjectSpec, **filters) -> AsyncIterator[bytes]:
+    """
+    Run an exporter while holding one of the export slots, waiting for a slot first if they are all taken
+    :param exporter: one of EXPORTERS
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters
+    :return: async iterator of the exporter's chunks
+    """
+    async with _export_slots:
+        async for chunk in exporter(spec, **filters):
+            yield chunk
+
+
+EXPORTERS = {
+    ExportFormat.NDJSON: export_ndjson,
+    ExportFormat.COCO: export_coco,
+    ExportFormat.YOLO: export_yolo,
+}
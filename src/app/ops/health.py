@@ -0,0 +1,129 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/health.py
+# Description: health snapshot of the upstream dependencies, refreshed in the background so probes never wait on them
+
+import asyncio
+import inspect
+import math
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+import tator
+
+from app.conf import health_interval_s, health_timeout_s, health_stale_s
+from app.logger import debug, exception
+from app.ops.db import fetch_all, get_db_pool
+from app.ops.projects import registry
+from app.ops.queries import sql_resolve_enabled
+from app.ops.redis_process import local_mode, get_redis, queued_jobs, in_flight_jobs
+
+
+class HealthMonitor:
+    """
+    Checks Tator, the database pool and the job queue every interval_s seconds and keeps the results in a snapshot.
+    The probes only read the snapshot, so they return at once and make no upstream calls.
+    """
+
+    def __init__(self, interval_s: float = health_interval_s, timeout_s: float = health_timeout_s,
+                 stale_s: float = health_stale_s):
+        self.interval_s = interval_s
+        self.timeout_s = timeout_s
+        self.stale_s = stale_s
+        self.checked_at: float | None = None
+        self.checks: Dict[str, Dict[str, Any]] = {}
+        # Call of the sync SDK still running in a thread, see check_tator
+        self._tator_call: asyncio.Future | None = None
+
+    async def _check(self, check: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(check(), self.timeout_s)
+            result = {"ok": True, **result}
+        except asyncio.TimeoutError:
+            result = {"ok": False, "error": f"timed out after {self.timeout_s} s"}
+        except Exception as e:
+            result = {"ok": False, "error": str(e)}
+        result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    async def check_tator(self, api: tator.api | None) -> Dict[str, Any]:
+        if api is None:
+            raise RuntimeError("Tator API not initialized")
+        # Not through run_sdk, so the probe does not wait behind a busy scheduler or SDK thread pool.
+        # The call has its own HTTP timeout, as a thread cannot be cancelled when the check times out
+        if inspect.iscoroutinefunction(api.whoami):
+            await api.whoami(_request_timeout=self.timeout_s)
+        else:
+            if self._tator_call is not None and not self._tator_call.done():
+                raise RuntimeError("the previous check is still waiting for Tator")
+            self._tator_call = asyncio.ensure_future(asyncio.to_thread(api.whoami, _request_timeout=self.timeout_s))
+            # Retrieve the error of a call that outlives its check
+            self._tator_call.add_done_callback(lambda call: call.cancelled() or call.exception())
+            await asyncio.shield(self._tator_call)
+        return {"projects": len(registry.projects)}
+
+    async def check_db(self) -> Dict[str, Any]:
+        if not sql_resolve_enabled():
+            return {"enabled": False}
+        await fetch_all("SELECT 1", timeout_ms=int(self.timeout_s * 1000), name="health")
+        stats = get_db_pool().get_stats()
+        return {"enabled": True, "pool_size": stats.get("pool_size", 0), "pool_available": stats.get("pool_available", 0),
+                "requests_waiting": stats.get("requests_waiting", 0)}
+
+    async def check_queue(self) -> Dict[str, Any]:
+        if not local_mode():
+            await asyncio.to_thread(get_redis().ping)
+        queued = await asyncio.to_thread(queued_jobs)
+        running = in_flight_jobs() if local_mode() else await asyncio.to_thread(in_flight_jobs)
+        if math.isnan(queued) or math.isnan(running):
+            raise RuntimeError("job queue unavailable")
+        return {"local": local_mode(), "queued": int(queued), "in_flight": int(running)}
+
+    async def refresh(self, api: tator.api | None):
+        """
+        Run all checks at once and replace the snapshot
+        """
+        tator_check, db_check, queue_check = await asyncio.gather(
+            self._check(lambda: self.check_tator(api)), self._check(self.check_db), self._check(self.check_queue))
+        self.checks = {"tator": tator_check, "db": db_check, "queue": queue_check}
+        self.checked_at = time.time()
+        debug("Health %s", self.checks)
+
+    async def refresh_loop(self, api: tator.api | None):
+        """
+        Refresh the snapshot every interval_s seconds until cancelled
+        """
+        while True:
+            try:
+                await self.refresh(api)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                exception(f"Failed to check health. Error: {e}")
+            await asyncio.sleep(self.interval_s)
+
+    def ready(self) -> bool:
+        """
+        True if the last snapshot is recent and Tator, the database, if used, and the job queue were reachable
+        """
+        if self.checked_at is None or time.time() - self.checked_at > self.stale_s:
+            return False
+        return all(check.get("ok") for check in self.checks.values())
+
+    def tator_error(self) -> str | None:
+        """
+        Error of the last Tator check, None if it succeeded or has not run yet
+        """
+        check = self.checks.get("tator", {})
+        return None if check.get("ok", True) else check.get("error")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready(),
+            "checked_at": self.checked_at,
+            "age_s": round(time.time() - self.checked_at, 1) if self.checked_at else None,
+            "checks": self.checks,
+        }
+
+
+monitor = HealthMonitor()
@@ -0,0 +1,92 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/metrics.py
+# Description: prometheus metrics for bulk operations, tator SDK calls and database queries.
+#   Registered on the default registry so they are exported on /metrics with the HTTP metrics.
+#   The gauges set how they combine across the processes of a queue worker, see worker.serve_metrics
+
+from prometheus_client import Counter, Gauge, Histogram
+
+LOCALIZATIONS = Counter(
+    "fastapi_tator_localizations",
+    "Localizations modified or deleted by bulk operations",
+    ["operation", "project", "action"],
+)
+
+BATCH_DURATION = Histogram(
+    "fastapi_tator_batch_duration_seconds",
+    "Time to fetch or apply a batch of a bulk operation",
+    ["operation", "stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+BATCH_SIZE = Histogram(
+    "fastapi_tator_batch_size",
+    "Number of localizations in an applied batch",
+    ["operation"],
+    buckets=(0, 1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+
+BATCHES_FAILED = Counter(
+    "fastapi_tator_batches_failed",
+    "Batches of bulk operations that failed",
+    ["operation", "stage"],
+)
+
+BATCH_MEDIA = Gauge(
+    "fastapi_tator_batch_media",
+    "Current number of media per batch chosen by the adaptive batcher",
+    ["project"],
+    multiprocess_mode="mostrecent",
+)
+
+JOBS_QUEUED = Gauge(
+    "fastapi_tator_jobs_queued",
+    "Bulk operation jobs waiting in the queue",
+    multiprocess_mode="livemax",
+)
+
+JOBS_IN_FLIGHT = Gauge(
+    "fastapi_tator_jobs_in_flight",
+    "Bulk operation jobs being run",
+    multiprocess_mode="livemax",
+)
+
+SDK_CALL_DURATION = Histogram(
+    "fastapi_tator_sdk_call_duration_seconds",
+    "Duration of tator SDK calls, excluding the wait for a free slot",
+    ["method"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    "fastapi_tator_scheduler_queue_depth",
+    "Upstream calls waiting for a slot of the fair scheduler",
+    ["lane", "project"],
+    multiprocess_mode="livesum",
+)
+
+SCHEDULER_WAIT = Histogram(
+    "fastapi_tator_scheduler_wait_seconds",
+    "Time upstream calls waited for a slot of the fair scheduler",
+    ["lane"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+SDK_CALL_ERRORS = Counter(
+    "fastapi_tator_sdk_call_errors",
+    "Tator SDK calls that raised an exception",
+    ["method"],
+)
+
+FILTERED_LOCALIZATIONS = Counter(
+    "fastapi_tator_filtered_localizations",
+    "Localizations fetched from Tator and kept by a client-side filter, fetched over kept is the over-fetch ratio",
+    ["filter", "operation", "project", "stage"],
+)
+
+DB_QUERY_DURATION = Histogram(
+    "fastapi_tator_db_query_duration_seconds",
+    "Duration of direct database queries, including the wait for a pooled connection",
+    ["query"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
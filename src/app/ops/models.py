@@ -3,7 +3,7 @@
 # Description: models for common bulk operations on tator
 
 from enum import unique, Enum
-from typing import Optional
+from typing import List, Optional
 
 from pydantic import BaseModel, field_validator
 from app.conf import default_project
@@ -17,6 +17,35 @@ class ProjectSpec(BaseModel):
     video_type: int | None = None
 
 
+class BatchError(BaseModel):
+    index: int
+    stage: str
+    message: str
+
+
+class BatchSummary(BaseModel):
+    name: str
+    batches: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    items: int = 0
+    elapsed_s: float = 0.
+    errors: List[BatchError] = []
+
+
+class CountEstimate(BaseModel):
+    localizations: int = 0
+    media: int = 0
+
+
+class DryRunEstimate(BaseModel):
+    total: CountEstimate = CountEstimate()
+    verified: CountEstimate = CountEstimate()
+    unverified: CountEstimate = CountEstimate()
+    image: CountEstimate = CountEstimate()
+    video: CountEstimate = CountEstimate()
+
+
 @unique
 class FilterType(Enum):
     Includes = "Includes"
@@ -24,6 +53,13 @@ class FilterType(Enum):
     LessThan = "LessThan"
 
 
+@unique
+class ExportFormat(Enum):
+    NDJSON = "ndjson"
+    COCO = "coco"
+    YOLO = "yolo"
+
+
 class DeleteFlagFilterModel(BaseModel):
     project_name: str | None = default_project
     dry_run: bool | None = True
@@ -100,3 +136,43 @@ class LocSaliencyLabelFilterModel(BaseModel):
     version_name: str | None = "Baseline"
     project_name: str | None = default_project
     dry_run: bool | None = True
+
+class ExportFilterModel(BaseModel):
+    export_format: str | None = ExportFormat.NDJSON
+    label_name: str | None = None
+    cluster_name: str | None = None
+    verified: Optional[bool] = True
+    version_name: str | None = "Baseline"
+    project_name: str | None = default_project
+
+
+class LocLabelItem(BaseModel):
+    loc_id: int
+    label: str
+    score: float | None = None
+    verified: Optional[bool] = None
+
+
+class LocLabelBulkModel(BaseModel):
+    items: List[LocLabelItem] = []
+    project_name: str | None = default_project
+    dry_run: bool | None = True
+
+
+class LocLabelResult(BaseModel):
+    loc_id: int
+    status: str
+    message: str | None = None
+
+
+class ClusterLabelItem(BaseModel):
+    cluster_name: str
+    label: str
+    verify: Optional[bool] = None
+
+
+class ClusterLabelPlanModel(BaseModel):
+    items: List[ClusterLabelItem] = []
+    version_name: str | None = "Baseline"
+    project_name: str | None = default_project
+    dry_run: bool | None = True
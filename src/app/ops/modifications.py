@@ -2,10 +2,25 @@
 # Filename: app/ops/utils.py
 # Description: operations that modify the database
 
+from collections import Counter
+from typing import Any, AsyncIterable, Dict, List, Tuple
+
 import tator
+from app.conf import loc_chunk_size
 from app.logger import info, exception, debug, err
-from app.ops.models import ProjectSpec, FilterType, LocMediaClusterFilterModel, LocIdFilterModel, LocClusterFilterModel
-from app.ops.utils import get_version_id, get_media_ids
+from app.ops.batching import get_batcher, resumable_media_batches, call_adaptive, iter_adaptive_media_batches
+from app.ops.checkpoints import current_checkpoint, checkpointed
+from app.ops.cache import notify_write
+from app.ops.executor import run_sdk
+from app.ops.metrics import LOCALIZATIONS
+from app.ops.models import ProjectSpec, FilterType, LocMediaClusterFilterModel, LocIdFilterModel, LocClusterFilterModel, \
+    BatchSummary, LocLabelBulkModel, LocLabelResult, ClusterLabelPlanModel, ClusterLabelItem
+from app.ops.pipeline import run_batches
+from app.ops.progress import report_progress
+from app.ops.queries import sql_resolve_enabled, iter_cluster_localization_ids, get_existing_localization_ids, \
+    iter_clusters_localization_ids
+from app.ops.tracing import record_filter
+from app.ops.utils import get_version_id
 
 
 async def change_label_id(label: str, model: LocIdFilterModel, api: tator.api, spec: ProjectSpec):
@@ -18,32 +33,238 @@ async def change_label_id(label: str, model: LocIdFilterModel, api: tator.api, s
     """
     info(f"Assigning localizations for {model.loc_id}  to {label}...")
 
-    # Update boxes by IDs, set verified to True
-    params = {"type": spec.box_type}
-    id_bulk_patch = {
-        "attributes": {"Label": label},
-        "ids": [model.loc_id],
-        "in_place": 1,
-    }
+    attributes = {"Label": label}
     if model.score is not None:
-        id_bulk_patch["attributes"] = {"Label": label, "score": model.score}
+        attributes["score"] = model.score
 
-    info(id_bulk_patch)
     try:
-        response = api.update_localization(project=spec.project_id, **params, localization_bulk_update=id_bulk_patch)
-        debug(response)
+        await _update_localization_ids(api, spec, [model.loc_id], attributes, "change_label_id")
+        report_progress(localizations=1)
     except Exception as e:
         err(f"Failed to update localization {model.loc_id} with label {label}. Error: {e}")
 
 
-async def assign_cluster_label(model: LocClusterFilterModel, label: str, api: tator.api, spec: ProjectSpec):
+async def change_label_ids(model: LocLabelBulkModel, api: tator.api, spec: ProjectSpec,
+                           chunk_size: int = loc_chunk_size) -> Tuple[int, List[LocLabelResult]]:
+    """
+    Assign labels to localizations by ID with as few bulk updates as possible. Items with the same label, score
+    and verified state are grouped and updated chunk_size IDs at a time. If an ID is listed more than once the
+    last item wins. Nothing is updated for a dry run.
+    :param model: model with the label, score and verified state of each localization
+    :param api: tator api
+    :param spec: project specifications
+    :param chunk_size: maximum number of IDs in each bulk update
+    :return: number of bulk updates and the result of each item in the order given
+    """
+    items = model.items
+    results: List[LocLabelResult | None] = [None] * len(items)
+    latest = {item.loc_id: i for i, item in enumerate(items)}
+    groups: Dict[tuple, List[int]] = {}
+    for i, item in enumerate(items):
+        if latest[item.loc_id] != i:
+            results[i] = LocLabelResult(loc_id=item.loc_id, status="skipped", message="Superseded by a later item")
+        elif item.score is not None and not 0. <= item.score <= 1.:
+            results[i] = LocLabelResult(loc_id=item.loc_id, status="invalid",
+                                        message=f"Invalid score {item.score}. Must be between 0 and 1")
+        else:
+            groups.setdefault((item.label, item.score, item.verified), []).append(i)
+
+    if sql_resolve_enabled() and groups:
+        try:
+            existing = await get_existing_localization_ids(spec, [items[i].loc_id for g in groups.values() for i in g])
+            for key in list(groups):
+                for i in groups[key]:
+                    if items[i].loc_id not in existing:
+                        results[i] = LocLabelResult(loc_id=items[i].loc_id, status="not_found")
+                groups[key] = [i for i in groups[key] if items[i].loc_id in existing]
+                if not groups[key]:
+                    del groups[key]
+        except Exception as e:
+            err(f"Failed to check the localization IDs in the database, updating all of them. Error: {e}")
+
+    batches = []
+    for indices in groups.values():
+        first = items[indices[0]]
+        attributes = {"Label": first.label}
+        if first.score is not None:
+            attributes["score"] = first.score
+        if first.verified is not None:
+            attributes["verified"] = first.verified
+        for start in range(0, len(indices), chunk_size):
+            batches.append((attributes, indices[start:start + chunk_size]))
+
+    if model.dry_run:
+        for _, indices in batches:
+            for i in indices:
+                results[i] = LocLabelResult(loc_id=items[i].loc_id, status="planned")
+        return len(batches), results
+
+    async def fetch(index: int, batch: tuple) -> tuple:
+        return batch
+
+    async def apply(index: int, batch: tuple) -> int:
+        attributes, indices = batch
+        return await _update_localization_ids(api, spec, [items[i].loc_id for i in indices], attributes, "change_label_ids")
+
+    summary = await run_batches(f"Relabel {len(items)} localizations by ID", batches, fetch, apply,
+                                operation="change_label_ids")
+    failed = {e.index: e.message for e in summary.errors}
+    for index, (_, indices) in enumerate(batches):
+        for i in indices:
+            if index in failed:
+                results[i] = LocLabelResult(loc_id=items[i].loc_id, status="failed", message=failed[index])
+            else:
+                results[i] = LocLabelResult(loc_id=items[i].loc_id, status="updated")
+    return len(batches), results
+
+
+async def assign_label_ids(model: LocLabelBulkModel, api: tator.api, spec: ProjectSpec) -> Dict[str, Any]:
+    """
+    Assign labels to localizations by ID as a queued job, see change_label_ids. The job is not checkpointed, a resumed
+    job updates all items again.
+    :param model: model with the label, score and verified state of each localization
+    :param api: tator api
+    :param spec: project specifications
+    :return: number of bulk updates, number of items by status and the result of each item, for the job's summary
+    """
+    calls, results = await change_label_ids(model, api, spec)
+    statuses = Counter(r.status for r in results)
+    info(f"Done. Updated {statuses['updated']} of {len(results)} localizations by ID in {calls} calls")
+    return {"calls": calls, "statuses": dict(statuses), "failed": statuses["failed"],
+            "results": [r.model_dump() for r in results]}
+
+
+def _label_attributes(model: LocClusterFilterModel | LocMediaClusterFilterModel | ClusterLabelItem, label: str) -> dict:
+    """
+    Attributes to set on relabeled localizations. Sets verified to True or False if requested, otherwise leaves it as-is.
+    """
+    attributes = {"Label": label}
+    verify = getattr(model, "verify", None)
+    if verify is not None:
+        attributes["verified"] = verify
+    return attributes
+
+
+async def _update_localization_ids(api: tator.api, spec: ProjectSpec, ids: List[int], attributes: dict, operation: str) -> int:
+    """
+    Bulk update the attributes of localizations by IDs
+    :param operation: name of the operation for the metrics
+    :return: number of localizations updated
+    """
+    id_bulk_patch = {
+        "attributes": attributes,
+        "ids": ids,
+        "in_place": 1,
+    }
+    debug("Updating %d localizations with %s", len(ids), id_bulk_patch)
+    response = await run_sdk(api.update_localization_list, project=spec.project_id, type=spec.box_type, localization_bulk_update=id_bulk_patch)
+    debug("%s", response)
+    await notify_write(spec.project_id)
+    LOCALIZATIONS.labels(operation, spec.project_name, "modified").inc(len(ids))
+    return len(ids)
+
+
+async def _relabel_cluster_media(
+        model: LocClusterFilterModel | LocMediaClusterFilterModel,
+        label: str,
+        api: tator.api,
+        spec: ProjectSpec,
+        media_batches: AsyncIterable[List[int]],
+        version_id: int | None,
+        operation: str
+) -> BatchSummary:
+    """
+    Pipelined assignment of a label to the localizations in a cluster for the given batches of media.
+    Localizations for the next batches are fetched while earlier updates are in flight.
+    :param model: model with the cluster name and optional verify flag
+    :param label: new label to assign
+    :param api: tator api
+    :param spec: project specifications
+    :param media_batches: batches of media ids to search for localizations in the cluster
+    :param version_id: optional version id to restrict the localizations to
+    :param operation: name of the operation for the metrics
+    :return: summary of the batches
+    """
+    kwargs = {"attribute": [f"cluster::{model.cluster_name}"]}
+    if version_id:
+        kwargs["version"] = [version_id]
+    attributes = _label_attributes(model, label)
+
+    batcher = get_batcher(spec.project_name)
+
+    async def get_localizations(media_ids: List[int]) -> list:
+        return await run_sdk(api.get_localization_list, project=spec.project_id, type=spec.box_type, media_id=media_ids, **kwargs)
+
+    async def fetch(index: int, batch: List[int]) -> List[int]:
+        debug("Fetching localizations for media batch %d that include %s ...", index, model.cluster_name)
+        results = await call_adaptive(batcher, batch, get_localizations, len)
+        localizations = [l for result in results for l in result]
+
+        # only keep localizations that include the cluster name - this is a filter because
+        # sometimes the query returns localizations that do not include the cluster name
+        # this is a bug in the API
+        ids = [l.id for l in localizations if model.cluster_name == l.attributes.get("cluster")]
+        record_filter("cluster", operation, spec.project_name, len(localizations), len(ids))
+        return ids
+
+    async def apply(index: int, ids: List[int]) -> int:
+        if len(ids) == 0:
+            debug("No localizations found for media batch %d that include %s ...", index, model.cluster_name)
+            return 0
+
+        debug("Found %d localizations that include %s ...", len(ids), model.cluster_name)
+        return await _update_localization_ids(api, spec, ids, attributes, operation)
+
+    return await run_batches(f"Relabel cluster {model.cluster_name} to {label}", media_batches, fetch, apply,
+                             operation=operation, checkpoint=current_checkpoint.get())
+
+
+async def _relabel_cluster_ids(
+        model: LocClusterFilterModel | LocMediaClusterFilterModel,
+        label: str,
+        api: tator.api,
+        spec: ProjectSpec,
+        version_id: int | None,
+        operation: str
+) -> BatchSummary:
+    """
+    Pipelined assignment of a label to the localizations in a cluster resolved with a direct database query.
+    Chunks of localization ids go straight to the bulk update without fetching any localizations.
+    :param model: model with the cluster name, optional media name filter and optional verify flag
+    :param label: new label to assign
+    :param api: tator api
+    :param spec: project specifications
+    :param version_id: optional version id to restrict the localizations to
+    :param operation: name of the operation for the metrics
+    :return: summary of the batches
+    """
+    attributes = _label_attributes(model, label)
+    media_name = getattr(model, "media_name", None)
+    filter_media = FilterType(model.filter_media) if media_name else FilterType.Equals
+    checkpoint = current_checkpoint.get()
+    position = checkpoint.begin("localizations") if checkpoint is not None else {}
+    id_batches = checkpointed(iter_cluster_localization_ids(spec, model.cluster_name, version_id=version_id, media_name=media_name,
+                                                            filter_media=filter_media, position=position),
+                              "localizations", position, checkpoint)
+
+    async def fetch(index: int, ids: List[int]) -> List[int]:
+        return ids
+
+    async def apply(index: int, ids: List[int]) -> int:
+        return await _update_localization_ids(api, spec, ids, attributes, operation)
+
+    return await run_batches(f"Relabel cluster {model.cluster_name} to {label}", id_batches, fetch, apply,
+                             operation=operation, checkpoint=checkpoint)
+
+
+async def assign_cluster_label(model: LocClusterFilterModel, label: str, api: tator.api, spec: ProjectSpec) -> BatchSummary | None:
     """
     Paginated assignment of a label for all localizations for a given cluster filter
     :param model: model with criteria to filter for modifications
     :param label: new label to assign
     :param spec:  project specifications
     :param api: tator api
-    :return:
+    :return: summary of the batches, or None if there was nothing to modify
     """
     attribute_cluster = [f"cluster::{model.cluster_name}"]
 
@@ -53,83 +274,42 @@ async def assign_cluster_label(model: LocClusterFilterModel, label: str, api: ta
 
     version_id = await get_version_id(api, spec.project_id, model.version_name)
     if version_id is None and len(model.version_name) > 0:
-        info(f"Version {spec.version_name} not found in project {spec.project_name}")
+        info(f"Version {model.version_name} not found in project {spec.project_name}")
         return
 
-    debug(f"Fetching medias for project {spec.project_name} with cluster {model.cluster_name} ...")
+    if sql_resolve_enabled():
+        try:
+            summary = await _relabel_cluster_ids(model, label, api, spec, version_id, "assign_cluster_label")
+            info(f"Done. Changed {summary.items} localizations that include {attribute_cluster} "
+                 f"and {model.cluster_name} to {label} with {summary.failed} of {summary.batches} batches failed")
+            return summary
+        except Exception as e:
+            err(f"Failed to resolve localizations in cluster {model.cluster_name} from the database, "
+                f"falling back to the REST API. Error: {e}")
+
+    debug("Fetching medias for project %s with cluster %s ...", spec.project_name, model.cluster_name)
 
     kwargs = {"related_attribute": attribute_cluster}
     debug(kwargs)
-    media_ids = await get_media_ids(api=api, spec=spec, **kwargs)
-    debug(f"Found {len(media_ids)} medias with {kwargs}...")
-    if len(media_ids) == 0:
+    media_batches = resumable_media_batches(api, spec, count_localizations=False, **kwargs)
+    summary = await _relabel_cluster_media(model, label, api, spec, media_batches, version_id, "assign_cluster_label")
+    if summary.batches == 0:
         info(f"No media found with {kwargs}")
         return
 
-    # Clear the kwargs to prepare for the next query
-    kwargs.clear()
-    kwargs["attribute"] = [f"cluster::{model.cluster_name}"]
-    if version_id:
-        kwargs["version"] = [version_id]
-
-    batch_size = min(100, len(media_ids))
-    num_modified = 0
-    for i in range(0, len(media_ids), batch_size):
-        debug(f"Fetching localizations for media {i} to {i+batch_size} that include {model.cluster_name} ...")
+    info(f"Done. Changed {summary.items} localizations that include {attribute_cluster} "
+         f"and {model.cluster_name} to {label} with {summary.failed} of {summary.batches} batches failed")
+    return summary
 
-        if len(media_ids) == 0:
-            info(f"No media found with {kwargs}")
-            return
 
-        kwargs["media_id"] = media_ids[i:i + batch_size]
-        debug(kwargs)
-        localizations = api.get_localization_list(project=spec.project_id, type=spec.box_type, **kwargs)
-
-        # only keep localizations that include the cluster name - this is a filter because
-        # sometimes the query returns localizations that do not include the cluster name
-        # this is a bug in the API
-        localizations = [l for l in localizations if model.cluster_name == l.attributes.get("cluster")]
-
-        if len(localizations) == 0:
-            debug(f"No localizations found for media {i} to {i+batch_size} that include {model.cluster_name} ...")
-            continue
-
-        num_modified += len(localizations)
-        debug(f"Found {len(localizations)} localizations that include {model.cluster_name} ...")
-
-        # Bulk update boxes by IDs
-        params = {"type": spec.box_type}
-        if model.verify is None:
-            id_bulk_patch = {
-                "attributes": {"Label": label},
-                "ids": [l.id for l in localizations],
-                "in_place": 1,
-            }
-        else:
-            id_bulk_patch = {
-                "attributes": {"Label": label, "verified": model.verify},
-                "ids": [l.id for l in localizations],
-                "in_place": 1,
-            }
-        try:
-            info(id_bulk_patch)
-            response = api.update_localization_list(project=spec.project_id, **params, localization_bulk_update=id_bulk_patch)
-            debug(response)
-        except Exception as e:
-            err(f"Failed to update localizations for media {i} to {i+batch_size} that include {model.cluster_name}. Error: {e}")
-
-    info(f"Done. Changed {num_modified} localizations that include {attribute_cluster} "
-         f"and {model.cluster_name} to {label}")
-
-
-async def assign_cluster_media_label(model: LocMediaClusterFilterModel, label: str, api: tator.api, spec: ProjectSpec):
+async def assign_cluster_media_label(model: LocMediaClusterFilterModel, label: str, api: tator.api, spec: ProjectSpec) -> BatchSummary | None:
     """
     Paginated assignment of a label for all localizations for a given media and cluster filter
     :param model: model with criteria to filter for modifications
     :param label: new label to assign
     :param spec:  project specifications
     :param api: tator api
-    :return:
+    :return: summary of the batches, or None if there was nothing to modify
     """
     attribute_media = None if len(model.media_name) == 0 else [f"$name::{model.media_name}"]
     attribute_cluster = [f"cluster::{model.cluster_name}"]
@@ -141,10 +321,10 @@ async def assign_cluster_media_label(model: LocMediaClusterFilterModel, label: s
 
     version_id = await get_version_id(api, spec.project_id, model.version_name)
     if version_id is None and len(model.version_name) > 0:
-        info(f"Version {spec.version_name} not found in project {spec.project_name}")
+        info(f"Version {model.version_name} not found in project {spec.project_name}")
         return
 
-    debug(f"Fetching medias for project {spec.project_name} with name {model.media_name} ...")
+    debug("Fetching medias for project %s with name %s ...", spec.project_name, model.media_name)
 
     kwargs = {"related_attribute": attribute_cluster}
     if attribute_media:
@@ -156,64 +336,154 @@ async def assign_cluster_media_label(model: LocMediaClusterFilterModel, label: s
             err(f"Invalid filter type {filter_media}")
             return
 
+    if sql_resolve_enabled():
+        try:
+            summary = await _relabel_cluster_ids(model, label, api, spec, version_id, "assign_cluster_media_label")
+            info(f"Done. Changed {summary.items} localizations that include {attribute_media} "
+                 f"and {model.cluster_name} to {label} with {summary.failed} of {summary.batches} batches failed")
+            return summary
+        except Exception as e:
+            err(f"Failed to resolve localizations in cluster {model.cluster_name} from the database, "
+                f"falling back to the REST API. Error: {e}")
+
     debug(kwargs)
-    media_ids = await get_media_ids(api=api, spec=spec, **kwargs)
-    debug(f"Found {len(media_ids)} medias with {kwargs}...")
-    if len(media_ids) == 0:
+    media_batches = resumable_media_batches(api, spec, count_localizations=False, **kwargs)
+    summary = await _relabel_cluster_media(model, label, api, spec, media_batches, version_id,
+                                           "assign_cluster_media_label")
+    if summary.batches == 0:
         info(f"No media found with {kwargs}")
         return
 
-    # Clear the kwargs to prepare for the next query
-    kwargs.clear()
-    kwargs["attribute"] = [f"cluster::{model.cluster_name}"]
-    if version_id:
-        kwargs["version"] = [version_id]
+    info(f"Done. Changed {summary.items} localizations that include {attribute_media} "
+         f"and {model.cluster_name} to {label} with {summary.failed} of {summary.batches} batches failed")
+    return summary
 
-    batch_size = min(100, len(media_ids))
-    num_modified = 0
-    for i in range(0, len(media_ids), batch_size):
-        debug(f"Fetching localizations for media {i} to {i+batch_size} that include {model.cluster_name} ...")
 
-        if len(media_ids) == 0:
-            info(f"No media found with {kwargs}")
-            return
+async def _group_cluster_ids(
+        pages: AsyncIterable[List[Tuple[int, str]]],
+        targets: Dict[str, tuple],
+        chunk_size: int,
+        page_position: dict,
+        position: dict
+) -> AsyncIterable[Tuple[tuple, List[int]]]:
+    """
+    Group each page of streamed (localization id, cluster name) pairs by the attributes to set, yielding up to
+    chunk_size IDs at a time so clusters relabeled to the same label share bulk updates. The last batch of a page
+    carries the position of the page, the others cannot be resumed from.
+    """
+    async for page in pages:
+        grouped: Dict[tuple, List[int]] = {}
+        for loc_id, cluster_name in page:
+            key = targets.get(cluster_name)
+            if key is not None:
+                grouped.setdefault(key, []).append(loc_id)
+        batches = [(key, ids[start:start + chunk_size]) for key, ids in grouped.items() for start in range(0, len(ids), chunk_size)]
+        for i, batch in enumerate(batches):
+            position.clear()
+            if i == len(batches) - 1:
+                position.update(page_position)
+            yield batch
+
+
+async def _cluster_media_batches(
+        api: tator.api,
+        spec: ProjectSpec,
+        cluster_names: List[str],
+        position: dict
+) -> AsyncIterable[Tuple[str, List[int]]]:
+    """
+    Scan the media that hold each cluster in turn, yielding the cluster name with each adaptive batch of its media.
+    The position records the index of the cluster and the last media of the batch.
+    """
+    start = position.get("cluster", 0)
+    for i in range(start, len(cluster_names)):
+        media_position = {k: v for k, v in position.items() if k != "cluster"} if i == start else {}
+        batches = iter_adaptive_media_batches(api, spec, get_batcher(spec.project_name), False, media_position,
+                                              related_attribute=[f"cluster::{cluster_names[i]}"])
+        async for batch in batches:
+            position.clear()
+            position.update(media_position, cluster=i)
+            yield cluster_names[i], batch
+
+
+async def assign_cluster_labels(model: ClusterLabelPlanModel, api: tator.api, spec: ProjectSpec,
+                                chunk_size: int = loc_chunk_size) -> BatchSummary | None:
+    """
+    Assign labels to the localizations of many clusters, e.g. from an sdcat run, in a single pass over the data
+    with direct database queries, otherwise with one scan per cluster of the media that hold it.
+    Localizations of clusters relabeled to the same label and verified state share bulk updates.
+    :param model: model with the label and optional verify flag of each cluster
+    :param api: tator api
+    :param spec: project specifications
+    :param chunk_size: maximum number of IDs in each bulk update
+    :return: summary of the batches, or None if there was nothing to modify
+    """
+    if len(model.items) == 0:
+        info("No clusters provided")
+        return
 
-        kwargs["media_id"] = media_ids[i:i + batch_size]
-        debug(kwargs)
-        localizations = api.get_localization_list(project=spec.project_id, type=spec.box_type, **kwargs)
+    version_id = await get_version_id(api, spec.project_id, model.version_name)
+    if version_id is None and len(model.version_name or "") > 0:
+        info(f"Version {model.version_name} not found in project {spec.project_name}")
+        return
 
-        # only keep localizations that include the cluster name - this is a filter because
-        # sometimes the query returns localizations that do not include the cluster name
-        # this is a bug in the API
-        localizations = [l for l in localizations if model.cluster_name == l.attributes.get("cluster")]
-
-        if len(localizations) == 0:
-            debug(f"No localizations found for media {i} to {i+batch_size} that include {model.cluster_name} ...")
-            continue
-
-        num_modified += len(localizations)
-        debug(f"Found {len(localizations)} localizations that include {model.cluster_name} ...")
-
-        # Bulk update boxes by IDs, set verified to True
-        params = {"type": spec.box_type}
-        if model.verify is not None:
-            id_bulk_patch = {
-                "attributes": {"Label": label, "verified": model.verify},
-                "ids": [l.id for l in localizations],
-                "in_place": 1,
-            }
-        else:
-            id_bulk_patch = {
-                "attributes": {"Label": label},
-                "ids": [l.id for l in localizations],
-                "in_place": 1,
-            }
+    # Attributes to set by cluster, as sorted tuples so they can be grouped
+    targets = {item.cluster_name: tuple(sorted(_label_attributes(item, item.label).items())) for item in model.items}
+    operation = "assign_cluster_labels"
+    name = f"Relabel {len(targets)} clusters"
+
+    async def apply(index: int, groups: List[Tuple[tuple, List[int]]]) -> int:
+        count = 0
+        for key, ids in groups:
+            count += await _update_localization_ids(api, spec, ids, dict(key), operation)
+        return count
+
+    summary = None
+    if sql_resolve_enabled():
         try:
-            info(id_bulk_patch)
-            response = api.update_localization_list(project=spec.project_id, **params, localization_bulk_update=id_bulk_patch)
-            debug(response)
+            checkpoint = current_checkpoint.get()
+            position = checkpoint.begin("localizations") if checkpoint is not None else {}
+            page_position = dict(position)
+            # Pages of several bulk updates, so clusters relabeled to the same label share them
+            pages = iter_clusters_localization_ids(spec, list(targets), version_id=version_id, chunk_size=chunk_size * 10,
+                                                   position=page_position)
+            id_batches = checkpointed(_group_cluster_ids(pages, targets, chunk_size, page_position, position),
+                                      "localizations", position, checkpoint)
+
+            async def fetch_ids(index: int, batch: Tuple[tuple, List[int]]) -> List[Tuple[tuple, List[int]]]:
+                return [batch]
+
+            summary = await run_batches(name, id_batches, fetch_ids, apply, operation=operation, checkpoint=checkpoint)
         except Exception as e:
-            err(f"Failed to update localizations for media {i} to {i+batch_size} that include {model.cluster_name}. Error: {e}")
-
-    info(f"Done. Changed {num_modified} localizations that include {attribute_media} "
-         f"and {model.cluster_name} to {label}")
+            err(f"Failed to resolve localizations in {len(targets)} clusters from the database, "
+                f"falling back to the REST API. Error: {e}")
+
+    if summary is None:
+        # One scan per cluster over the media that hold it, with batches of different clusters in flight together
+        kwargs = {"version": [version_id]} if version_id else {}
+        batcher = get_batcher(spec.project_name)
+
+        async def fetch(index: int, batch: Tuple[str, List[int]]) -> List[Tuple[tuple, List[int]]]:
+            cluster_name, media_ids = batch
+            debug("Fetching localizations for media batch %d that include %s ...", index, cluster_name)
+
+            async def get_localizations(media_ids: List[int]) -> list:
+                return await run_sdk(api.get_localization_list, project=spec.project_id, type=spec.box_type,
+                                     media_id=media_ids, attribute=[f"cluster::{cluster_name}"], **kwargs)
+
+            results = await call_adaptive(batcher, media_ids, get_localizations, len)
+            localizations = [l for result in results for l in result]
+            # The cluster filter of the API can return localizations of other clusters, see _relabel_cluster_media
+            ids = [l.id for l in localizations if l.attributes.get("cluster") == cluster_name]
+            record_filter("cluster", operation, spec.project_name, len(localizations), len(ids))
+            return [(targets[cluster_name], ids[start:start + chunk_size]) for start in range(0, len(ids), chunk_size)]
+
+        checkpoint = current_checkpoint.get()
+        position = checkpoint.begin("clusters") if checkpoint is not None else {}
+        media_batches = checkpointed(_cluster_media_batches(api, spec, list(targets), position), "clusters", position,
+                                     checkpoint)
+        summary = await run_batches(name, media_batches, fetch, apply, operation=operation, checkpoint=checkpoint)
+
+    info(f"Done. Changed {summary.items} localizations in {len(targets)} clusters "
+         f"with {summary.failed} of {summary.batches} batches failed")
+    return summary
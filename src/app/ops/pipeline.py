@@ -0,0 +1,130 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/pipeline.py
+# Description: pipelined execution of batched fetch and update operations
+
+import asyncio
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable
+
+from app.conf import batch_concurrency, batch_prefetch
+from app.logger import info, err
+from app.ops.checkpoints import Checkpoint, JobInterrupted, drain_requested
+from app.ops.metrics import BATCH_DURATION, BATCH_SIZE, BATCHES_FAILED
+from app.ops.models import BatchError, BatchSummary
+from app.ops.progress import report_progress
+
+_DONE = object()
+
+
+async def _aiter(batches: Iterable | AsyncIterable):
+    if hasattr(batches, "__aiter__"):
+        async for batch in batches:
+            yield batch
+    else:
+        for batch in batches:
+            yield batch
+
+
+async def run_batches(
+        name: str,
+        batches: Iterable | AsyncIterable,
+        fetch: Callable[[int, Any], Awaitable[Any]],
+        apply: Callable[[int, Any], Awaitable[int]],
+        concurrency: int = batch_concurrency,
+        prefetch: int = batch_prefetch,
+        operation: str = "batch",
+        checkpoint: Checkpoint | None = None,
+) -> BatchSummary:
+    """
+    Run fetch then apply for every batch. Up to prefetch batches are fetched concurrently ahead of the
+    updates while up to concurrency batches are applied at once. A failed batch is recorded and does not stop the remaining batches.
+    :param name: name of the operation for logging
+    :param batches: batches to process, e.g. chunks of media ids
+    :param fetch: coroutine taking (batch index, batch) that returns the work for the batch
+    :param apply: coroutine taking (batch index, fetched work) that returns the number of items processed
+    :param concurrency: maximum number of batches applied at once
+    :param prefetch: maximum number of batches being fetched or waiting to be applied
+    :param operation: name of the operation for the batch metrics, e.g. assign_cluster_label
+    :param checkpoint: optional checkpoint of the job, told when each batch succeeds. Failed batches hold the cursor
+    back, so a resumed job retries them. If a shutdown is requested no more batches are started and JobInterrupted
+    is raised once the batches in flight are done
+    :return: summary of the run with errors ordered by batch index
+    """
+    start = time.perf_counter()
+    fetched: asyncio.Queue = asyncio.Queue(maxsize=max(1, prefetch))
+    summary = BatchSummary(name=name)
+    errors = []
+
+    fetch_slots = asyncio.Semaphore(max(1, prefetch))
+    fetch_tasks = set()
+    interrupted = False
+
+    def done(index: int):
+        if checkpoint is not None:
+            checkpoint.done(index)
+
+    async def fetch_one(index: int, batch: Any):
+        try:
+            try:
+                with BATCH_DURATION.labels(operation, "fetch").time():
+                    work = await fetch(index, batch)
+            except Exception as e:
+                BATCHES_FAILED.labels(operation, "fetch").inc()
+                err(f"{name}: failed to fetch batch {index}. Error: {e}")
+                errors.append(BatchError(index=index, stage="fetch", message=str(e)))
+                report_progress(error=f"batch {index}: {e}", failed_batches=1)
+                return
+            await fetched.put((index, work))
+        finally:
+            fetch_slots.release()
+
+    async def fetch_all():
+        nonlocal interrupted
+        try:
+            index = 0
+            async for batch in _aiter(batches):
+                if checkpoint is not None and drain_requested():
+                    interrupted = True
+                    break
+                await fetch_slots.acquire()
+                summary.batches += 1
+                task = asyncio.create_task(fetch_one(index, batch))
+                fetch_tasks.add(task)
+                task.add_done_callback(fetch_tasks.discard)
+                index += 1
+        finally:
+            await asyncio.gather(*fetch_tasks, return_exceptions=True)
+            for _ in range(max(1, concurrency)):
+                await fetched.put(_DONE)
+
+    async def apply_all():
+        while True:
+            item = await fetched.get()
+            if item is _DONE:
+                return
+            index, work = item
+            try:
+                with BATCH_DURATION.labels(operation, "apply").time():
+                    items = await apply(index, work)
+                BATCH_SIZE.labels(operation).observe(items)
+                summary.items += items
+                report_progress(items=items, batches=1)
+                done(index)
+            except Exception as e:
+                BATCHES_FAILED.labels(operation, "apply").inc()
+                err(f"{name}: failed to apply batch {index}. Error: {e}")
+                errors.append(BatchError(index=index, stage="apply", message=str(e)))
+                report_progress(error=f"batch {index}: {e}", failed_batches=1)
+
+    await asyncio.gather(fetch_all(), *(apply_all() for _ in range(max(1, concurrency))))
+
+    if interrupted:
+        info(f"{name}: stopped after {summary.batches} batches for a shutdown")
+        raise JobInterrupted(name)
+
+    summary.errors = sorted(errors, key=lambda e: e.index)
+    summary.failed = len({e.index for e in errors})
+    summary.succeeded = summary.batches - summary.failed
+    summary.elapsed_s = round(time.perf_counter() - start, 3)
+    info(f"{name}: {summary.items} items in {summary.batches} batches, {summary.failed} failed, {summary.elapsed_s} s")
+    return summary
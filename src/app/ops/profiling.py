@@ -0,0 +1,159 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/profiling.py
+# Description: opt-in sampling profiles and allocation summaries of single requests and the jobs they queue
+
+import hmac
+import re
+import threading
+import tracemalloc
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List
+
+from app.conf import temp_path, profile_token, profile_interval_s, profile_top_n
+from app.logger import info, err
+
+PROFILE_HEADER = "x-profile"
+PROFILE_ID_HEADER = "x-profile-id"
+profile_dir = Path(temp_path) / "profiles"
+
+# Id of the profile of the current request, set by ProfilingMiddleware. Jobs queued by the request are profiled too,
+# see redis_process.submit_job
+current_profile: ContextVar[str | None] = ContextVar("current_profile", default=None)
+
+_PROFILE_NAME = re.compile(r"^[0-9a-f]{32}(-job)?\.(speedscope\.json|allocations\.txt)$")
+
+# tracemalloc is process wide, so it runs while any profile is open
+_tracing = 0
+_tracing_lock = threading.Lock()
+
+
+def profiling_enabled() -> bool:
+    return bool(profile_token)
+
+
+def profile_allowed(token: str | None) -> bool:
+    """
+    True if token matches the profiling token. Always False when no profiling token is configured.
+    """
+    return bool(profile_token) and token is not None and hmac.compare_digest(token.encode(), profile_token.encode())
+
+
+def profile_path(name: str) -> Path | None:
+    """
+    Path of a stored profile file, or None if the name is not one written by Profile
+    """
+    return profile_dir / name if _PROFILE_NAME.match(name) else None
+
+
+def _start_tracing():
+    global _tracing
+    with _tracing_lock:
+        if _tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing += 1
+
+
+def _stop_tracing():
+    global _tracing
+    with _tracing_lock:
+        _tracing -= 1
+        if _tracing == 0:
+            tracemalloc.stop()
+
+
+class Profile:
+    """
+    Samples the call stacks of the code run inside the block with pyinstrument, if installed, and traces allocations.
+    On exit writes <id>.speedscope.json, to open in https://www.speedscope.app, and <id>.allocations.txt with the
+    profile_top_n lines that allocated the most memory. Allocations of other requests running at the same time
+    are included, as tracemalloc traces the whole process.
+    """
+
+    def __init__(self, profile_id: str, async_mode: str = "enabled"):
+        """
+        :param profile_id: id of the profile, the prefix of its files
+        :param async_mode: pyinstrument async mode, "enabled" to only sample the current task or "disabled" for the thread
+        """
+        self.profile_id = profile_id
+        self.async_mode = async_mode
+        self.profiler = None
+        self.files: List[str] = []
+
+    def __enter__(self) -> "Profile":
+        try:
+            from pyinstrument import Profiler
+            self.profiler = Profiler(interval=profile_interval_s, async_mode=self.async_mode)
+        except ImportError:
+            err("Profiling call stacks requires pyinstrument, install it with pip install pyinstrument")
+        _start_tracing()
+        self._before = tracemalloc.take_snapshot()
+        if self.profiler is not None:
+            self.profiler.start()
+        return self
+
+    def __exit__(self, *exc: Any):
+        if self.profiler is not None:
+            self.profiler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _stop_tracing()
+        try:
+            profile_dir.mkdir(parents=True, exist_ok=True)
+            if self.profiler is not None:
+                from pyinstrument.renderers import SpeedscopeRenderer
+                name = f"{self.profile_id}.speedscope.json"
+                (profile_dir / name).write_text(self.profiler.output(renderer=SpeedscopeRenderer()))
+                self.files.append(name)
+            name = f"{self.profile_id}.allocations.txt"
+            (profile_dir / name).write_text(self._allocations(snapshot))
+            self.files.append(name)
+            info(f"Stored profile {self.profile_id} in {profile_dir}")
+        except Exception as e:
+            err(f"Failed to store profile {self.profile_id}. Error: {e}")
+
+    def _allocations(self, snapshot: tracemalloc.Snapshot) -> str:
+        stats = snapshot.compare_to(self._before, "lineno")
+        total = sum(s.size_diff for s in stats)
+        lines = [f"Allocations of profile {self.profile_id}: {total / 1024:.1f} KiB net, "
+                 f"top {profile_top_n} lines by size"]
+        for stat in stats[:profile_top_n]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size_diff / 1024:10.1f} KiB {stat.count_diff:8} blocks  {frame.filename}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles requests sending the profiling token in the X-Profile header. The response gets an
+    X-Profile-Id header with the id to fetch the files from /profiles. Only installed when a token is configured.
+    It wraps the app directly, not through call_next, so the endpoint runs in the profiled task.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = next((v.decode() for k, v in scope.get("headers", []) if k == PROFILE_HEADER.encode()), None)
+        if token is None:
+            return await self.app(scope, receive, send)
+        if not profile_allowed(token):
+            info(f"Ignoring a profiling request with an invalid token for {scope.get('path')}")
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message: Dict[str, Any]):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (PROFILE_ID_HEADER.encode(), profile_id.encode())]}
+            await send(message)
+
+        reset_token = current_profile.set(profile_id)
+        try:
+            with Profile(profile_id):
+                await self.app(scope, receive, send_with_id)
+        finally:
+            current_profile.reset(reset_token)
@@ -0,0 +1,55 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/progress.py
+# Description: progress reporting from bulk operations to the job that runs them
+
+import time
+from contextvars import ContextVar
+from typing import Dict
+
+from rq.job import Job
+
+# Job running the current bulk operation, or None when an operation is run directly
+current_job: ContextVar[Job | None] = ContextVar("current_job", default=None)
+
+# Number of errors kept in a job's status
+MAX_JOB_ERRORS = 100
+
+# Minimum time between two saves of a job's progress to Redis, in seconds. Each save is a blocking round trip
+PROGRESS_SAVE_INTERVAL_S = 1.0
+
+# Last time the progress of each running job was saved, time.monotonic() values by job id
+_saved_at: Dict[str, float] = {}
+
+
+def report_progress(error: str | None = None, **counts: int):
+    """
+    Add to the progress counters of the current job, e.g. report_progress(localizations=100, batches=1).
+    The counters are saved at most every PROGRESS_SAVE_INTERVAL_S seconds, see flush_progress.
+    Does nothing when no job is running.
+    :param error: optional error message to record
+    :param counts: counters to increment
+    """
+    job = current_job.get()
+    if job is None:
+        return
+
+    progress = job.meta.setdefault("progress", {})
+    for name, count in counts.items():
+        progress[name] = progress.get(name, 0) + count
+    if error is not None:
+        errors = job.meta.setdefault("errors", [])
+        errors.append(error)
+        del errors[:-MAX_JOB_ERRORS]
+    now = time.monotonic()
+    if now - _saved_at.get(job.id, 0.) >= PROGRESS_SAVE_INTERVAL_S:
+        _saved_at[job.id] = now
+        job.save_meta()
+
+
+def flush_progress(job: Job):
+    """
+    Save the progress of a job that stopped running, including the counters not saved yet by report_progress
+    :param job: the job
+    """
+    _saved_at.pop(job.id, None)
+    job.save_meta()
@@ -0,0 +1,159 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/projects.py
+# Description: registry of tator projects with caches of resolved project specifications and versions
+
+import asyncio
+import time
+from typing import Dict, List, Tuple
+
+import tator
+
+from app.conf import project_spec_ttl_s, project_refresh_interval_s, version_ttl_s
+from app.logger import info, debug, exception
+from app.ops.executor import run_sdk
+from app.ops.models import ProjectSpec
+
+
+class ProjectRegistry:
+    """
+    Index of tator projects by name, a TTL cache of their ProjectSpec, and a TTL cache of each project's
+    version name to id map. The project list is refreshed periodically by refresh_loop so projects
+    created after startup become visible.
+    """
+
+    # Minimum time between refreshes forced by a lookup of an unknown project or version name
+    min_forced_refresh_s = 5.0
+
+    def __init__(self, spec_ttl_s: float = project_spec_ttl_s, refresh_interval_s: float = project_refresh_interval_s,
+                 version_ttl_s: float = version_ttl_s):
+        self.spec_ttl_s = spec_ttl_s
+        self.refresh_interval_s = refresh_interval_s
+        self.version_ttl_s = version_ttl_s
+        self._projects: Dict[str, tator.models.Project] = {}
+        self._specs: Dict[str, Tuple[float, ProjectSpec]] = {}
+        self._versions: Dict[int, Tuple[float, Dict[str, int]]] = {}
+        self._last_refresh = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def projects(self) -> List[tator.models.Project]:
+        return list(self._projects.values())
+
+    def set_projects(self, projects: List[tator.models.Project]):
+        """
+        Replace the project index. Cached specs for projects that were removed or whose id changed are dropped.
+        :param projects: list of projects from tator
+        """
+        index = {p.name: p for p in projects}
+        for name in list(self._specs):
+            if name not in index or index[name].id != self._specs[name][1].project_id:
+                self.invalidate(name)
+        self._projects = index
+        self._last_refresh = time.monotonic()
+
+    async def refresh(self, api: tator.api) -> List[tator.models.Project]:
+        """
+        Fetch the project list from tator and update the index
+        :param api: The Tator API object
+        :return: List of projects
+        """
+        async with self._lock:
+            info("Fetching projects from tator")
+            projects = await run_sdk(api.get_project_list)
+            info(f"Found {len(projects)} projects")
+            self.set_projects(projects)
+            return projects
+
+    async def get_project(self, api: tator.api, project_name: str) -> tator.models.Project | None:
+        """
+        Look up a project by name, refreshing the project list once if the name is not known
+        :param api: The Tator API object
+        :param project_name: The name of the project
+        :return: The project or None if not found
+        """
+        project = self._projects.get(project_name)
+        if project is None and time.monotonic() - self._last_refresh > self.min_forced_refresh_s:
+            debug("Project %s not in registry, refreshing project list", project_name)
+            await self.refresh(api)
+            project = self._projects.get(project_name)
+        return project
+
+    def get_spec(self, project_name: str) -> ProjectSpec | None:
+        """
+        Get a cached project spec, or None if not cached or expired
+        """
+        cached = self._specs.get(project_name)
+        if cached is None:
+            return None
+        created, spec = cached
+        if time.monotonic() - created > self.spec_ttl_s:
+            del self._specs[project_name]
+            return None
+        return spec
+
+    def put_spec(self, spec: ProjectSpec):
+        self._specs[spec.project_name] = (time.monotonic(), spec)
+
+    def invalidate(self, project_name: str | None = None):
+        """
+        Drop the cached spec and versions for a project, or for all projects if no name is given
+        """
+        if project_name is None:
+            self._specs.clear()
+            self._versions.clear()
+        else:
+            cached = self._specs.pop(project_name, None)
+            if cached is not None:
+                self._versions.pop(cached[1].project_id, None)
+
+    async def refresh_versions(self, api: tator.api, project_id: int) -> Dict[str, int]:
+        """
+        Fetch the versions for a project from tator and cache the name to id map
+        :param api: The Tator API object
+        :param project_id: The project id
+        :return: The version name to id map
+        """
+        versions = await run_sdk(api.get_version_list, project_id)
+        version_map = {v.name: v.id for v in versions}
+        debug("Found %s versions in project %s", len(version_map), project_id)
+        self._versions[project_id] = (time.monotonic(), version_map)
+        return version_map
+
+    async def get_version_id(self, api: tator.api, project_id: int, version_name: str) -> int | None:
+        """
+        Look up a version id by name. The version map is refreshed when it has expired, and once more
+        on a miss in case the version was created since the map was cached.
+        :param api: The Tator API object
+        :param project_id: The project id to search for the version in
+        :param version_name: The name of the version
+        :return: The version id or None if not found
+        """
+        if not version_name:
+            return None
+
+        cached = self._versions.get(project_id)
+        now = time.monotonic()
+        if cached is None or now - cached[0] > self.version_ttl_s:
+            return (await self.refresh_versions(api, project_id)).get(version_name)
+
+        created, version_map = cached
+        version_id = version_map.get(version_name)
+        if version_id is None and now - created > self.min_forced_refresh_s:
+            version_id = (await self.refresh_versions(api, project_id)).get(version_name)
+        return version_id
+
+    async def refresh_loop(self, api: tator.api):
+        """
+        Refresh the project list every refresh_interval_s seconds until cancelled
+        """
+        while True:
+            await asyncio.sleep(self.refresh_interval_s)
+            try:
+                await self.refresh(api)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                exception(f"Failed to refresh projects. Error: {e}")
+
+
+registry = ProjectRegistry()
@@ -0,0 +1,359 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/queries.py
+# Description: direct queries against the tator database that resolve localizations without the REST API
+
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from app.conf import db_password, sql_resolve, loc_chunk_size, export_fetch_size, export_statement_timeout_ms
+from app.logger import debug, err
+from app.ops.db import fetch_all, stream_rows
+from app.ops.models import CountEstimate, DryRunEstimate, FilterType, ProjectSpec
+
+
+def sql_resolve_enabled() -> bool:
+    """
+    True if localizations should be resolved with direct database queries, which requires database credentials
+    """
+    return sql_resolve and db_password is not None
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _quote(name: str) -> str:
+    return "'" + name.replace("'", "''") + "'"
+
+
+def _localization_filter(
+        spec: ProjectSpec,
+        version_id: int | None = None,
+        attributes: Dict[str, str] | None = None,
+        attributes_lt: Dict[str, float] | None = None,
+        media_name: str | None = None,
+        filter_media: FilterType = FilterType.Equals,
+) -> Tuple[List[str], List[Any]]:
+    """
+    WHERE conditions and parameters that select the localizations of a project's box type.
+    Only the latest mark, i.e. version, of each localization is selected, as the REST API does by default.
+    Conditions on the media name refer to the media joined as m.
+    :param spec: project specifications
+    :param version_id: optional version id to restrict the localizations to
+    :param attributes: attribute values the localizations must equal, e.g. {"cluster": "C1", "verified": "false"}
+    :param attributes_lt: attribute values the localizations must be less than, e.g. {"saliency": 1000}
+    :param media_name: optional media name to restrict the localizations to
+    :param filter_media: match the media name exactly (Equals) or as a substring (Includes)
+    :return: conditions and their parameters
+    """
+    conditions = [
+        "l.project = %s",
+        "l.type = %s",
+        "NOT l.deleted",
+        "l.mark = l.latest_mark",
+    ]
+    params: List[Any] = [spec.project_id, spec.box_type]
+    # Attribute names are inlined so the planner can use the expression indexes on the attributes
+    for name, value in (attributes or {}).items():
+        conditions.append(f"l.attributes->>{_quote(name)} = %s")
+        params.append(value)
+    for name, value in (attributes_lt or {}).items():
+        conditions.append(f"(l.attributes->>{_quote(name)})::float < %s")
+        params.append(float(value))
+    if version_id:
+        conditions.append("l.version = %s")
+        params.append(version_id)
+    if media_name:
+        if filter_media == FilterType.Includes:
+            conditions.append("m.name ILIKE %s")
+            params.append(f"%{_escape_like(media_name)}%")
+        else:
+            conditions.append("m.name = %s")
+            params.append(media_name)
+    return conditions, params
+
+
+async def estimate_localizations(
+        spec: ProjectSpec,
+        version_id: int | None = None,
+        attributes: Dict[str, str] | None = None,
+        attributes_lt: Dict[str, float] | None = None,
+        media_name: str | None = None,
+        filter_media: FilterType = FilterType.Equals,
+) -> DryRunEstimate | None:
+    """
+    Count the localizations that match a filter, and the media they are in, with one grouped query.
+    The counts are split by verified state and by media type.
+    :param spec: project specifications
+    :param version_id: optional version id to restrict the localizations to
+    :param attributes: attribute values the localizations must equal
+    :param attributes_lt: attribute values the localizations must be less than
+    :param media_name: optional media name to restrict the localizations to
+    :param filter_media: match the media name exactly (Equals) or as a substring (Includes)
+    :return: the counts or None if the database could not be queried
+    """
+    conditions, params = _localization_filter(spec, version_id, attributes, attributes_lt, media_name, filter_media)
+    query = f"""
+        SELECT media_type, verified, GROUPING(media_type), GROUPING(verified), COUNT(*), COUNT(DISTINCT media)
+        FROM (
+            SELECT m.type AS media_type, l.attributes->>'verified' AS verified, l.media AS media
+            FROM public.main_localization l
+            JOIN public.main_media m ON m.id = l.media
+            WHERE NOT m.deleted AND {" AND ".join(conditions)}
+        ) f
+        GROUP BY GROUPING SETS ((media_type), (verified), ());
+        """
+
+    try:
+        rows = await fetch_all(query, params, name="dry_run_estimate", project=spec.project_id)
+    except Exception as e:
+        err(f"Failed to estimate localizations in project {spec.project_name} from the database. Error: {e}")
+        return None
+
+    estimate = DryRunEstimate()
+    media_types = {spec.image_type: "image", spec.video_type: "video"}
+    for media_type, verified, no_type, no_verified, num_locs, num_media in rows:
+        counts = CountEstimate(localizations=num_locs, media=num_media)
+        if no_type and no_verified:
+            estimate.total = counts
+        elif no_verified and media_type in media_types:
+            setattr(estimate, media_types[media_type], counts)
+        elif no_type and verified == "true":
+            estimate.verified = counts
+        elif no_type and verified == "false":
+            estimate.unverified = counts
+    debug("Estimated %s in project %s", estimate, spec.project_name)
+    return estimate
+
+
+async def iter_cluster_localization_ids(
+        spec: ProjectSpec,
+        cluster_name: str,
+        version_id: int | None = None,
+        media_name: str | None = None,
+        filter_media: FilterType = FilterType.Equals,
+        chunk_size: int = loc_chunk_size,
+        position: Dict[str, Any] | None = None,
+) -> AsyncIterator[List[int]]:
+    """
+    Stream the ids of the localizations in a cluster in chunks, paged by id
+    :param spec: project specifications
+    :param cluster_name: the cluster name
+    :param version_id: optional version id to restrict the localizations to
+    :param media_name: optional media name to restrict the localizations to
+    :param filter_media: match the media name exactly (Equals) or as a substring (Includes)
+    :param chunk_size: number of ids in each chunk
+    :param position: optional {"after"} localization id to resume after, updated to the last id of each chunk
+    before it is yielded
+    :return: async iterator of lists of localization ids
+    """
+    conditions, params = _localization_filter(spec, version_id, {"cluster": cluster_name}, media_name=media_name,
+                                              filter_media=filter_media)
+    joins = "JOIN public.main_media m ON m.id = l.media" if media_name else ""
+    conditions.append("l.id > %s")
+
+    query = f"""
+        SELECT l.id
+        FROM public.main_localization l
+        {joins}
+        WHERE {" AND ".join(conditions)}
+        ORDER BY l.id
+        LIMIT %s;
+        """
+
+    last_id = position.get("after", 0) if position else 0
+    num_found = 0
+    while True:
+        rows = await fetch_all(query, (*params, last_id, chunk_size), name="cluster_localization_ids", project=spec.project_id)
+        if len(rows) == 0:
+            break
+        ids = [r[0] for r in rows]
+        num_found += len(ids)
+        last_id = ids[-1]
+        if position is not None:
+            position["after"] = last_id
+        yield ids
+        if len(ids) < chunk_size:
+            break
+
+    debug("Resolved %s localizations in cluster %s in project %s", num_found, cluster_name, spec.project_name)
+
+
+async def get_existing_localization_ids(spec: ProjectSpec, ids: List[int]) -> set:
+    """
+    The ids of the localizations of a project that exist and are not deleted
+    :param spec: project specifications
+    :param ids: localization ids to check
+    :return: set of existing ids
+    """
+    query = """
+        SELECT id
+        FROM public.main_localization
+        WHERE project = %s AND id = ANY(%s) AND NOT deleted;
+        """
+    rows = await fetch_all(query, (spec.project_id, list(ids)), name="existing_localization_ids", project=spec.project_id)
+    return {r[0] for r in rows}
+
+
+async def get_media_localization_counts(spec: ProjectSpec, media_ids: List[int]) -> Dict[int, int]:
+    """
+    Count the localizations of the project's box type in each media with one grouped query
+    :param spec: project specifications
+    :param media_ids: the media ids
+    :return: number of localizations by media id, media without localizations are left out
+    """
+    query = """
+        SELECT l.media, COUNT(*)
+        FROM public.main_localization l
+        WHERE l.project = %s AND l.type = %s AND l.media = ANY(%s) AND NOT l.deleted AND l.mark = l.latest_mark
+        GROUP BY 1;
+        """
+    rows = await fetch_all(query, (spec.project_id, spec.box_type, list(media_ids)), name="media_localization_counts", project=spec.project_id)
+    return {media_id: count for media_id, count in rows}
+
+
+def _cluster_conditions(spec: ProjectSpec, cluster_names: List[str], version_id: int | None) -> Tuple[List[str], List[Any]]:
+    conditions, params = _localization_filter(spec, version_id)
+    conditions.append("l.attributes->>'cluster' = ANY(%s)")
+    params.append(list(cluster_names))
+    return conditions, params
+
+
+async def count_cluster_localizations(spec: ProjectSpec, cluster_names: List[str], version_id: int | None = None) -> Dict[str, int]:
+    """
+    Count the localizations in each of many clusters with one grouped query
+    :param spec: project specifications
+    :param cluster_names: the cluster names
+    :param version_id: optional version id to restrict the localizations to
+    :return: number of localizations by cluster name, clusters without localizations are left out
+    """
+    conditions, params = _cluster_conditions(spec, cluster_names, version_id)
+    query = f"""
+        SELECT l.attributes->>'cluster', COUNT(*)
+        FROM public.main_localization l
+        WHERE {" AND ".join(conditions)}
+        GROUP BY 1;
+        """
+    rows = await fetch_all(query, params, name="count_cluster_localizations", project=spec.project_id)
+    return {cluster: count for cluster, count in rows}
+
+
+async def iter_clusters_localization_ids(
+        spec: ProjectSpec,
+        cluster_names: List[str],
+        version_id: int | None = None,
+        chunk_size: int = loc_chunk_size,
+        position: Dict[str, Any] | None = None,
+) -> AsyncIterator[List[Tuple[int, str]]]:
+    """
+    Stream the ids and cluster names of the localizations in many clusters in one pass, paged by id
+    :param spec: project specifications
+    :param cluster_names: the cluster names
+    :param version_id: optional version id to restrict the localizations to
+    :param chunk_size: number of localizations in each chunk
+    :param position: optional {"after"} localization id to resume after, updated to the last id of each chunk
+    before it is yielded
+    :return: async iterator of lists of (localization id, cluster name)
+    """
+    conditions, params = _cluster_conditions(spec, cluster_names, version_id)
+    conditions.append("l.id > %s")
+
+    query = f"""
+        SELECT l.id, l.attributes->>'cluster'
+        FROM public.main_localization l
+        WHERE {" AND ".join(conditions)}
+        ORDER BY l.id
+        LIMIT %s;
+        """
+
+    last_id = position.get("after", 0) if position else 0
+    num_found = 0
+    while True:
+        rows = await fetch_all(query, (*params, last_id, chunk_size), name="clusters_localization_ids", project=spec.project_id)
+        if len(rows) == 0:
+            break
+        num_found += len(rows)
+        last_id = rows[-1][0]
+        if position is not None:
+            position["after"] = last_id
+        yield [(r[0], r[1]) for r in rows]
+        if len(rows) < chunk_size:
+            break
+
+    debug("Resolved %s localizations in %s clusters in project %s", num_found, len(cluster_names), spec.project_name)
+
+
+def _export_filter(
+        spec: ProjectSpec,
+        version_id: int | None = None,
+        label_name: str | None = None,
+        cluster_name: str | None = None,
+        verified: bool | None = None,
+) -> Tuple[str, List[Any]]:
+    """
+    FROM and WHERE clauses that select the labeled localizations to export, joined to their media as m
+    """
+    attributes = {}
+    if label_name:
+        attributes["Label"] = label_name
+    if cluster_name:
+        attributes["cluster"] = cluster_name
+    if verified is not None:
+        attributes["verified"] = "true" if verified else "false"
+    conditions, params = _localization_filter(spec, version_id, attributes)
+    conditions.extend(["l.attributes ? 'Label'", "NOT m.deleted"])
+    clauses = f"""
+        FROM public.main_localization l
+        JOIN public.main_media m ON m.id = l.media
+        WHERE {" AND ".join(conditions)}
+        """
+    return clauses, params
+
+
+async def get_export_labels(spec: ProjectSpec, **filters) -> List[str]:
+    """
+    Sorted labels of the localizations to export
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters, see _export_filter
+    :return: list of labels
+    """
+    clauses, params = _export_filter(spec, **filters)
+    query = f"SELECT DISTINCT l.attributes->>'Label' {clauses} ORDER BY 1;"
+    rows = await fetch_all(query, params, timeout_ms=export_statement_timeout_ms, name="export_labels", project=spec.project_id)
+    return [r[0] for r in rows]
+
+
+def iter_export_images(spec: ProjectSpec, **filters) -> AsyncIterator[tuple]:
+    """
+    Stream the media frames that hold localizations to export, ordered by media and frame
+    :param spec: project specifications
+    :param filters: version_id, label_name, cluster_name and verified filters, see _export_filter
+    :return: async iterator of (media id, frame, media name, media type, media width, media height)
+    """
+    clauses, params = _export_filter(spec, **filters)
+    query = f"""
+        SELECT DISTINCT l.media, l.frame, m.name, m.type, m.width, m.height
+        {clauses}
+        ORDER BY l.media, l.frame;
+        """
+    return stream_rows(query, params, fetch_size=export_fetch_size, timeout_ms=export_statement_timeout_ms,
+                       name="export_images", project=spec.project_id)
+
+
+def iter_export_localizations(spec: ProjectSpec, by_media: bool = False, **filters) -> AsyncIterator[tuple]:
+    """
+    Stream the localizations to export with their media
+    :param spec: project specifications
+    :param by_media: order by media and frame instead of by localization id
+    :param filters: version_id, label_name, cluster_name and verified filters, see _export_filter
+    :return: async iterator of (id, media id, frame, media name, media type, media width, media height,
+        x, y, width, height, attributes), with the box in coordinates normalized to the media size
+    """
+    clauses, params = _export_filter(spec, **filters)
+    order = "l.media, l.frame, l.id" if by_media else "l.id"
+    query = f"""
+        SELECT l.id, l.media, l.frame, m.name, m.type, m.width, m.height, l.x, l.y, l.width, l.height, l.attributes
+        {clauses}
+        ORDER BY {order};
+        """
+    return stream_rows(query, params, fetch_size=export_fetch_size, timeout_ms=export_statement_timeout_ms,
+                       name="export_localizations", project=spec.project_id)
@@ -1,28 +1,295 @@
 # fastapi-tator, Apache-2.0 license
-# Filename: app/redis_process.py
-# Description: Run Redis process tasks
+# Filename: app/ops/redis_process.py
+# Description: durable queue of bulk operations backed by Redis
+
+import asyncio
+import contextvars
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Any
 
 import redis
+import tator
+from pydantic import BaseModel
 from rq import Queue
+from rq.exceptions import InvalidJobOperation, NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry
 
-import time
-from datetime import datetime
-
+from app.conf import redis_url, job_queue_name, job_timeout_s, job_result_ttl_s, job_drain_timeout_s
+from app.logger import info, debug, exception, err
+from app.ops.checkpoints import DONE, JobInterrupted, job_checkpoint, request_drain, store
+from app.ops.dedup import job_key, claim_job_key, release_job_key
+from app.ops.metrics import JOBS_QUEUED, JOBS_IN_FLIGHT
+from app.ops.profiling import Profile, current_profile
+from app.ops.progress import current_job
 import app.ops.worker as worker_tasks
-from app.ops.models import SDCATModel
 
-# Set up Redis connection
-redis_conn = redis.Redis(host='localhost', port=6379, db=0)
+# Seconds a worker holds its claim to resubmit an unfinished job, see resume_jobs
+RESUME_CLAIM_S = 60
+
+_redis_conn: redis.Redis | None = None
+_local_tasks = set()
+
+
+def local_mode() -> bool:
+    """
+    True if jobs run inside the web process because no Redis server is configured. Jobs are then not durable.
+    """
+    return not redis_url
+
+
+def get_redis() -> redis.Redis:
+    """
+    Get the Redis connection for the job queue. Uses an in-process Redis stand-in if no Redis server is configured
+    or FASTAPI_TATOR_REDIS_URL is fakeredis://
+    """
+    global _redis_conn
+    if _redis_conn is None:
+        if local_mode() or redis_url.startswith("fakeredis://"):
+            import fakeredis
+            info("Using an in-process job queue. Jobs will not survive a restart")
+            _redis_conn = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        else:
+            info(f"Using the job queue at {redis_url}")
+            _redis_conn = redis.Redis.from_url(redis_url)
+    return _redis_conn
+
+
+def get_queue() -> Queue:
+    return Queue(name=job_queue_name, connection=get_redis())
+
+
+async def _run_local(job: Job, api: tator.api, payload: dict):
+    """
+    Run a job on the event loop of the web process, recording its status like a queue worker would
+    """
+    token = current_job.set(job)
+    job.meta.pop("interrupted", None)
+    job.started_at = datetime.now(timezone.utc)
+    job.set_status(JobStatus.STARTED)
+    job.save()
+    profile_id = job.meta.get("profile_id")
+    try:
+        with Profile(profile_id) if profile_id else nullcontext(), job_checkpoint(job.id, payload):
+            job.meta["summary"] = await worker_tasks.execute_job(api=api, **payload)
+        job.save_meta()
+        status = JobStatus.FINISHED
+    except JobInterrupted:
+        job.meta["interrupted"] = True
+        job.save_meta()
+        status = JobStatus.STOPPED
+    except Exception as e:
+        exception(f"Job {job.id} failed. Error: {e}")
+        errors = job.meta.setdefault("errors", [])
+        # Operations may have reported the error already, see deletions.py
+        if not errors or str(e) not in errors[-1]:
+            errors.append(str(e))
+        job.save_meta()
+        status = JobStatus.FAILED
+    finally:
+        current_job.reset(token)
+    job.ended_at = datetime.now(timezone.utc)
+    job.set_status(status)
+    job.save()
+    if status != JobStatus.STOPPED:
+        release_job_key(job, status == JobStatus.FINISHED, job.meta.get("summary"))
+
+
+def _create_job(queue: Queue, payload: dict, job_id: str | None = None) -> Job:
+    operation = payload["operation"]
+    project_name = payload["model"].get("project_name")
+    return queue.create_job(
+        worker_tasks.run_job,
+        kwargs=payload,
+        job_id=job_id,
+        timeout=job_timeout_s,
+        result_ttl=job_result_ttl_s,
+        failure_ttl=job_result_ttl_s,
+        description=f"{operation} {project_name}",
+        meta={"operation": operation, "project_name": project_name, "progress": {}, "errors": [],
+              "dedup_key": job_key(payload)},
+    )
+
+
+def _start_local(job: Job, api: tator.api, payload: dict):
+    job.enqueued_at = datetime.now(timezone.utc)
+    job.save()
+    # A fresh context, so the job does not inherit the request's, e.g. a running profiler
+    task = asyncio.create_task(_run_local(job, api, payload), context=contextvars.Context())
+    _local_tasks.add(task)
+    task.add_done_callback(_local_tasks.discard)
+
+
+async def submit_job(api: tator.api, operation: str, model: BaseModel, label: str | None = None, **kwargs: Any) -> str:
+    """
+    Queue a bulk operation. With a Redis server configured the job is consumed by the worker pool,
+    see app/ops/worker.py, otherwise it runs in the background of the web process.
+    A request identical to a queued, running or just finished job attaches to that job, see app/ops/dedup.py.
+    :param api: tator api, used when the job runs in the web process
+    :param operation: name of the operation in worker.OPERATIONS
+    :param model: the request model with the criteria for the operation
+    :param label: optional label for relabel operations
+    :param kwargs: additional keyword arguments for the operation, e.g. localization filters
+    :return: the job id, of the existing job if the request is a duplicate
+    """
+    payload = {
+        "operation": operation,
+        "model_type": type(model).__name__,
+        "model": model.model_dump(mode="json"),
+        "label": label,
+        "kwargs": kwargs,
+    }
+    queue = get_queue()
+    job = _create_job(queue, payload)
+
+    existing = await asyncio.to_thread(claim_job_key, queue.connection, job.meta["dedup_key"], job.id)
+    if existing is not None:
+        return existing
+    if current_profile.get() is not None:
+        # Profile the job of a profiled request, see app/ops/profiling.py
+        job.meta["profile_id"] = f"{current_profile.get()}-job"
+
+    if local_mode():
+        _start_local(job, api, payload)
+    else:
+        await asyncio.to_thread(queue.enqueue_job, job)
+
+    info(f"Queued job {job.id} {operation} in project {model.project_name}")
+    return job.id
+
+
+async def resume_jobs(api: tator.api | None = None) -> int:
+    """
+    Resubmit the jobs that were running or interrupted when the service last stopped, keeping their job ids.
+    They resume from their checkpoints, see app/ops/checkpoints.py. Without a Redis server they run in this process,
+    otherwise jobs that failed or are missing from Redis are queued again and queued or running jobs are left alone.
+    Workers share the checkpoints, so each job is claimed in Redis first and only the worker holding the claim
+    resubmits it.
+    :param api: tator api, used when the jobs run in the web process
+    :return: the number of jobs resubmitted
+    """
+    try:
+        unfinished = await asyncio.to_thread(store.unfinished)
+    except Exception as e:
+        err(f"Failed to read the job checkpoints. Error: {e}")
+        return 0
+
+    queue = get_queue()
+    if not local_mode():
+        # Move the jobs of workers that died to the failed registry
+        await asyncio.to_thread(StartedJobRegistry(queue=queue).cleanup)
+
+    resumed = 0
+    for job_id, payload in unfinished:
+        if local_mode():
+            _start_local(_create_job(queue, payload, job_id), api, payload)
+        else:
+            try:
+                job = await asyncio.to_thread(Job.fetch, job_id, connection=get_redis())
+                status = job.get_status()
+            except NoSuchJobError:
+                job, status = _create_job(queue, payload, job_id), None
+            if status == JobStatus.FINISHED:
+                store.finish(job_id, DONE)
+                continue
+            if status not in (None, JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+                continue
+            claimed = await asyncio.to_thread(get_redis().set, f"{job_queue_name}:resume:{job_id}", "1",
+                                              nx=True, ex=RESUME_CLAIM_S)
+            if not claimed:
+                debug("Job %s is being resubmitted by another worker", job_id)
+                continue
+            try:
+                # Failed jobs are moved out of the failed registry
+                await asyncio.to_thread(job.requeue)
+            except InvalidJobOperation:
+                if status == JobStatus.FAILED:
+                    # Already moved out of the failed registry, i.e. requeued by another worker
+                    debug("Job %s already left the failed registry", job_id)
+                    continue
+                await asyncio.to_thread(queue.enqueue_job, job)
+        info(f"Resubmitted job {job_id} {payload['operation']}")
+        resumed += 1
+    return resumed
+
+
+async def drain_local_jobs(timeout_s: float = job_drain_timeout_s):
+    """
+    Ask the jobs running in the web process to checkpoint and stop, waiting up to timeout_s seconds for them
+    """
+    if not local_mode():
+        return
+    request_drain()
+    if _local_tasks:
+        info(f"Waiting up to {timeout_s} s for {len(_local_tasks)} jobs to checkpoint")
+        await asyncio.wait(list(_local_tasks), timeout=timeout_s)
+
+
+def queued_jobs() -> float:
+    """
+    Number of jobs waiting in the queue, for the job metrics
+    """
+    if local_mode():
+        return 0
+    try:
+        return get_queue().count
+    except redis.RedisError:
+        return float("nan")
+
+
+def in_flight_jobs() -> float:
+    """
+    Number of jobs being run by the workers, or by the web process if no Redis server is configured
+    """
+    if local_mode():
+        return len(_local_tasks)
+    try:
+        return StartedJobRegistry(queue=get_queue()).count
+    except redis.RedisError:
+        return float("nan")
+
+
+JOBS_QUEUED.set_function(queued_jobs)
+JOBS_IN_FLIGHT.set_function(in_flight_jobs)
+
+
+def _isoformat(dt: datetime | None) -> str | None:
+    return dt.isoformat() if dt else None
+
 
-# Check if the Redis connection is working
-redis_conn.ping()
+def get_job_status(job_id: str) -> dict | None:
+    """
+    Get the status, progress counters and errors of a job
+    :param job_id: the job id
+    :return: the job status or None if the job is not found
+    """
+    try:
+        job = Job.fetch(job_id, connection=get_redis())
+    except NoSuchJobError:
+        return None
 
-sdcat_task_processor_q = Queue(name='default', connection=redis_conn)
+    status = job.get_status()
+    errors = list(job.meta.get("errors", []))
+    summary = job.meta.get("summary")
+    if not local_mode():
+        result = job.latest_result()
+        if result is not None and result.type == result.Type.SUCCESSFUL:
+            summary = result.return_value
+        elif result is not None and result.type == result.Type.FAILED and result.exc_string:
+            errors.append(result.exc_string.strip().splitlines()[-1])
 
-def process_sdcat(sdcat_process_task: SDCATModel):
-    now = datetime.now()
-    timestamp = int(time.mktime(now.timetuple()))
-    sdcat_process_task.id = f"{sdcat_process_task.images}_{timestamp}"
-    job_ai = sdcat_task_processor_q.enqueue(worker_tasks.sdcat_detect, sdcat_process_task, result_ttl=-1)
-    return {"job_id": job_ai.get_id()}
-    # return {"AI Feedback Process Job Status": job_ai.get_status()}
\ No newline at end of file
+    return {
+        "job_id": job.id,
+        "operation": job.meta.get("operation"),
+        "project_name": job.meta.get("project_name"),
+        "status": status.value if status else None,
+        "enqueued_at": _isoformat(job.enqueued_at),
+        "started_at": _isoformat(job.started_at),
+        "ended_at": _isoformat(job.ended_at),
+        "progress": job.meta.get("progress", {}),
+        "errors": errors,
+        "summary": summary,
+        "profile_id": job.meta.get("profile_id"),
+        "trace": job.meta.get("trace"),
+    }
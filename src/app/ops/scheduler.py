@@ -0,0 +1,118 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/scheduler.py
+# Description: fair scheduling of upstream calls between projects, with interactive reads ahead of bulk operations
+
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict
+
+from app.ops.metrics import SCHEDULER_QUEUE_DEPTH, SCHEDULER_WAIT
+
+# Priority lanes, in the order they are served. Requests run in the interactive lane, e.g. dry runs and label counts,
+# and queued jobs in the bulk lane, see worker.execute_job
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+# Lane of the upstream calls made in the current context
+current_lane: ContextVar[str] = ContextVar("current_lane", default=INTERACTIVE)
+
+
+class FairScheduler:
+    """
+    Hands out capacity slots for upstream calls. Waiting calls are grouped by lane and project: the interactive lane
+    is always served first, and within a lane the projects with waiting calls take turns. A project holds at most
+    project_limit slots, and the bulk lane leaves reserved slots free so interactive calls do not wait behind bulk ones.
+    """
+
+    def __init__(self, capacity: int, project_limit: int, reserved: int = 0):
+        self.capacity = max(1, capacity)
+        self.project_limit = max(1, project_limit)
+        self.reserved = min(max(0, reserved), self.capacity - 1)
+        self.active = 0
+        self.active_by_project: Counter = Counter()
+        self._waiting: Dict[str, OrderedDict[str, Deque[asyncio.Future]]] = {lane: OrderedDict() for lane in LANES}
+
+    def depth(self, lane: str | None = None) -> int:
+        """
+        Number of calls waiting for a slot, in one lane or in all of them
+        """
+        lanes = [lane] if lane else LANES
+        return sum(len(waiters) for name in lanes for waiters in self._waiting[name].values())
+
+    def _can_run(self, project: str, lane: str) -> bool:
+        limit = self.capacity if lane == INTERACTIVE else self.capacity - self.reserved
+        return self.active < limit and self.active_by_project[project] < self.project_limit
+
+    def _dispatch(self):
+        while self.active < self.capacity:
+            for lane in LANES:
+                projects = self._waiting[lane]
+                project = next((p for p in projects if self._can_run(p, lane)), None)
+                if project is not None:
+                    break
+            else:
+                return
+            waiters = projects[project]
+            future = waiters.popleft()
+            if waiters:
+                # The project goes to the back of the turn order of its lane
+                projects.move_to_end(project)
+            else:
+                del projects[project]
+            SCHEDULER_QUEUE_DEPTH.labels(lane, project).dec()
+            self.active += 1
+            self.active_by_project[project] += 1
+            future.set_result(None)
+
+    def _remove(self, project: str, lane: str, future: asyncio.Future):
+        waiters = self._waiting[lane].get(project)
+        if waiters is not None and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiting[lane][project]
+            SCHEDULER_QUEUE_DEPTH.labels(lane, project).dec()
+
+    async def acquire(self, project: str, lane: str = INTERACTIVE):
+        """
+        Wait for a slot, see release
+        :param project: key of the project the call is for
+        :param lane: INTERACTIVE or BULK
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[lane].setdefault(project, deque()).append(future)
+        SCHEDULER_QUEUE_DEPTH.labels(lane, project).inc()
+        start = time.perf_counter()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(project)
+            else:
+                self._remove(project, lane, future)
+            raise
+        SCHEDULER_WAIT.labels(lane).observe(time.perf_counter() - start)
+
+    def release(self, project: str):
+        self.active -= 1
+        self.active_by_project[project] -= 1
+        if self.active_by_project[project] <= 0:
+            del self.active_by_project[project]
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, project: str, lane: str | None = None) -> AsyncIterator[None]:
+        """
+        Hold a slot for the duration of the block
+        :param project: key of the project the call is for
+        :param lane: INTERACTIVE or BULK, current_lane if not given
+        """
+        await self.acquire(project, lane or current_lane.get())
+        try:
+            yield
+        finally:
+            self.release(project)
@@ -0,0 +1,162 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/tator_client.py
+# Description: native async client for the Tator REST endpoints used by the bulk operations
+
+import asyncio
+import weakref
+from types import SimpleNamespace
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+from app.conf import tator_pool_size, tator_http2, tator_timeout_s
+from app.logger import info
+
+# Query parameters sent once per value, all other lists are sent comma separated as by the tator SDK
+MULTI_PARAMS = {"sort_by"}
+
+
+class TatorApiError(Exception):
+    """
+    A Tator call that returned an error status. Has the status like the SDK's ApiException, see batching.is_overload
+    """
+
+    def __init__(self, status: int, reason: str, body: str = ""):
+        super().__init__(f"({status}) {reason}: {body[:500]}")
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def _to_object(value: Any) -> Any:
+    """
+    Response items as objects with attribute access like the SDK models, e.g. media.id. Nested values such as
+    attributes stay dictionaries.
+    """
+    if isinstance(value, list):
+        return [_to_object(v) for v in value]
+    if isinstance(value, dict):
+        return SimpleNamespace(**value)
+    return value
+
+
+def _to_body(value: Any) -> Any:
+    return value.to_dict() if hasattr(value, "to_dict") else value
+
+
+def _params(kwargs: Dict[str, Any]) -> List[Tuple[str, str]]:
+    params = []
+    for name, value in kwargs.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            if name in MULTI_PARAMS:
+                params.extend((name, str(v)) for v in value)
+            else:
+                params.append((name, ",".join(str(v) for v in value)))
+        else:
+            params.append((name, str(value)))
+    return params
+
+
+class AsyncTatorClient:
+    """
+    Async replacement for the tator SDK methods the service calls, with the same names and arguments, so run_sdk
+    awaits them directly instead of running them on the SDK thread pool. Connections are pooled and kept alive,
+    with HTTP/2 when the h2 package is installed and the server supports it. Results are plain objects, not SDK models.
+    Each event loop gets its own HTTP client, as the queue worker runs each job on a new loop.
+    """
+
+    def __init__(self, host: str, token: str, pool_size: int = tator_pool_size, http2: bool = tator_http2,
+                 timeout_s: float = tator_timeout_s):
+        self.host = host.rstrip("/")
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout_s = timeout_s
+        self.http2 = http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                info("HTTP/2 to Tator requires h2, install it with pip install httpx[http2]. Using HTTP/1.1")
+                self.http2 = False
+        self._clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        return f"AsyncTatorClient({self.host}, pool {self.pool_size}, http2 {self.http2})"
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=self.host,
+                headers={"Authorization": f"Token {self.token}", "Accept": "application/json"},
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=self.timeout_s,
+                http2=self.http2,
+            )
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self):
+        """
+        Close the HTTP client of the running event loop
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _request(self, method: str, path: str, body: Any = None, _request_timeout: float | None = None,
+                       **kwargs) -> Any:
+        """
+        Make a call and decode its JSON response
+        :param method: HTTP method
+        :param path: path under the host, e.g. /rest/Medias/1
+        :param body: optional JSON body
+        :param _request_timeout: timeout of this call in seconds, as in the SDK
+        :param kwargs: query parameters
+        """
+        response = await self._client().request(
+            method, path, params=_params(kwargs), json=_to_body(body),
+            timeout=_request_timeout if _request_timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        )
+        if response.status_code >= 400:
+            raise TatorApiError(response.status_code, response.reason_phrase, response.text)
+        return _to_object(response.json()) if response.content else None
+
+    async def whoami(self, **kwargs):
+        return await self._request("GET", "/rest/User/GetCurrent", **kwargs)
+
+    async def get_project_list(self, **kwargs):
+        return await self._request("GET", "/rest/Projects", **kwargs)
+
+    async def get_localization_type_list(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/LocalizationTypes/{project}", **kwargs)
+
+    async def get_media_type_list(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/MediaTypes/{project}", **kwargs)
+
+    async def get_version_list(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/Versions/{project}", **kwargs)
+
+    async def get_media_count(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/MediaCount/{project}", **kwargs)
+
+    async def get_media_list(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/Medias/{project}", **kwargs)
+
+    async def get_localization_count(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/LocalizationCount/{project}", **kwargs)
+
+    async def get_localization_list(self, project: int, **kwargs):
+        return await self._request("GET", f"/rest/Localizations/{project}", **kwargs)
+
+    async def get_localization(self, id: int, **kwargs):
+        return await self._request("GET", f"/rest/Localization/{id}", **kwargs)
+
+    async def update_localization_list(self, project: int, localization_bulk_update: Any, **kwargs):
+        return await self._request("PATCH", f"/rest/Localizations/{project}", body=localization_bulk_update, **kwargs)
+
+    async def delete_localization_list(self, project: int, localization_bulk_delete: Any = None, **kwargs):
+        return await self._request("DELETE", f"/rest/Localizations/{project}", body=localization_bulk_delete, **kwargs)
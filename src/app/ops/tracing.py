@@ -0,0 +1,160 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/tracing.py
+# Description: timing of the upstream calls, tator SDK and SQL, made while handling a request or running a job
+
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Any, Dict, List
+
+from app.logger import debug
+from app.ops.metrics import FILTERED_LOCALIZATIONS
+
+SERVER_TIMING_HEADER = "server-timing"
+# Most expensive upstream methods listed in the Server-Timing header, besides the totals
+MAX_TIMING_ENTRIES = 10
+
+
+class Trace:
+    """
+    Totals of the upstream calls made in one request or job by kind and method: calls, errors, time and items returned.
+    Call times are summed, so calls made concurrently can add up to more than the elapsed time.
+    With emit_spans each call is also logged at debug level, as for bulk jobs.
+    """
+
+    def __init__(self, name: str, emit_spans: bool = False):
+        """
+        :param name: what is traced, e.g. the request path or the job id
+        :param emit_spans: log every call
+        """
+        self.name = name
+        self.emit_spans = emit_spans
+        self.start = time.perf_counter()
+        self.totals: Dict[tuple, Dict[str, float]] = {}
+        self.counters: Counter = Counter()
+
+    def add(self, kind: str, method: str, duration_s: float, project: Any = None, size: int | None = None,
+            error: bool = False):
+        """
+        Record an upstream call
+        :param kind: sdk or db
+        :param method: SDK method or query name
+        :param duration_s: duration of the call in seconds
+        :param project: project id or name, if known
+        :param size: number of items or rows returned, if known
+        :param error: True if the call raised an exception
+        """
+        total = self.totals.setdefault((kind, method), {"calls": 0, "errors": 0, "duration_s": 0., "items": 0})
+        total["calls"] += 1
+        total["errors"] += error
+        total["duration_s"] += duration_s
+        total["items"] += size or 0
+        if self.emit_spans:
+            debug("Span %s %s %s project %s %.1f ms%s%s", self.name, kind, method, project, duration_s * 1000,
+                  "" if size is None else f" {size} items", " failed" if error else "")
+
+    def server_timing(self) -> str:
+        """
+        Value of a Server-Timing header with the upstream time by kind and by the most expensive methods,
+        and the time since the trace started as total
+        """
+        entries = []
+        for kind in ("sdk", "db"):
+            totals = [t for (k, _), t in self.totals.items() if k == kind]
+            if totals:
+                entries.append(f'{kind};dur={sum(t["duration_s"] for t in totals) * 1000:.1f};'
+                               f'desc="{sum(t["calls"] for t in totals)} calls"')
+        methods = sorted(self.totals.items(), key=lambda item: item[1]["duration_s"], reverse=True)
+        for (kind, method), t in methods[:MAX_TIMING_ENTRIES]:
+            entries.append(f'{kind}-{method};dur={t["duration_s"] * 1000:.1f};'
+                           f'desc="{t["calls"]} calls {t["items"]} items"')
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Totals as a dictionary, e.g. for a job's status, with the over-fetch ratios of client-side filters
+        """
+        ratios = {}
+        for name, fetched in self.counters.items():
+            if name.endswith("_fetched"):
+                kept = self.counters.get(f"{name[:-len('_fetched')]}_kept", 0)
+                ratios[name[:-len("_fetched")]] = round(fetched / kept, 3) if kept else None
+        return {
+            "elapsed_s": round(time.perf_counter() - self.start, 3),
+            "calls": {f"{kind}.{method}": {"calls": t["calls"], "errors": t["errors"], "items": t["items"],
+                                           "duration_ms": round(t["duration_s"] * 1000, 1)}
+                      for (kind, method), t in sorted(self.totals.items())},
+            "counters": dict(self.counters),
+            "over_fetch": ratios,
+        }
+
+
+# Trace of the current request or job, None outside of them
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+def result_size(result: Any) -> int | None:
+    """
+    Number of items in a result: the length of a list, or the value of a count
+    """
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    return None
+
+
+def record_call(kind: str, method: str, start: float, project: Any = None, result: Any = None, error: bool = False):
+    """
+    Record an upstream call started at start, a time.perf_counter() value, in the current trace if there is one
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(kind, method, time.perf_counter() - start, project, result_size(result), error)
+
+
+def record_filter(name: str, operation: str, project: str, fetched: int, kept: int):
+    """
+    Record the localizations fetched from Tator and those kept by a client-side filter, to measure the over-fetch
+    :param name: name of the filter, e.g. cluster
+    :param operation: name of the operation for the metrics
+    :param project: project name
+    :param fetched: localizations returned by Tator
+    :param kept: localizations that passed the filter
+    """
+    FILTERED_LOCALIZATIONS.labels(name, operation, project, "fetched").inc(fetched)
+    FILTERED_LOCALIZATIONS.labels(name, operation, project, "kept").inc(kept)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.counters[f"{name}_fetched"] += fetched
+        trace.counters[f"{name}_kept"] += kept
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces the upstream calls of each request and adds a Server-Timing header to the response.
+    Calls made after the response started, e.g. while streaming an export, are not in the header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = Trace(scope.get("path", ""))
+
+        async def send_with_timing(message: Dict[str, Any]):
+            if message["type"] == "http.response.start":
+                headers: List[tuple] = [*message.get("headers", []),
+                                        (SERVER_TIMING_HEADER.encode(), trace.server_timing().encode())]
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_trace.reset(token)
@@ -0,0 +1,165 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/uploads.py
+# Description: incremental parsing of uploaded sdcat cluster assignment files, CSV or Parquet
+
+import csv
+import io
+import os
+from typing import Any, BinaryIO, Dict, Iterator, List, NamedTuple
+
+from app.ops.models import ClusterLabelItem
+
+# Accepted column names, first match wins
+CLUSTER_COLUMNS = ("cluster", "cluster_name")
+LABEL_COLUMNS = ("label", "Label", "class_name")
+VERIFY_COLUMNS = ("verify", "verified")
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+# Rows read from a Parquet file at a time
+PARQUET_BATCH_SIZE = 10000
+
+# Maximum number of row errors reported
+MAX_ERRORS = 100
+
+TRUE_VALUES = {"true", "t", "yes", "y", "1"}
+FALSE_VALUES = {"false", "f", "no", "n", "0"}
+
+
+class InvalidUploadException(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class ClusterAssignments(NamedTuple):
+    items: List[ClusterLabelItem]
+    rows: int
+    errors: List[str]
+    num_errors: int
+
+
+def is_parquet(filename: str | None, content_type: str | None = None) -> bool:
+    """
+    True if an upload is a Parquet file, judged by its extension or content type
+    """
+    if filename and os.path.splitext(filename)[1].lower() in PARQUET_EXTENSIONS:
+        return True
+    return bool(content_type) and "parquet" in content_type
+
+
+def _find_column(columns: List[str], names: tuple, required: bool) -> str | None:
+    for name in names:
+        if name in columns:
+            return name
+    if required:
+        raise InvalidUploadException(f"Missing column {' or '.join(names)}, found columns {', '.join(columns)}")
+    return None
+
+
+def _parse_verify(value: Any) -> bool | None:
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text == "":
+        return None
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"invalid verify value {value}")
+
+
+def _csv_rows(file: BinaryIO) -> Iterator[Dict[str, Any]]:
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.DictReader(text)
+        if reader.fieldnames is None:
+            raise InvalidUploadException("The file is empty")
+        columns = [c.strip() for c in reader.fieldnames]
+        reader.fieldnames = columns
+        yield {"columns": columns}
+        yield from reader
+    except UnicodeDecodeError as e:
+        raise InvalidUploadException(f"Not a UTF-8 text file. Error: {e}")
+    except csv.Error as e:
+        raise InvalidUploadException(f"Not a valid CSV file. Error: {e}")
+    finally:
+        text.detach()
+
+
+def _parquet_rows(file: BinaryIO) -> Iterator[Dict[str, Any]]:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise InvalidUploadException("Parquet uploads require pyarrow, install it with pip install pyarrow")
+
+    try:
+        parquet = pq.ParquetFile(file)
+    except Exception as e:
+        raise InvalidUploadException(f"Not a valid Parquet file. Error: {e}")
+    columns = parquet.schema_arrow.names
+    wanted = [c for c in (_find_column(columns, CLUSTER_COLUMNS, True), _find_column(columns, LABEL_COLUMNS, True),
+                          _find_column(columns, VERIFY_COLUMNS, False)) if c]
+    yield {"columns": columns}
+    for batch in parquet.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=wanted):
+        yield from batch.to_pylist()
+
+
+def parse_cluster_file(file: BinaryIO, parquet: bool = False) -> ClusterAssignments:
+    """
+    Read cluster to label assignments row by row from a CSV or Parquet file with a cluster and a label column,
+    and an optional verify column. Rows repeating a cluster with the same label are merged. Clusters assigned
+    to different labels, and rows without a cluster or label, are left out and reported as errors.
+    This blocks, run it in a thread.
+    :param file: binary file positioned at the start
+    :param parquet: True for a Parquet file, False for CSV
+    :return: the assignments in the order of the file with the number of rows and the errors
+    """
+    items: Dict[str, ClusterLabelItem] = {}
+    conflicts = set()
+    errors = []
+    num_errors = 0
+    num_rows = 0
+
+    def error(message: str):
+        nonlocal num_errors
+        num_errors += 1
+        if len(errors) < MAX_ERRORS:
+            errors.append(message)
+
+    rows = _parquet_rows(file) if parquet else _csv_rows(file)
+    try:
+        columns = next(rows)["columns"]
+        cluster_column = _find_column(columns, CLUSTER_COLUMNS, True)
+        label_column = _find_column(columns, LABEL_COLUMNS, True)
+        verify_column = _find_column(columns, VERIFY_COLUMNS, False)
+
+        for num_rows, row in enumerate(rows, start=1):
+            cluster = str(row.get(cluster_column) or "").strip()
+            label = str(row.get(label_column) or "").strip()
+            if not cluster or not label:
+                error(f"Row {num_rows}: missing {'cluster' if not cluster else 'label'}")
+                continue
+            try:
+                verify = _parse_verify(row.get(verify_column)) if verify_column else None
+            except ValueError as e:
+                error(f"Row {num_rows}: {e}")
+                continue
+            item = ClusterLabelItem(cluster_name=cluster, label=label, verify=verify)
+            if cluster in conflicts:
+                continue
+            existing = items.get(cluster)
+            if existing is not None and existing != item:
+                if existing.label != label:
+                    error(f"Row {num_rows}: cluster {cluster} is assigned to both {existing.label} and {label}, skipping it")
+                else:
+                    error(f"Row {num_rows}: cluster {cluster} has different verify values, skipping it")
+                conflicts.add(cluster)
+                del items[cluster]
+                continue
+            items[cluster] = item
+    finally:
+        rows.close()
+
+    return ClusterAssignments(list(items.values()), num_rows, errors, num_errors)
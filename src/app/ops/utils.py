@@ -2,18 +2,23 @@
 # Filename: app/ops/utils.py
 # Description: operations that modify the database
 
+import asyncio
 import os
 
-import psycopg2
 import tator
 from tator.openapi.tator_openapi import TatorApi
-from typing import List, Tuple
+from tator.openapi.tator_openapi.rest import RESTClientObject
+from typing import AsyncIterator, List
+from app.conf import sdk_threads, media_page_size, tator_async_client
 from app.logger import info, exception, debug, err
+from app.ops.cache import CachedValue, label_cache
+from app.ops.executor import run_sdk
+from app.ops.db import fetch_all, fetch_one
 from app.ops.models import ProjectSpec, FilterType
+from app.ops.projects import registry
+from app.ops.tator_client import AsyncTatorClient
 from typing import Any
 
-global projects
-
 
 # Custom exceptions
 class NotFoundException(Exception):
@@ -22,7 +27,7 @@ class NotFoundException(Exception):
 
 def prepare_media_kwargs(model:Any, allow_empty_media:bool=False, attribute_prefix=None) -> dict | None:
     media_kwargs = {}
-    debug(f"prepare_media_kwargs model: {model}")
+    debug("prepare_media_kwargs model: %s", model)
     if not hasattr(model, "filter_media"):
         return media_kwargs
     media_filter_type = FilterType(model.filter_media)
@@ -64,7 +69,13 @@ def init_api() -> tator.api:
         return
 
     try:
+        if tator_async_client:
+            api = AsyncTatorClient(os.environ["TATOR_API_HOST"], os.environ["TATOR_API_TOKEN"])
+            info(api)
+            return api
         api = tator.get_api(os.environ["TATOR_API_HOST"], os.environ["TATOR_API_TOKEN"])
+        # Size the HTTP connection pool to match the SDK thread pool so concurrent calls can reuse connections
+        api.api_client.rest_client = RESTClientObject(api.api_client.configuration, maxsize=sdk_threads)
         info(api)
         return api
     except Exception as e:
@@ -74,15 +85,11 @@ def init_api() -> tator.api:
 
 async def get_tator_projects(api: tator.api) -> List[tator.models.Project]:
     """
-    Get all projects from the Tator API
+    Get all projects from the Tator API and refresh the project registry
     :param api: The Tator API object
     :return: List of projects
     """
-    global projects
-    info("Fetching projects from tator")
-    projects = api.get_project_list()
-    info(f"Found {len(projects)} projects")
-    return projects
+    return await registry.refresh(api)
 
 async def get_projects(tator_api: TatorApi):
     """
@@ -116,18 +123,13 @@ async def get_image_spec_version(api: TatorApi, model):
 async def get_version_id(api: tator.api, project_id: int, version_name: str) -> int:
     """
     Get the version id for the given version name. Returns None if the version is not found.
+    Version maps are cached per project in the project registry.
     :param api: The Tator API object
     :param project_id: The project id to search for the version in
     :param version_name: The name of the version to get the id for
     :return: The version id
     """
-    versions = api.get_version_list(project_id)
-    for v in versions:
-        info(f"Found version {v.name} id {v.id} in project {project_id}")
-        if v.name == version_name:
-            return v.id
-
-    return None
+    return await registry.get_version_id(api, project_id, version_name)
 
 async def get_localization(api: tator.api, id: int) -> tator.models.Localization:
     """
@@ -137,40 +139,32 @@ async def get_localization(api: tator.api, id: int) -> tator.models.Localization
     :return: localization that matches the id
     """
     try:
-        localizations = api.get_localization(id=id)
+        localizations = await run_sdk(api.get_localization, id=id)
         return localizations
     except Exception as e:
         exception(e)
         return None
 
-async def get_localization_count(api: tator.api, project_name: str) -> int:
-    global projects
-    project = next((p for p in projects if p.name == project_name), None)
-
-    if project is None:
-        info(f"Project {project_name} not found")
-        raise NotFoundException(name=project_name)
-
-    count = api.get_localization_count(project=project.id, type=project.box_type)
-    debug(f"Found {count} localizations in project {project_name}")
-    return count
-
 async def get_project_spec(api: tator.api, project_name: str) -> ProjectSpec:
     """
     Get common project specifications used across operations. Raises a NotFoundException if the project is not found.
+    Specifications are cached in the project registry so repeat requests make no upstream type lookups.
     :param project_name: The name of the project to initialize
     :return: The project spec
     """
-    global projects
+    spec = registry.get_spec(project_name)
+    if spec is not None:
+        return spec
+
     try:
 
-        project = next((p for p in projects if p.name == project_name), None)
+        project = await registry.get_project(api, project_name)
         if project is None:
             info(f"Project {project_name} not found")
             raise NotFoundException(name=project_name)
 
         # Get the box localization type for the project
-        localization_types = api.get_localization_type_list(project=project.id)
+        localization_types = await run_sdk(api.get_localization_type_list, project=project.id)
 
         # The box type is the one with the name 'Boxes'
         box_type = None
@@ -182,7 +176,7 @@ async def get_project_spec(api: tator.api, project_name: str) -> ProjectSpec:
                 break
 
         # Get the image and video media type for the project
-        media_types = api.get_media_type_list(project=project.id)
+        media_types = await run_sdk(api.get_media_type_list, project=project.id)
         image_type = None
         video_type = None
         for m in media_types:
@@ -196,7 +190,9 @@ async def get_project_spec(api: tator.api, project_name: str) -> ProjectSpec:
                 video_type = m.id
                 info(f"Found video type {video_type}")
 
-        return ProjectSpec(project_name=project.name, project_id=project.id, image_type=image_type, video_type=video_type, box_type=box_type)
+        spec = ProjectSpec(project_name=project.name, project_id=project.id, image_type=image_type, video_type=video_type, box_type=box_type)
+        registry.put_spec(spec)
+        return spec
     except Exception as e:
         exception(e)
         raise NotFoundException(name=project_name)
@@ -211,8 +207,8 @@ async def get_localization_count(api: tator.api, spec: ProjectSpec, **kwargs) ->
     :return: count of media that match the filter
     """
     try:
-        debug(f'get_localization_count: {spec.project_id}, {spec.box_type}, {kwargs}')
-        loc_count = api.get_localization_count(project=spec.project_id, type=spec.box_type, **kwargs)
+        debug("get_localization_count: %s, %s, %s", spec.project_id, spec.box_type, kwargs)
+        loc_count = await run_sdk(api.get_localization_count, project=spec.project_id, type=spec.box_type, **kwargs)
         return loc_count
     except Exception as e:
         exception(e)
@@ -228,98 +224,53 @@ async def get_media_list(api: tator.api, spec: ProjectSpec, media_type: int,  **
     :return: list of media that match the filter
     """
     try:
-        media = api.get_media_list(project=spec.project_id, type=media_type, **kwargs)
+        media = await run_sdk(api.get_media_list, project=spec.project_id, type=media_type, **kwargs)
         return media
     except Exception as e:
         exception(e)
         return []
 
-async def get_label_counts_score(project_id: int, version_id: int, score_min: float) -> List[Tuple[str, int]]:
+async def get_label_counts_score(project_id: int, version_id: int, score_min: float) -> CachedValue:
     """
-    Get the label counts for a given project that exist in a filename and version
+    Get the label counts for a given project and version for localizations with a score greater than score_min
     :param project_id:  project id
     :param version_id:  version id
     :param score_min:  minimum score
-    :return:  list of tuples with label and count
-    """
-    """
-    Get the label counts for a given project for localizations with a score greater than score_min
-    :param project_id:
-    :return:  JSON object with label counts sorted by count in descending order
+    :return:  dictionary of label counts sorted by count in descending order, with its age in seconds and ETag
     """
-    dbname = os.environ.get("TATOR_DB_NAME", "tator_online")
-    user = os.environ.get("TATOR_DB_USER", "django")
-    password = os.environ.get("TATOR_DB_PASSWORD")
-    host = os.environ.get("TATOR_DB_HOST", "mantis.shore.mbari.org")
-    port = os.environ.get("TATOR_DB_PORT", "5432")
-
-    try:
-        DB_PARAMS = {
-            "dbname": dbname,
-            "user": user,
-            "password": password,
-            "host": host,
-            "port": str(port),
-        }
-
-        query = """
-            SELECT 
-                attributes->>'Label' AS label,
-                COUNT(*) AS count
-            FROM public.main_localization
-            WHERE attributes ? 'Label'
-              AND attributes ? 'score'
-              AND project = %s 
-              AND version = %s
-              AND attributes->>'score' > score_min
-            GROUP BY attributes->>'Label', attributes->>%s;
-            """
-
-        with psycopg2.connect(**DB_PARAMS) as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, (project_id, str(version_id), str(score_min)))
-                rows = cur.fetchall()
+    query = """
+        SELECT 
+            attributes->>'Label' AS label,
+            COUNT(*) AS count
+        FROM public.main_localization
+        WHERE attributes ? 'Label'
+          AND attributes ? 'score'
+          AND project = %s 
+          AND version = %s
+          AND (attributes->>'score')::float > %s
+        GROUP BY attributes->>'Label';
+        """
 
-        nested_result = {}
-        for label, a, count in rows:
-            if label not in nested_result:
-                nested_result[label] = {}
-            nested_result[label][a] = count
+    async def load() -> dict:
+        rows = await fetch_all(query, (project_id, version_id, float(score_min)), name="label_counts_score", project=project_id)
+        return dict(sorted(rows, key=lambda item: item[1], reverse=True))
 
-        return nested_result
+    try:
+        return await label_cache.get_or_load((project_id, "score", version_id, float(score_min)), load)
 
     except Exception as e:
-        print(f"Error: {e}")
-        return {"labels": {}}
+        exception(f"Error: {e}")
+        return CachedValue({"labels": {}}, 0., None)
 
-async def get_label_counts_cluster(project_id: int, version_id: int, attribute: str = None) -> List[Tuple[str, int]]:
+async def get_label_counts_cluster(project_id: int, version_id: int, attribute: str = None) -> CachedValue:
     """
     Get the label counts for a given project that exist in a cluster, version, and optional attribute, e.g. depth, altitude, etc.
     :param project_id:  project id
     :param version_id:  version id
     :param attribute:  attribute to filter on
-    :return:  list of tuples with label and count
-    """
-    """
-    Get the label counts for a given project for all verified localizations
-    :param project_id:
-    :return:  JSON object with label counts sorted by count in descending order
+    :return:  dictionary of label counts, nested by attribute value if an attribute is given, with its age in seconds and ETag
     """
-    dbname = os.environ.get("TATOR_DB_NAME", "tator_online")
-    user = os.environ.get("TATOR_DB_USER", "django")
-    password = os.environ.get("TATOR_DB_PASSWORD")
-    host = os.environ.get("TATOR_DB_HOST", "mantis.shore.mbari.org")
-    port = os.environ.get("TATOR_DB_PORT", "5432")
-
-    try:
-        DB_PARAMS = {
-            "dbname": dbname,
-            "user": user,
-            "password": password,
-            "host": host,
-            "port": str(port),
-        }
-
+    async def load() -> dict:
         if attribute is not None:
             query = """
                 SELECT 
@@ -335,10 +286,8 @@ async def get_label_counts_cluster(project_id: int, version_id: int, attribute:
                 GROUP BY attributes->>'Label', attributes->>%s;
                 """
 
-            with psycopg2.connect(**DB_PARAMS) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(query, ( str(attribute), str(attribute), project_id, str(version_id), str(attribute)))
-                    rows = cur.fetchall()
+            rows = await fetch_all(query, (str(attribute), str(attribute), project_id, version_id, str(attribute)),
+                                   name="label_counts_cluster_attribute", project=project_id)
 
             nested_result = {}
             for label, a, count in rows:
@@ -362,60 +311,48 @@ async def get_label_counts_cluster(project_id: int, version_id: int, attribute:
             ) subquery;
             """
 
-            with psycopg2.connect(**DB_PARAMS) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(query, (project_id, str(version_id)))
-                    result = cur.fetchone()[0]
+            row = await fetch_one(query, (project_id, version_id), name="label_counts_cluster", project=project_id)
+            result = row[0] if row else None
             results = {"labels": result} if result else {"labels": {}}
             result = dict(sorted(results["labels"].items(), key=lambda item: item[1], reverse=True))
             return result
 
+    try:
+        return await label_cache.get_or_load((project_id, "cluster", version_id, attribute), load)
+
     except Exception as e:
-        print(f"Error: {e}")
-        return {"labels": {}}
+        exception(f"Error: {e}")
+        return CachedValue({"labels": {}}, 0., None)
 
-async def get_label_counts_json(project_id):
+async def get_label_counts_json(project_id) -> CachedValue:
     """
     Get the label counts for a given project for all verified localizations
     :param project_id:
-    :return:  JSON object with label counts sorted by count in descending order
+    :return:  JSON object with label counts sorted by count in descending order, with its age in seconds and ETag
+    """
+    query = """
+    SELECT jsonb_object_agg(label, count) AS labels
+    FROM (
+        SELECT attributes->>'Label' AS label, COUNT(*) AS count
+        FROM public.main_localization
+        WHERE attributes ? 'Label' AND project = %s AND attributes->>'verified' = 'true' AND attributes->>'Label' IS NOT NULL
+        GROUP BY attributes->>'Label'
+    ) subquery;
     """
-    dbname = os.environ.get("TATOR_DB_NAME", "tator_online")
-    user = os.environ.get("TATOR_DB_USER", "django")
-    password = os.environ.get("TATOR_DB_PASSWORD")
-    host = os.environ.get("TATOR_DB_HOST", "mantis.shore.mbari.org")
-    port = os.environ.get("TATOR_DB_PORT", "5432")
-
-    try:
-        DB_PARAMS = {
-            "dbname": dbname,
-            "user": user,
-            "password": password,
-            "host": host,
-            "port": str(port),
-        }
-
-        query = """
-        SELECT jsonb_object_agg(label, count) AS labels
-        FROM (
-            SELECT attributes->>'Label' AS label, COUNT(*) AS count
-            FROM public.main_localization
-            WHERE attributes ? 'Label' AND project = %s AND attributes->>'verified' = 'true' AND attributes->>'Label' IS NOT NULL
-            GROUP BY attributes->>'Label'
-        ) subquery;
-        """
 
-        with psycopg2.connect(**DB_PARAMS) as conn:
-            with conn.cursor() as cur:
-                cur.execute(query, (project_id,))
-                result = cur.fetchone()[0]
+    async def load() -> dict:
+        row = await fetch_one(query, (project_id,), name="label_counts_verified", project=project_id)
+        result = row[0] if row else None
         results = {"labels": result} if result else {"labels": {}}
         result = dict(sorted(results["labels"].items(), key=lambda item: item[1], reverse=True))
         return result
 
+    try:
+        return await label_cache.get_or_load((project_id, "verified"), load)
+
     except Exception as e:
-        print(f"Error: {e}")
-        return {"labels": {}}
+        exception(f"Error: {e}")
+        return CachedValue({"labels": {}}, 0., None)
 
 
 async def get_media_count(api: tator.api, spec: ProjectSpec, **kwargs) -> int:
@@ -427,18 +364,81 @@ async def get_media_count(api: tator.api, spec: ProjectSpec, **kwargs) -> int:
     :return: count of media that match the filter
     """
     try:
-        media_count = 0
-        if spec.image_type:
-            debug(f'get_media_count: {spec.project_id}, {spec.image_type}, {kwargs}')
-            media_count = api.get_media_count(project=spec.project_id, type=spec.image_type, **kwargs)
-        if spec.video_type:
-            debug(f'get_media_count: {spec.project_id}, {spec.video_type}, {kwargs}')
-            media_count += api.get_media_count(project=spec.project_id, type=spec.video_type, **kwargs)
-        return media_count
+        media_types = [t for t in (spec.image_type, spec.video_type) if t]
+        debug("get_media_count: %s, %s, %s", spec.project_id, media_types, kwargs)
+        counts = await asyncio.gather(
+            *(run_sdk(api.get_media_count, project=spec.project_id, type=t, **kwargs) for t in media_types)
+        )
+        return sum(counts)
     except Exception as e:
         exception(e)
         return 0
 
+async def iter_media_ids(
+        api: tator.api,
+        spec: ProjectSpec,
+        chunk_size: int = 100,
+        page_size: int = media_page_size,
+        position: dict | None = None,
+        **kwargs
+) -> AsyncIterator[List[int]]:
+    """
+    Stream the media ids that match the filter in chunks. Each media type is counted with the same filter
+    and paged by id (keyset paging), so pages stay fast at any depth and ids are never repeated.
+    :param api:  tator api
+    :param spec:  project specifications
+    :param chunk_size:  number of media ids in each yielded chunk
+    :param page_size:  number of media fetched from tator per request
+    :param position:  optional {"media_type", "after"} to resume after, updated to the last media of each chunk
+    before it is yielded. Chunks do not span media types when given
+    :param kwargs:  filter arguments to pass to the get_media_count and get_media_list functions
+    :return: async iterator of lists of media ids that match the filter
+    """
+    chunk = []
+    resume = position.get("media_type") if position else None
+    for media_type in (spec.image_type, spec.video_type):
+        if media_type is None:
+            continue
+
+        last_id = None
+        if resume is not None:
+            if media_type != resume:
+                continue
+            last_id = position.get("after")
+            resume = None
+
+        media_count = await run_sdk(api.get_media_count, project=spec.project_id, type=media_type, **kwargs)
+        debug("Searching through %s medias of type %s with %s", media_count, media_type, kwargs)
+
+        num_found = 0
+        while num_found < media_count:
+            page_kwargs = dict(kwargs, sort_by=["$id"], stop=page_size)
+            if last_id is not None:
+                page_kwargs["after"] = last_id
+            media = await run_sdk(api.get_media_list, project=spec.project_id, type=media_type, **page_kwargs)
+            if len(media) == 0:
+                break
+
+            num_found += len(media)
+            last_id = max(m.id for m in media)
+            for m in media:
+                chunk.append(m.id)
+                if len(chunk) == chunk_size:
+                    if position is not None:
+                        position.update(media_type=media_type, after=chunk[-1])
+                    yield chunk
+                    chunk = []
+
+        debug("Found %d medias of type %s with %s", num_found, media_type, kwargs)
+        if position is not None and chunk:
+            position.update(media_type=media_type, after=chunk[-1])
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
 async def get_media_ids(
         api: tator.api,
         spec: ProjectSpec,
@@ -453,28 +453,12 @@ async def get_media_ids(
     """
     try:
         media_ids = []
-        media_count = 0
-        if spec.image_type is not None:
-            media_count = api.get_media_count(project=spec.project_id, type=spec.image_type)
-        if spec.video_type is not None:
-            media_count += api.get_media_count(project=spec.project_id, type=spec.video_type)
-
-        if media_count == 0:
-            err(f"No media found in project {spec.project_name}")
-            return media_ids
-
-        batch_size = min(1000, media_count)
-        debug(f"Searching through {media_count} medias with {kwargs}")
-        for i in range(0, media_count, batch_size):
-            media = api.get_media_list(project=spec.project_id, start=i, stop=i + batch_size, **kwargs)
-            for m in media:
-                media_ids.append(m.id)
-
-        # Remove any duplicate ids. Is this necessary?
-        media_ids = list(set(media_ids))
+        async for chunk in iter_media_ids(api, spec, **kwargs):
+            media_ids.extend(chunk)
 
-        debug(f"Found {len(media_ids)} medias with {kwargs}")
+        if len(media_ids) == 0:
+            err(f"No media found in project {spec.project_name} with {kwargs}")
         return media_ids
     except Exception as e:
         exception(e)
-        return []
\ No newline at end of file
+        return []
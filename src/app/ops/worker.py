@@ -1,25 +1,214 @@
-# worker.py
-import redis
-from rq import Worker, Queue, Connection
+# fastapi-tator, Apache-2.0 license
+# Filename: app/ops/worker.py
+# Description: worker that runs queued bulk operations. Run as many as needed with
+#   python -m app.ops.worker
 
-from app.logger import info
-from app.ops.models import SDCATModel
+import asyncio
+import os
+import signal
+import threading
+from pathlib import Path
+from contextlib import nullcontext, suppress
+from typing import Any
 
+import tator
+from prometheus_client import CollectorRegistry, start_http_server
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
+from pydantic import BaseModel
+from rq import Worker, get_current_job
 
-async def sdcat_detect(model: SDCATModel):
+import app.ops.models as models
+from app.conf import worker_metrics_port
+from app.logger import info, warn, create_logger_file, flush_logs
+from app.ops.checkpoints import JobInterrupted, job_checkpoint, request_drain
+from app.ops.db import open_db_pool, close_db_pool
+from app.ops.dedup import release_job_key
+from app.ops.metrics import JOBS_QUEUED, JOBS_IN_FLIGHT
+from app.ops.deletions import del_media_id, del_locs_by_filter, del_locs_filename
+from app.ops.modifications import assign_cluster_media_label, assign_cluster_label, change_label_id, assign_cluster_labels, \
+    assign_label_ids
+from app.ops.profiling import Profile
+from app.ops.progress import current_job, flush_progress
+from app.ops.scheduler import current_lane, BULK
+from app.ops.tator_client import AsyncTatorClient
+from app.ops.tracing import Trace, current_trace
+from app.ops.utils import init_api, get_project_spec
+
+# Bulk operations that can be queued, by name
+OPERATIONS = {
+    "change_label_id": change_label_id,
+    "assign_label_ids": assign_label_ids,
+    "assign_cluster_label": assign_cluster_label,
+    "assign_cluster_media_label": assign_cluster_media_label,
+    "assign_cluster_labels": assign_cluster_labels,
+    "del_media_id": del_media_id,
+    "del_locs_filename": del_locs_filename,
+    "del_locs_by_filter": del_locs_by_filter,
+}
+
+# Signal sent by the worker to the work horse running a job to checkpoint and stop
+DRAIN_SIGNAL = signal.SIGUSR1
+
+_api = None
+
+
+def get_api() -> tator.api:
+    global _api
+    if _api is None:
+        _api = init_api()
+    return _api
+
+
+async def execute_job(operation: str, model_type: str, model: dict, label: str | None = None,
+                      kwargs: dict | None = None, api: tator.api | None = None) -> Any:
     """
-    Process all images in a given directory
-    :param model: model with criteria for the job
+    Run a bulk operation from a queued job payload
+    :param operation: name of the operation in OPERATIONS
+    :param model_type: name of the request model class in app.ops.models
+    :param model: the request model as a dictionary
+    :param label: optional label for relabel operations
+    :param kwargs: additional keyword arguments for the operation
+    :param api: tator api, created from the environment if not given
+    :return: the operation summary as a dictionary, if the operation returns one
     """
-    # Send a Slack message
-    print(f"=====================>Processing images in {model.images}")
-    pass
+    model = getattr(models, model_type)(**model)
+    # Upstream calls of jobs wait behind interactive requests, which matters when jobs run in the web process
+    current_lane.set(BULK)
+    job = current_job.get()
+    trace = Trace(f"job {job.id if job else operation}", emit_spans=True)
+    current_trace.set(trace)
+    try:
+        api = api or get_api()
+        spec = await get_project_spec(api, model.project_name)
+        op_kwargs = dict(kwargs or {})
+        if label is not None:
+            op_kwargs["label"] = label
+        result = await OPERATIONS[operation](model=model, api=api, spec=spec, **op_kwargs)
+        return result.model_dump() if isinstance(result, BaseModel) else result
+    finally:
+        # Upstream call totals and over-fetch ratios, shown in the job's status
+        summary = trace.summary()
+        info(f"{operation} upstream calls {summary['calls']} over-fetch {summary['over_fetch']}")
+        if job:
+            job.meta["trace"] = summary
+            flush_progress(job)
+
+
+def run_job(**payload) -> Any:
+    """
+    Entry point for queued jobs, see redis_process.submit_job. On DRAIN_SIGNAL the job finishes its in-flight batches,
+    checkpoints and fails so it can be resumed, see redis_process.resume_jobs.
+    """
+    job = get_current_job()
+
+    async def _run():
+        token = current_job.set(job)
+        if job and job.meta.pop("interrupted", None):
+            job.save_meta()
+        await open_db_pool()
+        try:
+            with job_checkpoint(job.id if job else None, payload):
+                return await execute_job(**payload)
+        finally:
+            await close_db_pool()
+            # The HTTP client of the async Tator client is bound to this job's event loop
+            if isinstance(_api, AsyncTatorClient):
+                await _api.aclose()
+            current_job.reset(token)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(DRAIN_SIGNAL, lambda signum, frame: request_drain())
+    profile_id = job.meta.get("profile_id") if job else None
+    try:
+        with Profile(profile_id, async_mode="disabled") if profile_id else nullcontext():
+            result = asyncio.run(_run())
+    except JobInterrupted:
+        if job:
+            # Keeps the job's idempotency key, see dedup.claim_job_key
+            job.meta["interrupted"] = True
+            job.save_meta()
+        raise RuntimeError("Interrupted by a shutdown, the job resumes from its checkpoint when a worker starts")
+    except Exception:
+        if job:
+            release_job_key(job, False)
+        raise
+    finally:
+        # The work horse exits without running atexit handlers
+        flush_logs()
+    if job:
+        release_job_key(job, True, result)
+    return result
+
+
+class _QueueGauges:
+    """
+    Collector that updates the job gauges before the multiprocess collector reads them, as their functions are only
+    called on the default registry
+    """
+
+    def collect(self):
+        from app.ops.redis_process import queued_jobs, in_flight_jobs
+        JOBS_QUEUED.set(queued_jobs())
+        JOBS_IN_FLIGHT.set(in_flight_jobs())
+        return []
+
+
+def serve_metrics(port: int):
+    """
+    Serve the metrics of the worker and of its jobs. Each job runs in a forked work horse, so the metrics it records
+    are only kept with prometheus_client's multiprocess mode, i.e. when PROMETHEUS_MULTIPROC_DIR names an existing
+    directory before the worker starts. Files left by earlier runs are removed so their counts are not exported again.
+    """
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if not multiproc_dir:
+        warn("PROMETHEUS_MULTIPROC_DIR is not set, the metrics of jobs are lost when their work horse exits")
+        start_http_server(port)
+        return
+    for path in Path(multiproc_dir).glob("*.db"):
+        if not path.stem.endswith(f"_{os.getpid()}"):
+            path.unlink(missing_ok=True)
+    registry = CollectorRegistry()
+    registry.register(_QueueGauges())
+    MultiProcessCollector(registry, path=multiproc_dir)
+    start_http_server(port, registry=registry)
+
+
+class DrainingWorker(Worker):
+    """
+    Worker that asks the running job to finish its in-flight batches and checkpoint on a warm shutdown, e.g. docker stop,
+    instead of waiting for the whole job to finish
+    """
+
+    def handle_warm_shutdown_request(self):
+        super().handle_warm_shutdown_request()
+        if self.horse_pid:
+            with suppress(ProcessLookupError):
+                os.kill(self.horse_pid, DRAIN_SIGNAL)
+
+    def fork_work_horse(self, job, queue):
+        super().fork_work_horse(job, queue)
+        # horse_pid is reset once the work horse exits
+        self.last_horse_pid = self.horse_pid
+
+    def execute_job(self, job, queue):
+        try:
+            super().execute_job(job, queue)
+        finally:
+            # Drop the live gauges of the exited work horse, see serve_metrics
+            if os.environ.get("PROMETHEUS_MULTIPROC_DIR") and getattr(self, "last_horse_pid", 0):
+                mark_process_dead(self.last_horse_pid)
 
-listen = ['default']
 
 if __name__ == '__main__':
-    redis_conn = redis.Redis(host='localhost', port=6379, db=0)
-    task_queue = Queue(connection=redis_conn)
-    with Connection(redis_conn):
-        worker = Worker(map(Queue, listen))
-        worker.work()
+    from app.ops.redis_process import get_redis, get_queue, resume_jobs
+    create_logger_file(Path.home() / "tator_api" / "logs", "TATOR_WORKER")
+    queue = get_queue()
+    if worker_metrics_port:
+        info(f"Serving worker metrics on port {worker_metrics_port}")
+        serve_metrics(worker_metrics_port)
+    resumed = asyncio.run(resume_jobs())
+    if resumed:
+        info(f"Resumed {resumed} unfinished jobs")
+    info(f"Starting worker on queue {queue.name}")
+    worker = DrainingWorker([queue], connection=get_redis())
+    worker.work()
@@ -0,0 +1,11 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: tests/conftest.py
+# Description: run the tests with the in-process Redis stand-in and a throwaway checkpoint database
+
+import os
+import tempfile
+from pathlib import Path
+
+# Read by app.conf when it is first imported
+os.environ.pop("FASTAPI_TATOR_REDIS_URL", None)
+os.environ["FASTAPI_TATOR_CHECKPOINT_DB"] = str(Path(tempfile.mkdtemp()) / "checkpoints.db")
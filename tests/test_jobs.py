@@ -0,0 +1,103 @@
+# fastapi-tator, Apache-2.0 license
+# Filename: tests/test_jobs.py
+# Description: the job queue run in the web process against the in-process Redis stand-in
+
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.ops.progress as progress
+import app.ops.redis_process as redis_process
+import app.ops.worker as worker
+from app.main import app
+from app.ops.models import LocClusterFilterModel, ProjectSpec
+from app.ops.progress import report_progress
+
+
+async def fake_relabel(model: LocClusterFilterModel, api, spec: ProjectSpec, label: str):
+    for _ in range(3):
+        report_progress(items=10, batches=1)
+    return {"items": 30, "label": label, "project_id": spec.project_id}
+
+
+async def failing_relabel(model: LocClusterFilterModel, api, spec: ProjectSpec, label: str):
+    report_progress(items=10, batches=1)
+    raise RuntimeError("Tator is down")
+
+
+@pytest.fixture(autouse=True)
+def operations(monkeypatch):
+    async def get_project_spec(api, project_name):
+        return ProjectSpec(project_name=project_name, project_id=1, box_type=2, image_type=3)
+
+    monkeypatch.setattr(worker, "get_project_spec", get_project_spec)
+    monkeypatch.setitem(worker.OPERATIONS, "fake_relabel", fake_relabel)
+    monkeypatch.setitem(worker.OPERATIONS, "failing_relabel", failing_relabel)
+
+
+def submit(operation: str, cluster_name: str, label: str = "Fish", times: int = 1) -> list:
+    """
+    Submit the same request times times and wait for the jobs to run, returning the job ids
+    """
+    async def run():
+        model = LocClusterFilterModel(cluster_name=cluster_name, project_name="test", dry_run=False)
+        job_ids = [await redis_process.submit_job(object(), operation, model, label=label) for _ in range(times)]
+        while redis_process._local_tasks:
+            await asyncio.gather(*redis_process._local_tasks)
+        return job_ids
+
+    return asyncio.run(run())
+
+
+def test_submit_job_runs_in_process():
+    assert redis_process.local_mode()
+    job_id, = submit("fake_relabel", "C1")
+
+    status = redis_process.get_job_status(job_id)
+    assert status["status"] == "finished"
+    assert status["operation"] == "fake_relabel"
+    assert status["project_name"] == "test"
+    assert status["progress"] == {"items": 30, "batches": 3}
+    assert status["errors"] == []
+    assert status["summary"] == {"items": 30, "label": "Fish", "project_id": 1}
+    assert status["trace"] is not None
+
+
+def test_progress_saved_at_most_every_interval(monkeypatch):
+    saves = []
+    monkeypatch.setattr(progress.Job, "save_meta", lambda job: saves.append(dict(job.meta["progress"])))
+    monkeypatch.setattr(progress, "PROGRESS_SAVE_INTERVAL_S", 3600)
+    submit("fake_relabel", "C2")
+    # The first report, then the flush when the operation ends, then the status saved by the web process
+    assert saves == [{"items": 10, "batches": 1}, {"items": 30, "batches": 3}, {"items": 30, "batches": 3}]
+
+
+def test_duplicate_request_attaches_to_the_job():
+    first, second = submit("fake_relabel", "C3", times=2)
+    assert first == second
+    other, = submit("fake_relabel", "C3", label="Crab")
+    assert other != first
+
+
+def test_failed_job_reports_errors_and_is_not_attached():
+    first, = submit("failing_relabel", "C4")
+    status = redis_process.get_job_status(first)
+    assert status["status"] == "failed"
+    assert status["progress"] == {"items": 10, "batches": 1}
+    assert status["errors"] == ["Tator is down"]
+
+    retry, = submit("failing_relabel", "C4")
+    assert retry != first
+
+
+def test_jobs_endpoint():
+    job_id, = submit("fake_relabel", "C5")
+    client = TestClient(app)
+
+    response = client.get(f"/jobs/{job_id}")
+    assert response.status_code == 200
+    assert response.json()["status"] == "finished"
+    assert response.json()["progress"] == {"items": 30, "batches": 3}
+
+    assert client.get("/jobs/missing").status_code == 404